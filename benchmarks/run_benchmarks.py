@@ -0,0 +1,226 @@
+"""
+Benchmarks of ROI detection, TIC/EIC extraction and ROI I/O on synthetic runs.
+Every stage runs in a separate process, so its peak RSS is measured independently.
+
+    python benchmarks/run_benchmarks.py --size medium --output results.json
+    python benchmarks/run_benchmarks.py --size medium --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SIZES = {
+    'small': {'scans': 500, 'density': 1000, 'compounds': 300},
+    'medium': {'scans': 2000, 'density': 3000, 'compounds': 1000},
+    'large': {'scans': 6000, 'density': 5000, 'compounds': 3000},
+}
+STAGES = ['get_rois', 'cluster_rois', 'build_cache', 'get_rois_cached', 'cluster_rois_cached', 'parallel_rois_cached',
+          'tic', 'tic_cached', 'eic', 'eic_50_targets', 'save_json', 'save_store', 'load_json_labels',
+          'load_store_labels']
+ROI_PARAMETERS = {'delta_mz': 0.005, 'required_points': 15, 'intensity_threshold': 1000, 'dropped_points': 3}
+
+
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on Linux
+
+
+def _rois(path):
+    from utils.roi import get_ROIs
+    return get_ROIs(path, **ROI_PARAMETERS)
+
+
+def _folder_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+
+
+def run_stage(stage, path, work_dir):
+    """
+    Run one stage (in a child process)
+    :return: dict with seconds, peak RSS and stage counters
+    """
+    cache_dir = os.path.join(work_dir, 'cache' if stage.endswith('cached') or stage == 'build_cache' else 'no_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['LCMS_MARKTOOL_CACHE'] = cache_dir  # read by utils.scan_cache on import
+    import numpy as np
+    from utils.roi import construct_tic, construct_eic
+    from utils.roi_store import ROIStore, JSONFolder, STORE_FILENAME
+    from utils.scan_cache import build_cache
+
+    result = {}
+    rois = _rois(path) if stage in ('save_json', 'save_store') else None
+    json_folder = os.path.join(work_dir, 'json')
+    store_folder = os.path.join(work_dir, 'store')
+    if stage == 'load_json_labels' and not os.path.isdir(json_folder):  # saving stage was not selected
+        os.makedirs(json_folder)
+        JSONFolder(json_folder).add(_rois(path), 'bench')
+    elif stage == 'load_store_labels' and not os.path.isdir(store_folder):
+        os.makedirs(store_folder)
+        ROIStore(os.path.join(store_folder, STORE_FILENAME)).add(_rois(path), 'bench')
+    rss_before = _peak_rss()
+    start = time.perf_counter()
+    if stage in ('get_rois', 'get_rois_cached'):
+        result['rois'] = len(_rois(path))
+    elif stage in ('cluster_rois', 'cluster_rois_cached'):
+        from utils.roi import cluster_ROIs
+        result['rois'] = len(cluster_ROIs(path, **ROI_PARAMETERS))
+    elif stage == 'parallel_rois_cached':  # m/z bands in processes (their memory isn't in peak RSS)
+        from utils.roi import parallel_ROIs
+        result['rois'] = len(parallel_ROIs(path, **ROI_PARAMETERS))
+    elif stage == 'build_cache':
+        result['cache_bytes'] = _folder_size(build_cache(path))
+    elif stage in ('tic', 'tic_cached'):
+        result['points'] = len(construct_tic(path, 'TIC')['x'])
+    elif stage == 'eic':
+        result['points'] = len(construct_eic(path, 'EIC', 500., 0.01)['x'])
+    elif stage == 'eic_50_targets':
+        targets = np.linspace(150, 950, 50)
+        result['traces'] = len(construct_eic(path, ['EIC'] * 50, targets, 0.01)['y'])
+    elif stage == 'save_json':
+        shutil.rmtree(json_folder, ignore_errors=True)
+        os.makedirs(json_folder)
+        JSONFolder(json_folder).add(rois, 'bench')
+        result['rois'] = len(rois)
+        result['bytes_written'] = _folder_size(json_folder)
+    elif stage == 'save_store':
+        shutil.rmtree(store_folder, ignore_errors=True)
+        os.makedirs(store_folder)
+        store = ROIStore(os.path.join(store_folder, STORE_FILENAME))
+        store.add(rois, 'bench')
+        store.close()
+        result['rois'] = len(rois)
+        result['bytes_written'] = _folder_size(store_folder)
+    elif stage == 'load_json_labels':  # what the annotation window does on opening (index is built once)
+        folder = JSONFolder(json_folder)
+        result['rois'] = len(folder.labels())
+        result['first_open_seconds'] = time.perf_counter() - start
+        folder.close()
+        folder = JSONFolder(json_folder)
+        start = time.perf_counter()
+        folder.labels()
+    elif stage == 'load_store_labels':
+        store = ROIStore(os.path.join(store_folder, STORE_FILENAME))
+        result['rois'] = len(store.labels())
+    else:
+        raise ValueError(f'unknown stage: {stage}')
+    result['seconds'] = time.perf_counter() - start
+    result['peak_rss_mb'] = _peak_rss() / 2 ** 20
+    result['rss_before_mb'] = rss_before / 2 ** 20
+    if 'rois' in result and stage.startswith(('get_rois', 'cluster_rois', 'parallel_rois')):
+        result['rois_per_second'] = result['rois'] / result['seconds']
+    return result
+
+
+def _child(stage, path, work_dir, queue):
+    try:
+        queue.put(('ok', run_stage(stage, path, work_dir)))
+    except Exception as exception:
+        queue.put(('error', repr(exception)))
+
+
+def measure(stage, path, work_dir, repeat=1):
+    """
+    Run the stage in fresh processes and keep the fastest repetition
+    """
+    context = multiprocessing.get_context('spawn')
+    best = None
+    for _ in range(repeat):
+        queue = context.Queue()
+        process = context.Process(target=_child, args=(stage, path, work_dir, queue))
+        process.start()
+        status, result = queue.get()
+        process.join()
+        if status != 'ok':
+            return {'error': result}
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    print(f'\n{"stage":<20}{"before, s":>12}{"after, s":>12}{"ratio":>8}')
+    before = previous['stages']
+    for stage, result in results['stages'].items():
+        if stage in before and 'seconds' in before[stage] and 'seconds' in result:
+            ratio = result['seconds'] / before[stage]['seconds'] if before[stage]['seconds'] else float('nan')
+            print(f'{stage:<20}{before[stage]["seconds"]:>12.3f}{result["seconds"]:>12.3f}{ratio:>8.2f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of LCMS_Marktool hot paths on synthetic data')
+    parser.add_argument('--size', choices=SIZES, default='small')
+    parser.add_argument('--scans', type=int, help='override number of scans of the size preset')
+    parser.add_argument('--density', type=int, help='override centroids per scan of the size preset')
+    parser.add_argument('--compounds', type=int, help='override number of compounds of the size preset')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--repeat', type=int, default=1, help='repetitions of each stage (the fastest is kept)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('--compare', help='json file with previous results')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    args = parser.parse_args(argv)
+
+    from benchmarks.synthetic_mzml import generate
+
+    size = dict(SIZES[args.size])
+    for key in size:
+        if getattr(args, key) is not None:
+            size[key] = getattr(args, key)
+    work_dir = tempfile.mkdtemp(prefix='lcms_marktool_bench_')
+    try:
+        path = os.path.join(work_dir, 'synthetic.mzML')
+        start = time.perf_counter()
+        run = generate(path, seed=args.seed, **size)
+        print(f'generated {run["spectra"]} spectra, {run["points"]} points, {run["bytes"] / 2 ** 20:.1f} MB '
+              f'in {time.perf_counter() - start:.1f} s')
+
+        results = {'meta': {'revision': _git_revision(), 'python': platform.python_version(),
+                            'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'size': args.size,
+                            'roi_parameters': ROI_PARAMETERS},
+                   'run': run, 'stages': {}}
+        print(f'{"stage":<20}{"seconds":>10}{"peak RSS, MB":>14}  details')
+        for stage in STAGES:
+            if stage not in args.stages:
+                continue
+            result = measure(stage, path, work_dir, args.repeat)
+            results['stages'][stage] = result
+            details = ', '.join(f'{key}={value:.4g}' if isinstance(value, float) else f'{key}={value}'
+                                for key, value in result.items()
+                                if key not in ('seconds', 'peak_rss_mb', 'rss_before_mb'))
+            if 'error' in result:
+                print(f'{stage:<20}{"failed":>10}{"":>14}  {details}')
+            else:
+                print(f'{stage:<20}{result["seconds"]:>10.3f}{result["peak_rss_mb"]:>14.1f}  {details}')
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Generator of synthetic centroided LC-MS runs in mzML format (readable by pymzml), e.g.
+
+    python benchmarks/synthetic_mzml.py run.mzML --scans 2000 --density 3000 --compounds 500
+"""
+import re
+import zlib
+import base64
+import argparse
+import numpy as np
+
+
+def _encode(values, dtype):
+    return base64.b64encode(zlib.compress(np.asarray(values, dtype=dtype).tobytes())).decode()
+
+
+def _binary_array(values, dtype, accession, name, unit=''):
+    precision = ('MS:1000523', '64-bit float') if dtype == '<f8' else ('MS:1000521', '32-bit float')
+    encoded = _encode(values, dtype)
+    return (f'<binaryDataArray encodedLength="{len(encoded)}">'
+            f'<cvParam cvRef="MS" accession="{precision[0]}" name="{precision[1]}" value=""/>'
+            '<cvParam cvRef="MS" accession="MS:1000574" name="zlib compression" value=""/>'
+            f'<cvParam cvRef="MS" accession="{accession}" name="{name}" value=""{unit}/>'
+            f'<binary>{encoded}</binary></binaryDataArray>')
+
+
+def generate(path, scans=1000, density=1000, compounds=200, peak_width=0.1, scan_interval=0.01,
+             noise_level=200., intensity=(1e4, 1e7), mz_range=(100., 1000.), mz_ppm=3., ms2_every=0,
+             indexed=True, seed=0):
+    """
+    Write a synthetic run: compounds with gaussian chromatographic peaks plus random noise centroids
+    :param path: path to the mzML file
+    :param scans: number of MS1 scans
+    :param density: mean number of centroids per MS1 scan (compound peaks and noise)
+    :param compounds: number of compounds (chromatographic peaks)
+    :param peak_width: standard deviation of chromatographic peaks (minutes)
+    :param scan_interval: time between MS1 scans (minutes)
+    :param noise_level: mean intensity of noise centroids
+    :param intensity: range of compound apex intensities (log-uniform)
+    :param mz_range: range of m/z values
+    :param mz_ppm: m/z jitter of compound centroids (ppm)
+    :param ms2_every: add an MS2 scan after every n-th MS1 scan (0 - no MS2 scans)
+    :param indexed: write indexedmzML with offsets of spectra and TIC chromatogram
+    :param seed: random seed
+    :return: dict with parameters and sizes of the generated run
+    """
+    rng = np.random.default_rng(seed)
+    compound_mz = rng.uniform(*mz_range, compounds)
+    compound_rt = rng.uniform(0, scans * scan_interval, compounds)
+    compound_height = np.exp(rng.uniform(np.log(intensity[0]), np.log(intensity[1]), compounds))
+
+    header = ('<?xml version="1.0" encoding="utf-8"?>\n'
+              + ('<indexedmzML xmlns="http://psi.hupo.org/ms/mzml">\n' if indexed else '')
+              + '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n'
+              '<cvList count="2"><cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" '
+              'version="4.1.0" URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/>'
+              '<cv id="UO" fullName="Unit Ontology" version="09:04:2014" '
+              'URI="https://raw.githubusercontent.com/bio-ontology-research-group/unit-ontology/master/unit.obo"/>'
+              '</cvList>\n<run id="synthetic">\n')
+    n_spectra = scans + (scans // ms2_every if ms2_every else 0)
+    chunks = [header, f'<spectrumList count="{n_spectra}" defaultDataProcessingRef="dp">\n']
+    offsets = []
+    position = len(''.join(chunks).encode())
+    times, tics = [], []
+    n_points = 0
+    index = 0
+    for scan in range(scans):
+        t = scan * scan_interval
+        profile = compound_height * np.exp(-0.5 * ((t - compound_rt) / peak_width) ** 2)
+        present = profile > noise_level
+        peak_mz = compound_mz[present] * (1 + rng.normal(0, mz_ppm * 1e-6, np.count_nonzero(present)))
+        peak_i = profile[present] * rng.normal(1, 0.05, np.count_nonzero(present))
+        n_noise = max(int(rng.poisson(max(density - len(peak_mz), 0))), 0)
+        noise_mz = rng.uniform(*mz_range, n_noise)
+        noise_i = rng.exponential(noise_level, n_noise)
+        mz = np.concatenate((peak_mz, noise_mz))
+        i = np.abs(np.concatenate((peak_i, noise_i)))
+        order = np.argsort(mz)
+        mz, i = mz[order], i[order]
+        spectra = [(1, mz, i, t)]
+        if ms2_every and scan % ms2_every == ms2_every - 1:
+            spectra.append((2, np.sort(rng.uniform(50, mz_range[1], 50)), rng.exponential(1e3, 50), t + scan_interval / 2))
+        for ms_level, mz, i, t in spectra:
+            tic = float(np.sum(i.astype('<f4')))
+            spectrum = (f'<spectrum index="{index}" id="scan={index + 1}" defaultArrayLength="{len(mz)}">'
+                        f'<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{ms_level}"/>'
+                        '<cvParam cvRef="MS" accession="MS:1000127" name="centroid spectrum" value=""/>'
+                        f'<cvParam cvRef="MS" accession="MS:1000285" name="total ion current" value="{tic}"/>'
+                        '<scanList count="1"><cvParam cvRef="MS" accession="MS:1000795" name="no combination" value=""/>'
+                        '<scan><cvParam cvRef="MS" accession="MS:1000016" name="scan start time" '
+                        f'value="{t}" unitCvRef="UO" unitAccession="UO:0000031" unitName="minute"/></scan></scanList>'
+                        f'<binaryDataArrayList count="2">'
+                        + _binary_array(mz, '<f8', 'MS:1000514', 'm/z array',
+                                        ' unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"')
+                        + _binary_array(i, '<f4', 'MS:1000515', 'intensity array',
+                                        ' unitCvRef="MS" unitAccession="MS:1000131" unitName="number of detector counts"')
+                        + '</binaryDataArrayList></spectrum>\n')
+            offsets.append((f'scan={index + 1}', position))
+            position += len(spectrum.encode())
+            chunks.append(spectrum)
+            times.append(t)
+            tics.append(tic)
+            if ms_level == 1:
+                n_points += len(mz)
+            index += 1
+    chunks.append('</spectrumList>\n')
+    chromatogram_offsets = []
+    if indexed:
+        position += len(chunks[-1].encode())
+        chromatograms = '<chromatogramList count="1" defaultDataProcessingRef="dp">\n'
+        position += len(chromatograms.encode())
+        chromatogram_offsets.append(('TIC', position))
+        chromatograms += (f'<chromatogram index="0" id="TIC" defaultArrayLength="{len(times)}">'
+                          '<cvParam cvRef="MS" accession="MS:1000235" name="total ion current chromatogram" value=""/>'
+                          '<binaryDataArrayList count="2">'
+                          + _binary_array(times, '<f8', 'MS:1000595', 'time array',
+                                          ' unitCvRef="UO" unitAccession="UO:0000031" unitName="minute"')
+                          + _binary_array(tics, '<f8', 'MS:1000515', 'intensity array',
+                                          ' unitCvRef="MS" unitAccession="MS:1000131" unitName="number of detector counts"')
+                          + '</binaryDataArrayList></chromatogram>\n</chromatogramList>\n')
+        chunks.append(chromatograms)
+    chunks.append('</run>\n</mzML>\n')
+    if indexed:
+        index_offset = len(''.join(chunks).encode())
+        chunks.append('<indexList count="2">\n<index name="spectrum">\n'
+                      + ''.join(f'<offset idRef="{idRef}">{offset}</offset>\n' for idRef, offset in offsets)
+                      + '</index>\n<index name="chromatogram">\n'
+                      + ''.join(f'<offset idRef="{idRef}">{offset}</offset>\n' for idRef, offset in chromatogram_offsets)
+                      + f'</index>\n</indexList>\n<indexListOffset>{index_offset}</indexListOffset>\n'
+                      '</indexedmzML>\n')
+    data = ''.join(chunks).encode()
+    assert not indexed or re.match(rb'<spectrum ', data[offsets[-1][1]:offsets[-1][1] + 10])
+    with open(path, 'wb') as file:
+        file.write(data)
+    return {'path': path, 'scans': scans, 'spectra': n_spectra, 'points': n_points, 'density': density,
+            'compounds': compounds, 'bytes': len(data), 'seed': seed}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic mzML run')
+    parser.add_argument('path')
+    parser.add_argument('--scans', type=int, default=1000)
+    parser.add_argument('--density', type=int, default=1000, help='centroids per MS1 scan')
+    parser.add_argument('--compounds', type=int, default=200)
+    parser.add_argument('--peak-width', type=float, default=0.1, help='sigma of chromatographic peaks (min)')
+    parser.add_argument('--noise-level', type=float, default=200.)
+    parser.add_argument('--ms2-every', type=int, default=0)
+    parser.add_argument('--not-indexed', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.path, args.scans, args.density, args.compounds, args.peak_width,
+                   noise_level=args.noise_level, ms2_every=args.ms2_every, indexed=not args.not_indexed,
+                   seed=args.seed))
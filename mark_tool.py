@@ -1,4 +1,5 @@
 import sys
+import multiprocessing
 from utils.plot import PlotWindow, EICParameterWindow
 from utils.show_list import find_mzML, FileListWidget, PeakListWidget, ROIListWidget, ProgressBarsListItem
 from utils.annotation_window import AnnotationParameterWindow, ReAnnotationParameterWindow
@@ -16,6 +17,7 @@ class MainWindow(PlotWindow):
         self._list_of_files.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
         self._list_of_files.connectDoubleClick(self.FileListPlot)  # 双击绘制TIC图
         self._list_of_files.connectRightClick(partial(FileListMenu, self))  # 右键打开菜单
+        self._list_of_files.connectAddFile(self.cache_file)  # 导入时缓存为二进制文件
 
         # self._list_of_peaks.connectRightClick(partial(PeakListMenu, self))
 
@@ -179,6 +181,7 @@ class FileListMenu(QtWidgets.QMenu):
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # ROI generation runs in a process pool (also in PyInstaller build)
     # QtCore.QCoreApplication.setAttribute(QtCore.Qt.HighDpiScaleFactorRoundingPolicy.PassThrough)
     app = QtWidgets.QApplication(sys.argv)
     main_window = MainWindow()
@@ -0,0 +1,125 @@
+"""
+Headless ROI generation (no PyQt5 / matplotlib), e.g. for compute nodes:
+
+    python roi_cli.py data/*.mzML -o rois --prefix Example --jobs 8
+
+ROIs of every file are saved to {output}/{file name}/rois.sqlite with prefix {prefix}_{file name}
+(the same layout as batch generation in mark_tool.py), ready for annotation with "继续标注".
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils import instrumentation
+from utils.roi import ROI_ENGINES
+from utils.roi_store import ROIStore, JSONFolder, STORE_FILENAME
+from utils.mzml_meta import probe_run, describe_run
+
+
+def expand_paths(patterns):
+    """
+    :param patterns: paths to mzml files, globs or folders (searched recursively)
+    :return: sorted list of unique paths
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*.mzML')
+        matched = glob.glob(pattern, recursive=True)
+        if not matched and os.path.isfile(pattern):
+            matched = [pattern]
+        paths.update(os.path.abspath(path) for path in matched)
+    return sorted(paths)
+
+
+def process_file(path, output, prefix, delta_mz, required_points, dropped_points, intensity_threshold,
+                 output_format='store', engine='scan', jobs=None):
+    """
+    Generate ROIs of one file and save them for annotation
+    :param engine: name of ROI detection algorithm (see ROI_ENGINES)
+    :param jobs: number of processes of the parallel engine (number of CPUs by default)
+    :return: (path, folder, number of ROIs, seconds, instrumentation report or None)
+    """
+    start = time.perf_counter()
+    filename = os.path.basename(path)
+    name = filename[:filename.rfind('.')]
+    folder = os.path.join(output, name)
+    os.makedirs(folder, exist_ok=True)
+
+    description = describe_run(*probe_run(path)) + ', intensity_thr = ' + str(intensity_threshold)
+    options = {'jobs': jobs} if engine == 'parallel' else {}
+    with instrumentation.timer('cli.get_rois'):
+        rois = instrumentation.profiled(ROI_ENGINES[engine], path, delta_mz, required_points, intensity_threshold,
+                                        dropped_points, **options)
+    with instrumentation.timer('cli.save'):
+        store = ROIStore(os.path.join(folder, STORE_FILENAME)) if output_format == 'store' else JSONFolder(folder)
+        store.add(rois, f'{prefix}_{name}', 'unmarked', drop_points=dropped_points, description=description)
+        store.close()
+    report = None
+    if instrumentation.enabled():  # collected in the job process, merged in the main one
+        report = instrumentation.report()
+        instrumentation.reset()
+    return path, folder, len(rois), time.perf_counter() - start, report
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Generate ROIs from mzML files without GUI')
+    parser.add_argument('paths', nargs='+', help='mzML files, globs (e.g. "data/*.mzML") or folders')
+    parser.add_argument('-o', '--output', required=True, help='folder to save ROIs (a subfolder per file)')
+    parser.add_argument('--prefix', default='Example', help='prefix of ROI names')
+    parser.add_argument('--delta-mz', type=float, default=0.005, help='m/z deviation')
+    parser.add_argument('--required-points', type=int, default=15, help='minimum length of ROI (scans)')
+    parser.add_argument('--dropped-points', type=int, default=3, help='number of zero points which end ROI')
+    parser.add_argument('--intensity-threshold', type=int, default=1000, help='minimum intensity of ROI')
+    parser.add_argument('--format', choices=['store', 'json'], default='store', dest='output_format',
+                        help='one rois.sqlite per file (default) or a json file per ROI')
+    parser.add_argument('--engine', choices=sorted(ROI_ENGINES), default='scan',
+                        help='ROI detection: scan by scan (default), clustering of the whole run '
+                             '(faster, the run should fit in memory) or scan by scan in m/z bands in parallel '
+                             '(the same ROIs as scan by scan)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='number of processes')
+    parser.add_argument('--profile', nargs='?', const='-', metavar='REPORT',
+                        help='collect timers and counters of hot paths, print the report (or write it to json file)')
+    parser.add_argument('--profile-mode', choices=['cprofile', 'tracemalloc'],
+                        help='also run ROI generation of every file under cProfile or tracemalloc')
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error('--jobs should be at least 1')
+    paths = expand_paths(args.paths)
+    if not paths:
+        print('no mzML files found', file=sys.stderr)
+        return 1
+
+    if args.profile or args.profile_mode:
+        instrumentation.enable(None if args.profile in (None, '-') else args.profile, args.profile_mode)
+
+    failed = 0
+    file_jobs = min(args.jobs, len(paths))
+    parameters = (args.output, args.prefix, args.delta_mz, args.required_points, args.dropped_points,
+                  args.intensity_threshold, args.output_format, args.engine, max(1, args.jobs // file_jobs))
+    with ProcessPoolExecutor(file_jobs) as executor:
+        futures = {executor.submit(process_file, path, *parameters): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                path, folder, n_rois, seconds, report = future.result()
+                if report is not None:
+                    instrumentation.merge(report)
+                print(f'{path}: {n_rois} ROIs -> {folder} ({seconds:.1f} s)')
+            except Exception as exception:
+                failed += 1
+                print(f'{futures[future]}: failed: {exception!r}', file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import os
+import sys
+import zlib
+import base64
+import tempfile
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# the scan cache of test runs is kept apart from the cache of the user (read by utils.scan_cache on import)
+os.environ['LCMS_MARKTOOL_CACHE'] = tempfile.mkdtemp(prefix='lcms_marktool_cache_')
+
+
+@pytest.fixture(scope='session')
+def synthetic_run(tmp_path_factory):
+    """
+    Path to a small synthetic mzML run
+    """
+    from benchmarks.synthetic_mzml import generate
+    path = str(tmp_path_factory.mktemp('runs') / 'synthetic.mzML')
+    generate(path, scans=150, density=400, compounds=60, peak_width=0.1, scan_interval=0.01, seed=1)
+    return path
+
+
+def _binary_array(values, dtype, accession, name, unit=''):
+    encoded = base64.b64encode(zlib.compress(np.asarray(values, dtype=dtype).tobytes())).decode()
+    precision = ('MS:1000523', '64-bit float') if dtype == '<f8' else ('MS:1000521', '32-bit float')
+    return (f'<binaryDataArray encodedLength="{len(encoded)}">'
+            f'<cvParam cvRef="MS" accession="{precision[0]}" name="{precision[1]}" value=""/>'
+            '<cvParam cvRef="MS" accession="MS:1000574" name="zlib compression" value=""/>'
+            f'<cvParam cvRef="MS" accession="{accession}" name="{name}" value=""{unit}/>'
+            f'<binary>{encoded}</binary></binaryDataArray>')
+
+
+def write_mzml(path, scans, file_content=None, indexed=False):
+    """
+    Write scans to an mzML file
+    :param scans: list of (m/z array, intensity array, scan time in minutes[, ms level])
+    :param file_content: accessions of spectrum types declared in fileContent (not written by default)
+    :param indexed: write indexedmzML with offsets of spectra and TIC chromatogram (of all spectra)
+    """
+    header = ('<?xml version="1.0" encoding="utf-8"?>\n'
+              + ('<indexedmzML xmlns="http://psi.hupo.org/ms/mzml">\n' if indexed else '')
+              + '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n'
+              '<cvList count="2"><cv id="MS" fullName="PSI-MS" version="4.1.0" URI="x"/>'
+              '<cv id="UO" fullName="Unit Ontology" version="1" URI="x"/></cvList>\n')
+    if file_content is not None:
+        header += ('<fileDescription><fileContent>'
+                   + ''.join(f'<cvParam cvRef="MS" accession="{accession}" name="" value=""/>'
+                             for accession in file_content)
+                   + '</fileContent></fileDescription>\n')
+    chunks = [header + f'<run id="test">\n<spectrumList count="{len(scans)}" defaultDataProcessingRef="dp">\n']
+    offsets = []
+    times, tics = [], []
+    for n, (mz, i, time, *ms_level) in enumerate(scans):
+        ms_level = ms_level[0] if ms_level else 1
+        offsets.append((f'scan={n + 1}', len(''.join(chunks).encode())))
+        times.append(time)
+        tics.append(np.sum(i))
+        chunks.append(f'<spectrum index="{n}" id="scan={n + 1}" defaultArrayLength="{len(mz)}">'
+                      f'<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{ms_level}"/>'
+                      f'<cvParam cvRef="MS" accession="MS:1000285" name="total ion current" value="{np.sum(i)}"/>'
+                      '<scanList count="1"><scan><cvParam cvRef="MS" accession="MS:1000016" name="scan start time" '
+                      f'value="{time}" unitCvRef="UO" unitAccession="UO:0000031" unitName="minute"/></scan>'
+                      '</scanList><binaryDataArrayList count="2">'
+                      + _binary_array(mz, '<f8', 'MS:1000514', 'm/z array')
+                      + _binary_array(i, '<f8', 'MS:1000515', 'intensity array')
+                      + '</binaryDataArrayList></spectrum>\n')
+    chunks.append('</spectrumList>\n')
+    if indexed:
+        chunks.append('<chromatogramList count="1" defaultDataProcessingRef="dp">\n')
+        chromatogram_offset = len(''.join(chunks).encode())
+        chunks.append(f'<chromatogram index="0" id="TIC" defaultArrayLength="{len(times)}">'
+                      '<cvParam cvRef="MS" accession="MS:1000235" name="total ion current chromatogram" value=""/>'
+                      '<binaryDataArrayList count="2">'
+                      + _binary_array(times, '<f8', 'MS:1000595', 'time array',
+                                      ' unitCvRef="UO" unitAccession="UO:0000031" unitName="minute"')
+                      + _binary_array(tics, '<f8', 'MS:1000515', 'intensity array')
+                      + '</binaryDataArrayList></chromatogram>\n</chromatogramList>\n')
+    chunks.append('</run>\n</mzML>\n')
+    if indexed:
+        index_offset = len(''.join(chunks).encode())
+        chunks.append('<indexList count="2">\n<index name="spectrum">\n'
+                      + ''.join(f'<offset idRef="{idRef}">{offset}</offset>\n' for idRef, offset in offsets)
+                      + '</index>\n<index name="chromatogram">\n'
+                      + f'<offset idRef="TIC">{chromatogram_offset}</offset>\n'
+                      + f'</index>\n</indexList>\n<indexListOffset>{index_offset}</indexListOffset>\n'
+                      '</indexedmzML>\n')
+    with open(path, 'w') as file:
+        file.write(''.join(chunks))
+    return path
+
+
+@pytest.fixture
+def make_mzml(tmp_path):
+    """
+    Function which writes scans to an mzML file in a temporary folder (see write_mzml) and returns its path
+    """
+    return lambda name, scans, **kwargs: write_mzml(str(tmp_path / name), scans, **kwargs)
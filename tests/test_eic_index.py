@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from utils import roi
+from utils.eic_index import build_eic_index, eic_from_index, open_eic_index
+from utils.roi import _extract_intensities, construct_eic
+from utils.scan_cache import read_ms1
+
+
+def scan_by_scan(path, mz, delta):
+    return np.array([_extract_intensities(scan_mz, scan_i, np.array([mz]), np.array([delta]))[0]
+                     for scan_mz, scan_i, _ in read_ms1(path)])
+
+
+def check_targets(path, targets):
+    build_eic_index(path)
+    cached, index = open_eic_index(path)
+    for mz, delta in targets:
+        assert np.array_equal(index.intensities(mz, delta, len(cached)), scan_by_scan(path, mz, delta)), (mz, delta)
+
+
+def test_ties_and_windows(make_mzml):
+    scans = [
+        (np.array([100., 100.5, 101.]), np.array([10., 20., 30.]), 0.),
+        (np.array([100., 100.5]), np.array([40., 0.]), 0.01),  # zero intensity is the closest peak too
+        (np.array([]), np.array([]), 0.02),  # scan without peaks
+        (np.array([100.25]), np.array([50.]), 0.03),
+        (np.array([99.75, 100.75]), np.array([60., 70.]), 0.04),
+    ]
+    path = make_mzml('ties.mzML', scans)
+    check_targets(path, [
+        (100.25, 0.3),  # equal distances: the left peak wins
+        (100.25, 0.25),  # the closest peak is not closer than delta
+        (100.5, 0.001), (100.5, 1e-9),
+        (100.75, 0.5), (100.75, 0.26),
+        (99., 1.), (50., 1.), (200., 1.), (101.2, 0.5),  # the window is out of the range of the index
+        (100.4, 1e-6),  # empty window
+    ])
+
+
+def test_random_targets(make_mzml):
+    rng = np.random.default_rng(0)
+    scans = []
+    for n in range(40):
+        mz = np.sort(np.round(rng.uniform(100, 102, rng.integers(0, 60)), 3))
+        scans.append((mz, rng.exponential(1000, len(mz)), 0.01 * n))
+    path = make_mzml('random.mzML', scans)
+    targets = [(mz, delta) for mz, delta in zip(np.round(rng.uniform(99.9, 102.1, 300), 4),
+                                                rng.choice([0.0005, 0.001, 0.005, 0.05], 300))]
+    targets += [(float(mz), 0.01) for mz in scans[5][0][:20]]  # targets on peaks
+    check_targets(path, targets)
+
+
+@pytest.mark.parametrize('unit, scale', [('minute', 1), ('second', 60)])
+def test_construct_eic_from_index(make_mzml, monkeypatch, unit, scale):
+    scans = [(np.array([100., 101.]), np.array([10. * n, 20.]), 0.01 * n) for n in range(5)]
+    path = make_mzml('eic.mzML', scans)
+    expected = construct_eic(path, 'eic', 100., 0.01)  # read scan by scan
+    build_eic_index(path)
+
+    def indexed(*args):  # the same run with retention time in another unit
+        time, eic, _ = eic_from_index(*args)
+        return time * scale, eic, unit
+
+    monkeypatch.setattr(roi, 'eic_from_index', indexed)
+    result = construct_eic(path, 'eic', 100., 0.01)
+    assert isinstance(result['x'], list)
+    assert result['x'] == pytest.approx(list(expected['x']))
+    assert np.array_equal(result['y'], expected['y'])
@@ -0,0 +1,58 @@
+import os
+import json
+
+import pytest
+
+from utils import instrumentation
+
+
+def isolated_state(monkeypatch):
+    state = instrumentation._State()
+    state.timers, state.counters, state.stats, state.profiles, state.process_dumps = {}, {}, {}, [], set()
+    monkeypatch.setattr(instrumentation, '_state', state)
+    monkeypatch.setattr(instrumentation.atexit, 'register', lambda function: None)
+    return state
+
+
+def test_dump_process_keeps_previous_jobs(tmp_path, monkeypatch):
+    isolated_state(monkeypatch)
+    monkeypatch.setenv(instrumentation.ENV_INSTRUMENT, '0')
+    instrumentation.enable(str(tmp_path / 'report.json'))
+    for value in range(3):  # jobs of one pool process
+        instrumentation.count('jobs')
+        instrumentation.observe('value', value)
+        with instrumentation.timer('job'):
+            pass
+        instrumentation.dump_process()
+    with open(tmp_path / f'report.{os.getpid()}.json') as file:
+        report = json.load(file)
+    assert report['counters'] == {'jobs': 3}
+    assert report['stats']['value'] == {'count': 3, 'mean': 1., 'min': 0, 'max': 2}
+    assert report['timers']['job']['count'] == 3
+
+
+@pytest.mark.parametrize('instrument, profile, expected', [
+    ('', 'cprofile', (True, None, 'cprofile')),
+    ('1', '', (True, None, None)),
+    ('report.json', 'tracemalloc', (True, 'report.json', 'tracemalloc')),
+    ('0', 'cprofile', (False, None, None)),
+    ('', '', (False, None, None)),
+])
+def test_init_from_environment(monkeypatch, instrument, profile, expected):
+    state = isolated_state(monkeypatch)
+    monkeypatch.setenv(instrumentation.ENV_INSTRUMENT, instrument)  # restored after enable changes it
+    monkeypatch.setenv(instrumentation.ENV_PROFILE, profile)
+    instrumentation._init_from_environment()
+    assert (state.enabled, state.output, state.profile) == expected
+
+
+def test_profiles_of_repeated_calls_are_kept(tmp_path, monkeypatch):
+    isolated_state(monkeypatch)
+    monkeypatch.setenv(instrumentation.ENV_INSTRUMENT, '0')
+    monkeypatch.setenv(instrumentation.ENV_PROFILE, '')
+    instrumentation.enable(str(tmp_path / 'report.json'), 'cprofile')
+    for value in range(2):  # two jobs of one process
+        assert instrumentation.profiled(sum, [value, 1]) == value + 1
+    paths = [profile['path'] for profile in instrumentation.report()['profiles']]
+    assert len(set(paths)) == 2
+    assert all(os.path.isfile(path) for path in paths)
@@ -0,0 +1,115 @@
+import numpy as np
+import pymzml
+import pytest
+
+from utils import mzml_meta
+from utils.mzml_meta import MS1_SPECTRUM, MSN_SPECTRUM, probe_run, tic_from_chromatogram, tic_from_headers
+from utils.roi import construct_tic
+from utils.scan_cache import build_cache
+
+RUNS = [(indexed, ms2) for indexed in (True, False) for ms2 in (False, True)]
+RUN_IDS = [f'{"indexed" if indexed else "not-indexed"}-{"ms1-ms2" if ms2 else "ms1"}' for indexed, ms2 in RUNS]
+
+
+def scans(ms2, n=12):
+    """
+    MS1 scans with an MS2 scan after every third one (the last spectrum of the run is MS2)
+    """
+    rng = np.random.default_rng(n)
+    result = []
+    for number in range(n):
+        mz = np.sort(rng.uniform(100, 1000, 20))
+        result.append((mz, rng.uniform(1e3, 1e5, 20), 0.01 * number))
+        if ms2 and number % 3 == 2:
+            result.append((np.sort(rng.uniform(50, 500, 5)), rng.uniform(1e2, 1e3, 5), 0.01 * number + 0.005, 2))
+    return result
+
+
+def write_run(make_mzml, indexed, ms2):
+    content = [MS1_SPECTRUM, MSN_SPECTRUM] if ms2 else [MS1_SPECTRUM]
+    return make_mzml('run.mzML', scans(ms2), file_content=content, indexed=indexed)
+
+
+def read_all(path):
+    """
+    Baseline: TIC of MS1 spectra and the last spectrum read by pymzml
+    :return: (time, tic), (spectrum count, scan time, time unit)
+    """
+    time, tic = [], []
+    run = pymzml.run.Reader(path)
+    spectrum_count = run.get_spectrum_count()
+    for spectrum in run:
+        if spectrum.ms_level == 1:
+            time.append(spectrum.scan_time[0])
+            tic.append(spectrum.TIC)
+        last = spectrum.scan_time
+    return (time, tic), (spectrum_count, *last)
+
+
+@pytest.mark.parametrize('indexed, ms2', RUNS, ids=RUN_IDS)
+def test_tic_from_headers(make_mzml, indexed, ms2):
+    path = write_run(make_mzml, indexed, ms2)
+    (time, tic), _ = read_all(path)
+    result = tic_from_headers(path)
+    assert result[0] == pytest.approx(time)
+    assert result[1] == pytest.approx(tic)
+    assert result[2] == 'minute'
+
+
+@pytest.mark.parametrize('indexed', [True, False], ids=['indexed', 'not-indexed'])
+@pytest.mark.parametrize('ms2, content, used', [
+    (False, [MS1_SPECTRUM], True),
+    (False, None, False),  # there is no fileContent
+    (False, [MS1_SPECTRUM, MSN_SPECTRUM], False),
+    (True, [MS1_SPECTRUM, MSN_SPECTRUM], False),  # the chromatogram includes MS2 spectra
+], ids=['ms1-only', 'no-file-content', 'ms1-msn-declared', 'ms1-ms2'])
+def test_tic_from_chromatogram_of_ms1_only_runs(make_mzml, indexed, ms2, content, used):
+    path = make_mzml('run.mzML', scans(ms2), file_content=content, indexed=indexed)
+    result = tic_from_chromatogram(path)
+    if not (used and indexed):
+        assert result is None
+        return
+    (time, tic), _ = read_all(path)
+    assert result[0] == pytest.approx(time)
+    assert result[1] == pytest.approx(tic)
+    assert result[2] == 'minute'
+
+
+@pytest.mark.parametrize('indexed, ms2', RUNS, ids=RUN_IDS)
+def test_construct_tic_matches_full_read(make_mzml, indexed, ms2):
+    path = write_run(make_mzml, indexed, ms2)
+    (time, tic), _ = read_all(path)
+    result = construct_tic(path, 'run')
+    assert result['x'] == pytest.approx(time)
+    assert result['y'] == pytest.approx(tic)
+
+
+def fail(*args, **kwargs):
+    raise AssertionError('the previous source should be used')
+
+
+@pytest.mark.parametrize('indexed, ms2', RUNS, ids=RUN_IDS)
+@pytest.mark.parametrize('source', ['cache', 'index', 'tail', 'full'])
+def test_probe_run_sources(make_mzml, monkeypatch, indexed, ms2, source):
+    if source == 'index' and not indexed:
+        pytest.skip('there is no index')
+    path = write_run(make_mzml, indexed, ms2)
+    _, expected = read_all(path)
+    if source == 'cache':
+        build_cache(path)
+    # the sources after the expected one are not used, the sources before it give nothing
+    if source in ('tail', 'full'):
+        monkeypatch.setattr(mzml_meta, 'read_index', lambda path: None)
+    if source == 'full':
+        monkeypatch.setattr(mzml_meta, '_probe_tail', lambda path: None)
+    if source in ('cache', 'index', 'tail'):
+        monkeypatch.setattr(mzml_meta.pymzml.run, 'Reader', fail)
+    if source in ('cache', 'index'):
+        monkeypatch.setattr(mzml_meta, '_probe_tail', fail)
+    if source == 'cache':
+        monkeypatch.setattr(mzml_meta, 'read_index', fail)
+
+    count, t, measure = probe_run(path)
+    assert (count, measure) == (expected[0], expected[2])
+    assert t == pytest.approx(expected[1])
+    assert probe_run(path) == (count, t, measure)  # the second call is answered from memory
@@ -0,0 +1,219 @@
+import bisect
+
+import numpy as np
+import pytest
+
+from utils import roi
+from utils.roi import ROIBuilder, get_ROIs, cluster_ROIs, parallel_ROIs, mz_bands
+from utils.scan_cache import build_cache
+
+
+class _ReferenceROI:
+    def __init__(self, number, time, i, mz):
+        self.scan = [number, number]
+        self.rt = [time, time]
+        self.i = [i]
+        self.mz = [mz]
+        self.mzmean = mz
+        self.points = 1
+
+
+def reference_ROIs(scans, delta_mz, required_points, intensity_threshold, dropped_points):
+    """
+    Peak-by-peak ROI detection of the first version of get_ROIs (a sorted list of keys instead of AVL tree)
+    :param scans: list of (m/z array, intensity array, scan time), m/z values are sorted
+    :return: list of (scan, rt, i, mz, mzmean) of ROIs
+    """
+    keys, active = [], {}  # active ROIs by m/z of the first peak
+
+    def start(number, time, mz, i):
+        if mz not in active:
+            bisect.insort(keys, mz)
+        active[mz] = _ReferenceROI(number, time, i, mz)
+
+    completed = []
+    first_mz, first_i, start_time = scans[0]
+    min_mz, max_mz = max(first_mz), min(first_mz)
+    for mz, i in zip(first_mz, first_i):
+        if i != 0:
+            start(1, start_time, mz, i)
+            min_mz, max_mz = min(min_mz, mz), max(max_mz, mz)
+
+    number = 2
+    for scan_mz, scan_i, time in scans[1:]:
+        for mz, i in zip(scan_mz, scan_i):
+            if i == 0:
+                continue
+            ceiling = floor = None
+            if mz < max_mz:  # bounds of the keys are updated after the scan only
+                ceiling = active[keys[bisect.bisect_left(keys, mz)]]
+            if mz > min_mz:
+                floor = active[keys[bisect.bisect_right(keys, mz) - 1]]
+            if ceiling is None and floor is None:
+                start(number, time, mz, i)
+                continue
+            if ceiling is None or (floor is not None and ceiling.mzmean - mz > mz - floor.mzmean):
+                closest = floor
+            else:
+                closest = ceiling
+            if abs(closest.mzmean - mz) < delta_mz:
+                roi = closest
+                roi.mzmean = (roi.mzmean * roi.points + mz) / (roi.points + 1)
+                roi.points += 1
+                if roi.scan[1] == number:  # two peaks in one m/z window
+                    roi.mz[-1] = (roi.i[-1] * roi.mz[-1] + i * mz) / (roi.i[-1] + i)
+                    roi.i[-1] = roi.i[-1] + i
+                else:
+                    roi.mz.append(mz)
+                    roi.i.append(i)
+                    roi.scan[1] = number
+                    roi.rt[1] = time
+            else:
+                start(number, time, mz, i)
+
+        for key in list(keys):
+            roi = active[key]
+            if roi.scan[1] < number <= roi.scan[1] + dropped_points:
+                roi.mz.append(roi.mzmean)
+                roi.i.append(0)
+            elif roi.scan[1] != number:
+                keys.remove(key)
+                del active[key]
+                if roi.points >= required_points and max(roi.i) > intensity_threshold:
+                    completed.append(roi)
+        min_mz, max_mz = (keys[0], keys[-1]) if keys else (float('inf'), 0)
+        number += 1
+
+    for key in keys:
+        roi = active[key]
+        if roi.points >= required_points:
+            for _ in range(dropped_points - (number - 1 - roi.scan[1])):
+                roi.mz.append(roi.mzmean)
+                roi.i.append(0)
+            completed.append(roi)
+    return [((roi.scan[0] - dropped_points, roi.scan[1] + dropped_points), roi.rt,
+             [0] * dropped_points + roi.i, [roi.mzmean] * dropped_points + roi.mz, roi.mzmean)
+            for roi in completed]
+
+
+def random_scans(seed, n_scans=60, n_traces=25):
+    """
+    Scans with close traces (several peaks of one scan within delta_mz), gaps in traces,
+    zero intensities, repeated m/z values and noise
+    """
+    rng = np.random.default_rng(seed)
+    centers = np.sort(rng.uniform(100, 101, n_traces))
+    scans = []
+    for number in range(n_scans):
+        present = rng.random(n_traces) < 0.7  # gaps in traces
+        mz = centers[present] + rng.normal(0, 0.002, np.count_nonzero(present))
+        mz = np.concatenate((mz, rng.uniform(100, 101, rng.integers(0, 10))))
+        if len(mz) and rng.random() < 0.3:
+            mz = np.append(mz, mz[:2])  # repeated m/z values
+        mz = np.round(np.sort(mz), 4)  # rounding gives equal m/z values and keys
+        i = rng.exponential(3000, len(mz))
+        i[rng.random(len(mz)) < 0.05] = 0
+        if number == 0:
+            i[0] = 1000.  # the first scan has peaks
+        scans.append((mz, i, 0.01 * number))
+    return scans
+
+
+def assert_same(rois, expected):
+    assert len(rois) == len(expected)
+    for roi, (scan, rt, i, mz, mzmean) in zip(rois, expected):
+        assert tuple(roi.scan) == tuple(scan)
+        assert list(roi.rt) == list(rt)
+        assert np.array_equal(roi.i, i)
+        assert np.array_equal(roi.mz, mz)
+        assert roi.mzmean == mzmean
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('delta_mz, required_points, intensity_threshold, dropped_points',
+                         [(0.005, 3, 1000, 0), (0.005, 1, 0, 1), (0.01, 5, 2000, 3), (0.002, 2, 500, 2)])
+def test_builder_matches_reference(seed, delta_mz, required_points, intensity_threshold, dropped_points):
+    scans = random_scans(seed)
+    builder = ROIBuilder(delta_mz, required_points, intensity_threshold, dropped_points)
+    for mz, i, time in scans:
+        builder.add_scan(mz, i, time)
+    assert_same(builder.get_ROIs(),
+                reference_ROIs(scans, delta_mz, required_points, intensity_threshold, dropped_points))
+
+
+@pytest.mark.parametrize('dropped_points', [1, 3])
+def test_builder_flushes_completed_rois(monkeypatch, dropped_points):
+    monkeypatch.setattr(ROIBuilder, 'flush_points', 10)  # construct ROIs while scans are added
+    scans = random_scans(0, n_scans=120)
+    builder = ROIBuilder(0.005, 2, 0, dropped_points)
+    for mz, i, time in scans:
+        builder.add_scan(mz, i, time)
+    assert_same(builder.get_ROIs(), reference_ROIs(scans, 0.005, 2, 0, dropped_points))
+
+
+def test_get_ROIs_matches_reference(synthetic_run):
+    import pymzml
+    scans = [(np.asarray(scan.mz, dtype=np.float64), np.asarray(scan.i, dtype=np.float64), scan.scan_time[0])
+             for scan in pymzml.run.Reader(synthetic_run) if scan.ms_level == 1]
+    assert_same(get_ROIs(synthetic_run, 0.005, 5, 1000, 2), reference_ROIs(scans, 0.005, 5, 1000, 2))
+
+
+def assert_same_rois(rois, expected):
+    assert_same(rois, [(roi.scan, roi.rt, roi.i, roi.mz, roi.mzmean) for roi in expected])
+
+
+def banded_scans(seed):
+    """
+    random_scans in several m/z ranges far from each other (the run can be split into bands)
+    """
+    parts = [random_scans(seed + n) for n in range(3)]
+    return [(np.concatenate([part[number][0] + 5 * n for n, part in enumerate(parts)]),
+             np.concatenate([part[number][1] for part in parts]), 0.01 * number) for number in range(len(parts[0]))]
+
+
+@pytest.mark.parametrize('engine', [get_ROIs, cluster_ROIs])
+def test_candidates_match_engine(synthetic_run, engine):
+    candidates = engine(synthetic_run, 0.005, dropped_points=2, candidates=True)
+    for required_points, intensity_threshold in [(1, 0), (5, 1000), (15, 5000), (40, 20000)]:
+        rois = engine(synthetic_run, 0.005, required_points, intensity_threshold, 2)
+        assert candidates.count(required_points, intensity_threshold) == len(rois)
+        assert_same_rois(candidates.rois(required_points, intensity_threshold), rois)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_candidates_match_get_ROIs_random(make_mzml, seed):
+    path = make_mzml(f'candidates{seed}.mzML', random_scans(seed))
+    candidates = get_ROIs(path, 0.005, dropped_points=1, candidates=True)
+    for required_points, intensity_threshold in [(1, 0), (3, 1000), (5, 3000)]:
+        assert_same_rois(candidates.rois(required_points, intensity_threshold),
+                         get_ROIs(path, 0.005, required_points, intensity_threshold, 1))
+
+
+def test_parallel_ROIs_match_get_ROIs(synthetic_run):
+    build_cache(synthetic_run)
+    assert len(mz_bands(synthetic_run, 0.005, 3)) == 3
+    for required_points, intensity_threshold, dropped_points in [(5, 1000, 2), (1, 0, 0)]:
+        expected = get_ROIs(synthetic_run, 0.005, required_points, intensity_threshold, dropped_points)
+        assert_same_rois(parallel_ROIs(synthetic_run, 0.005, required_points, intensity_threshold, dropped_points,
+                                       jobs=3), expected)
+    assert_same_rois(parallel_ROIs(synthetic_run, 0.005, dropped_points=2, candidates=True, jobs=3).rois(5, 1000),
+                     get_ROIs(synthetic_run, 0.005, 5, 1000, 2))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_parallel_ROIs_match_get_ROIs_random(make_mzml, seed):
+    path = make_mzml(f'bands{seed}.mzML', banded_scans(seed))
+    build_cache(path)
+    assert len(mz_bands(path, 0.005, 3)) == 3
+    for required_points, intensity_threshold, dropped_points in [(3, 1000, 0), (1, 0, 1), (2, 500, 3)]:
+        assert_same_rois(parallel_ROIs(path, 0.005, required_points, intensity_threshold, dropped_points, jobs=3),
+                         get_ROIs(path, 0.005, required_points, intensity_threshold, dropped_points))
+
+
+def test_mz_bands_of_wide_range(make_mzml, monkeypatch):
+    monkeypatch.setattr(roi, 'MAX_BAND_BINS', 1000)  # bins are wider than delta_mz
+    path = make_mzml('wide.mzML', banded_scans(0))
+    build_cache(path)
+    bands = mz_bands(path, 0.005, 3)
+    assert len(bands) == 3
+    assert_same_rois(parallel_ROIs(path, 0.005, 2, 500, 1, jobs=3), get_ROIs(path, 0.005, 2, 500, 1))
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from benchmarks.synthetic_mzml import generate
+from roi_cli import main
+from utils.roi_store import STORE_FILENAME, open_rois
+
+
+@pytest.mark.parametrize('output_format', ['store', 'json'])
+def test_main_saves_rois_per_file(tmp_path, capsys, output_format):
+    for name in ('first', 'second'):
+        generate(str(tmp_path / f'{name}.mzML'), scans=60, density=50, compounds=10, seed=len(name))
+    output = str(tmp_path / 'rois')
+    assert main([str(tmp_path), '-o', output, '--prefix', 'Test', '--required-points', '5',
+                 '--format', output_format, '--jobs', '2']) == 0
+    assert sorted(os.listdir(output)) == ['first', 'second']
+    for name in ('first', 'second'):
+        folder = os.path.join(output, name)
+        assert os.path.isfile(os.path.join(folder, STORE_FILENAME)) == (output_format == 'store')
+        store = open_rois(folder)
+        try:
+            codes = [store.code(roi_name) for roi_name in store.names()]
+            assert codes and all(code.startswith(f'Test_{name}_') for code in codes)
+            assert store.load(store.names()[0])['description'].startswith('total time = ')
+        finally:
+            store.close()
+    assert 'failed' not in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('jobs', ['0', '-1'])
+def test_main_rejects_jobs_below_one(tmp_path, capsys, jobs):
+    with pytest.raises(SystemExit):
+        main([str(tmp_path), '-o', str(tmp_path / 'rois'), '--jobs', jobs])
+    assert '--jobs' in capsys.readouterr().err
@@ -0,0 +1,251 @@
+import os
+import json
+import sqlite3
+import threading
+
+import numpy as np
+import pytest
+
+from utils import roi_store
+from utils.roi import ROI
+from utils.roi_store import ROIStore, JSONFolder, WriteBehind, STORE_FILENAME
+
+
+def make_rois(n=3, length=6):
+    rng = np.random.default_rng(n)
+    return [ROI([10 * k + 1, 10 * k + length], [0.1 * k, 0.1 * k + 0.05], rng.exponential(1000, length),
+                100 + k + rng.normal(0, 0.001, length), 100. + k) for k in range(n)]
+
+
+@pytest.fixture(params=['store', 'json'])
+def folder(request, tmp_path):
+    """
+    Folder with three unmarked ROIs in a store file or in json files
+    """
+    store = ROIStore(str(tmp_path / STORE_FILENAME)) if request.param == 'store' else JSONFolder(str(tmp_path))
+    store.add(make_rois(), 'run', 'unmarked', description='total time = 1min')
+    store.close()
+    return str(tmp_path)
+
+
+def saved_labels(folder):
+    store = roi_store.open_rois(folder)  # a new connection: only what is on disk
+    try:
+        return {name: store.load(name)['label'] for name in store.names()}
+    finally:
+        store.close()
+
+
+def backend(folder):
+    return ROIStore if os.path.isfile(os.path.join(folder, STORE_FILENAME)) else JSONFolder
+
+
+def names(folder):
+    store = roi_store.open_rois(folder)
+    try:
+        return store.names()
+    finally:
+        store.close()
+
+
+def record_batches(monkeypatch, store_class, delay=0.):
+    batches = []
+    save_many = store_class.save_many
+
+    def recorded(self, records):
+        records = list(records)
+        threading.Event().wait(delay)
+        save_many(self, records)
+        batches.append([record[0] for record in records])
+    monkeypatch.setattr(store_class, 'save_many', recorded)
+    return batches
+
+
+def test_saves_are_written_in_one_batch(folder, monkeypatch):
+    batches = record_batches(monkeypatch, backend(folder), delay=0.2)
+    rois = dict(zip(names(folder), make_rois()))
+    writer = WriteBehind(folder, delay=0.5)
+    for label, (name, roi) in zip([0, 1, 0], rois.items()):
+        writer.save(name, roi, label)
+    writer.save(list(rois)[1], rois[list(rois)[1]], 0)  # only the latest annotation is written
+    assert writer.flush(timeout=10) == 0
+    assert [sorted(batch) for batch in batches] == [sorted(rois)]
+    assert saved_labels(folder) == dict(zip(rois, [0, 0, 0]))  # on disk when flush returns
+    assert writer.status() == (0, 0)
+    assert writer.close(timeout=10) == 0
+
+
+def test_flush_timeout(folder, monkeypatch):
+    record_batches(monkeypatch, backend(folder), delay=1.)
+    name = names(folder)[0]
+    writer = WriteBehind(folder, delay=0.)
+    writer.save(name, make_rois()[0], 1)
+    assert writer.flush(timeout=0.05) == 1  # still being written
+    assert writer.annotation(name) == (1, [])
+    assert writer.flush(timeout=10) == 0
+    assert saved_labels(folder)[name] == 1
+    writer.close(timeout=10)
+
+
+def test_failed_save_is_retried(folder, monkeypatch):
+    store_class = backend(folder)
+    save_many = store_class.save_many
+    failures = [OSError('disconnected')]
+
+    def failing(self, records):
+        if failures:
+            raise failures.pop()
+        save_many(self, records)
+    monkeypatch.setattr(store_class, 'save_many', failing)
+    name = names(folder)[1]
+    writer = WriteBehind(folder, delay=0.)
+    writer.save(name, make_rois()[1], 1, 1, [3])
+    assert writer.flush(timeout=10) == 1
+    assert isinstance(writer.error, OSError)
+    assert writer.status() == (0, 1)
+    assert writer.annotation(name) == (1, [3])  # the failed annotation is still shown
+    assert saved_labels(folder)[name] == 'unmarked'
+
+    assert writer.flush(timeout=10) == 0  # retried
+    assert writer.status() == (0, 0)
+    store = roi_store.open_rois(folder)
+    roi = store.load(name)
+    store.close()
+    assert (roi['label'], roi['number of peaks'], roi["peaks' score"]) == (1, 1, [3])
+    writer.close(timeout=10)
+
+
+def test_interrupted_write_keeps_previous_file(tmp_path, monkeypatch):
+    folder = JSONFolder(str(tmp_path))
+    folder.add(make_rois(), 'run')
+    name = folder.names()[0]
+    folder.save(name, make_rois()[0], 0)
+    with open(folder.path(name)) as file:
+        previous = file.read()
+
+    def interrupted(roi, file):
+        file.write(json.dumps(roi)[:20])  # the process is killed in the middle of the file
+        raise OSError('interrupted')
+    monkeypatch.setattr('utils.roi.json.dump', interrupted)
+    writer = WriteBehind(str(tmp_path), delay=0.)
+    writer.save(name, make_rois()[0], 1, 1, [2])
+    assert writer.flush(timeout=10) == 1
+    with open(folder.path(name)) as file:
+        assert file.read() == previous  # the file is replaced only after it is written completely
+    assert folder.load(name)['label'] == 0
+
+    monkeypatch.undo()
+    assert writer.flush(timeout=10) == 0
+    assert folder.load(name)['label'] == 1
+    assert not [file for file in os.listdir(tmp_path) if file.endswith('.tmp')]  # renamed on retry
+    writer.close(timeout=10)
+    folder.close()
+
+
+def annotated_folder(path):
+    """
+    Json files of two runs with noise, peaks (scores and borders) and unmarked ROIs
+    """
+    os.makedirs(path, exist_ok=True)
+    folder = JSONFolder(path)
+    folder.add(make_rois(3), 'first', description='total time = 1min, freq = 2Hz')
+    folder.add(make_rois(2), 'second', drop_points=2)
+    names = folder.names()
+    rois = make_rois(3) + make_rois(2)
+    folder.save(names[0], rois[0], 0, drop_points=3, description='noise')
+    folder.save(names[1], rois[1], 1, 2, [1, 3], [[1, 3], [4, 5]], 3, 'two peaks')
+    folder.close()
+    return path
+
+
+def load_all(store):
+    return {store.code(name): store.load(name) for name in store.names()}
+
+
+def test_json_store_json_round_trip(tmp_path):
+    source = JSONFolder(annotated_folder(str(tmp_path / 'json')))
+    path = roi_store.json_to_store(source.folder, str(tmp_path / STORE_FILENAME))
+    target = JSONFolder(roi_store.store_to_json(path, str(tmp_path / 'converted')))
+    expected = load_all(source)
+    assert load_all(target) == expected
+    assert sorted(target.names()) == sorted(source.names())
+    store = ROIStore(path)
+    assert load_all(store) == expected  # arrays and annotations are kept exactly in the store
+    store.close()
+    for folder in (source, target):
+        folder.close()
+
+
+def test_store_json_store_round_trip(tmp_path):
+    store = ROIStore(str(tmp_path / STORE_FILENAME))
+    store.add(make_rois(4), 'run', description='total time = 1min')
+    store.save('run_2', None, 1, 1, [2], [[2, 4]], 3, 'peak')
+    folder = roi_store.store_to_json(store.path, str(tmp_path / 'json'))
+    copy = ROIStore(roi_store.json_to_store(folder, str(tmp_path / 'second.sqlite')))
+    assert load_all(copy) == load_all(store)
+    assert copy.labels() == store.labels()
+    store.close()
+    copy.close()
+
+
+def test_labels_of_both_backends(tmp_path):
+    source = JSONFolder(annotated_folder(str(tmp_path / 'json')))
+    store = ROIStore(roi_store.json_to_store(source.folder, str(tmp_path / STORE_FILENAME)))
+    json_labels = [(source.code(name), label) for name, label in source.labels()]
+    assert json_labels == [(store.code(name), label) for name, label in store.labels()]
+    assert json_labels == [(source.code(name), source.load(name)['label']) for name in source.names()]
+    assert source.labels(1, 2) == source.labels()[1:3]
+    assert store.labels(1, 2) == store.labels()[1:3]
+    assert sorted(map(str, source.annotations())) == sorted(map(str, store.annotations()))
+    source.close()
+    store.close()
+
+
+def relabel(path, label):
+    """
+    Change the label of json file by another program (the index is not updated)
+    """
+    with open(path) as file:
+        roi = json.load(file)
+    mtime = os.stat(path).st_mtime_ns
+    roi['label'] = label
+    with open(path, 'w') as file:
+        json.dump(roi, file)
+    os.utime(path, ns=(mtime + 10 ** 9, mtime + 10 ** 9))  # file systems with coarse modification times
+
+
+def test_label_index_follows_files(tmp_path):
+    path = annotated_folder(str(tmp_path))
+    folder = JSONFolder(path)
+    assert folder.count() == 5  # the index is built
+    folder.close()
+    assert os.path.isfile(os.path.join(path, roi_store.INDEX_FILENAME))
+
+    names = JSONFolder(path).names()
+    make_rois(1)[0].save_annotated(os.path.join(path, 'third_0.json'), 'third_0', 1, 1, [4])  # added
+    relabel(os.path.join(path, names[2]), 0)  # relabelled
+    os.remove(os.path.join(path, names[1]))  # deleted
+    folder = JSONFolder(path)
+    assert dict(folder.labels()) == {name: folder.load(name)['label'] for name in folder.names()}
+    assert folder.annotation('third_0.json') == (1, [4])
+    assert folder.annotation(names[1]) == ('unmarked', [])
+    assert folder.count() == 5
+
+    folder.add(make_rois(2), 'fourth')  # the open index is updated
+    folder.save('fourth_1.json', make_rois(2)[1], 0)
+    folder.delete(names[0])
+    assert dict(folder.labels()) == {name: folder.load(name)['label'] for name in folder.names()}
+    folder.close()
+
+
+def test_label_index_of_previous_version(tmp_path):
+    path = annotated_folder(str(tmp_path))
+    os.remove(os.path.join(path, roi_store.INDEX_FILENAME))
+    index = sqlite3.connect(os.path.join(path, roi_store.INDEX_FILENAME))
+    with index:
+        index.execute('CREATE TABLE labels (name TEXT PRIMARY KEY, number INTEGER, label, peaks_score TEXT)')
+        index.execute("INSERT INTO labels VALUES ('first_0.json', 0, 'unmarked', '[]')")
+    index.close()
+    folder = JSONFolder(path)
+    assert dict(folder.labels()) == {name: folder.load(name)['label'] for name in folder.names()}
+    folder.close()
@@ -0,0 +1,50 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from utils import eic_index, scan_cache
+from utils.eic_index import build_eic_index, open_eic_index
+from utils.scan_cache import build_cache, evict, open_cached, release
+
+
+def scans(n=5):
+    return [(np.array([100., 101.]), np.array([10., 20.]), 0.01 * number) for number in range(n)]
+
+
+def test_release_closes_index(make_mzml):
+    path = make_mzml('release.mzML', scans())
+    build_eic_index(path)
+    folder = open_eic_index(path)[0].folder
+    assert any(key[0] == folder for key in eic_index._opened)
+    release(path)
+    assert not any(key[0] == folder for key in eic_index._opened)
+
+
+def test_evict_skips_folders_in_use(make_mzml, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    paths = [make_mzml(f'evict{n}.mzML', scans()) for n in range(3)]
+    for n, path in enumerate(paths):
+        build_cache(path, cache_dir=cache_dir)
+        os.utime(os.path.join(open_cached(path, cache_dir).folder, 'meta.json'), (n, n))
+    in_use = open_cached(paths[0], cache_dir).folder  # the least recently used folder can't be removed
+    rmtree = shutil.rmtree
+    monkeypatch.setattr(shutil, 'rmtree', lambda folder, **kwargs: folder == in_use or rmtree(folder, **kwargs))
+    folder_size = sum(os.path.getsize(os.path.join(in_use, name)) for name in os.listdir(in_use))
+    evict(cache_dir, max_size=2 * folder_size)
+    assert open_cached(paths[0], cache_dir) is not None
+    assert open_cached(paths[1], cache_dir) is None  # removed instead of the folder in use
+    assert open_cached(paths[2], cache_dir) is not None
+
+
+def test_build_cache_keeps_outdated_copy_in_use(make_mzml, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    path = make_mzml('rebuild.mzML', scans())
+    folder = build_cache(path, cache_dir=cache_dir)
+    make_mzml('rebuild.mzML', scans(6))  # the file is changed
+    rmtree = shutil.rmtree
+    monkeypatch.setattr(shutil, 'rmtree', lambda target, **kwargs: target == folder or rmtree(target, **kwargs))
+    with pytest.raises(OSError):
+        build_cache(path, cache_dir=cache_dir)
+    assert os.listdir(cache_dir) == [os.path.basename(folder)]  # the temporary folder is removed
@@ -1,17 +1,19 @@
 import os
-import json
-import pymzml
+from functools import partial
+from collections import Counter
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from PyQt5 import QtWidgets, QtGui, QtCore
 
-from utils.roi import get_ROIs, ROI
-from utils.roi import construct_ROI
+from utils.roi import ROI_ENGINES, described_ROIs
+from utils.mzml_meta import probe_run, describe_run
+from utils.roi_store import ROIStore, STORE_FILENAME, open_rois, score_counts, Prefetcher, WriteBehind
 from utils.plot import PlotWindow
-from utils.show_list import FileListWidget, GetFolderWidget, ROIListWidget
-from utils.threading import Worker
+from utils.show_list import FileListWidget, GetFolderWidget, ROIListView
+from utils.threading import Worker, ProcessWorker
+from utils import instrumentation
 
 
 class ReAnnotationParameterWindow(QtWidgets.QDialog):
@@ -58,6 +60,8 @@ class AnnotationParameterWindow(QtWidgets.QDialog):
         self.minimum_peak_points = None
         self.dropped_points = 3
         self.folder = None
+        self._candidates = None  # ROICandidates of one file: thresholds are applied without reading the file
+        self._candidates_key = None  # (path, delta_mz, dropped_points, engine)
 
         self._init_ui()
 
@@ -118,6 +122,23 @@ class AnnotationParameterWindow(QtWidgets.QDialog):
         self.intensity_threshold_getter = QtWidgets.QLineEdit(self)
         self.intensity_threshold_getter.setText('1000')
 
+        engine_label = QtWidgets.QLabel()
+        engine_label.setText('ROI算法：')
+        self.engine_getter = QtWidgets.QComboBox(self)
+        self.engine_getter.addItem('逐扫描匹配', 'scan')
+        self.engine_getter.addItem('全局m/z聚类（更快，需将整个文件读入内存）', 'cluster')
+        self.engine_getter.addItem('逐扫描匹配，按m/z分段多进程并行（结果相同，适合单个大文件）', 'parallel')
+
+        candidates_button = QtWidgets.QPushButton('提取候选ROI（之后修改最小长度和强度阈值无需重新读取文件）')
+        candidates_button.clicked.connect(self._extract_candidates)
+        self.candidates_label = QtWidgets.QLabel()  # 实时显示符合当前阈值的ROI个数
+        self.roi_points_getter.textChanged.connect(self._show_candidates_count)
+        self.intensity_threshold_getter.textChanged.connect(self._show_candidates_count)
+        self.mz_getter.textChanged.connect(self._show_candidates_count)
+        self.dropped_points_getter.textChanged.connect(self._show_candidates_count)
+        self.engine_getter.currentIndexChanged.connect(self._show_candidates_count)
+        self.list_of_files.itemSelectionChanged.connect(self._show_candidates_count)
+
         run_button = QtWidgets.QPushButton('生成')
         run_button.clicked.connect(self._run_button)
 
@@ -136,6 +157,10 @@ class AnnotationParameterWindow(QtWidgets.QDialog):
         parameter_layout.addWidget(self.dropped_points_getter)
         parameter_layout.addWidget(intensity_threshold_label)
         parameter_layout.addWidget(self.intensity_threshold_getter)
+        parameter_layout.addWidget(engine_label)
+        parameter_layout.addWidget(self.engine_getter)
+        parameter_layout.addWidget(candidates_button)
+        parameter_layout.addWidget(self.candidates_label)
         parameter_layout.addWidget(run_button)
 
         # main layout
@@ -154,18 +179,32 @@ class AnnotationParameterWindow(QtWidgets.QDialog):
             min_points = int(self.roi_points_getter.text())
             dropped_points = int(self.dropped_points_getter.text())
             intensity_threshold = int(self.intensity_threshold_getter.text())
+            engine = self.engine_getter.currentData()
 
             self.folder = self.folder_widget.get_folder()
-            path2mzml = None
-            for file in self.list_of_files.selectedItems():
-                path2mzml = self.list_of_files.file2path[file.text()]
-            if path2mzml is None:
+            paths = [self.list_of_files.file2path[file.text()] for file in self.list_of_files.selectedItems()]
+            if not paths:
                 raise ValueError
 
-            worker = Worker(get_ROIs, path2mzml, delta_mz, min_points, intensity_threshold, dropped_points)
-            worker.signals.result.connect(self._save)
-            worker.signals.result.connect(self._start_annotation)
-            self.parent.run_thread('构建ROI并保存到指定目录：', worker)  # 进度条
+            if len(paths) > 1:  # 批量生成：每个文件一个进程、子目录和前缀
+                self._run_batch(paths, delta_mz, min_points, intensity_threshold, dropped_points, engine)
+                self.close()
+                return
+
+            if self._candidates is not None and self._candidates_key == (paths[0], delta_mz, dropped_points, engine):
+                rois = self._candidates.rois(min_points, intensity_threshold)  # 不再读取文件
+                self._save(rois, dropped_points)
+                self._start_annotation(rois, dropped_points)
+                self.close()
+                return
+
+            worker = ProcessWorker(ROI_ENGINES[engine], paths[0], delta_mz, min_points, intensity_threshold,
+                                   dropped_points, cancellable=True)  # ROI 数组通过共享内存返回
+            # 使用启动时的连续零点数（结果返回前文本框可能已被修改）
+            worker.signals.result.connect(partial(self._save, dropped_points=dropped_points))
+            worker.signals.result.connect(partial(self._start_annotation, dropped_points=dropped_points))
+            key = ('rois', paths[0], delta_mz, min_points, intensity_threshold, dropped_points, engine)
+            self.parent.run_thread('构建ROI并保存到指定目录：', worker, key=key)  # 进度条
 
             self.close()
         except ValueError:
@@ -175,20 +214,105 @@ class AnnotationParameterWindow(QtWidgets.QDialog):
             msg.setIcon(QtWidgets.QMessageBox.Warning)
             msg.exec_()
 
-    def _save(self, rois):
-        for file_suffix in range(0, len(rois)):
+    def _current_candidates_key(self):
+        """
+        :return: (path, delta_mz, dropped_points, engine) of the current settings or None if they are invalid
+        """
+        selected = self.list_of_files.selectedItems()
+        try:
+            delta_mz = float(self.mz_getter.text())
             dropped_points = int(self.dropped_points_getter.text())
-            filename = f'{self.file_prefix}_{file_suffix}.json'
-            plotted_path = os.path.join(self.folder, filename)
-            code = os.path.basename(plotted_path)
-            code = code[:code.rfind('.')]
-            # print('saving, plotted_path = ', plotted_path, 'rois[] = ', rois[file_suffix])
-            ROI.save_annotated(rois[file_suffix], plotted_path, code, 'unmarked',
-                               drop_points=dropped_points, description=self.description)
-            file_suffix += 1
-
-    def _start_annotation(self, rois):
-        dropped_points = int(self.dropped_points_getter.text())
+        except ValueError:
+            return None
+        if len(selected) != 1:
+            return None
+        path = self.list_of_files.file2path[selected[0].text()]
+        return path, delta_mz, dropped_points, self.engine_getter.currentData()
+
+    def _extract_candidates(self):
+        key = self._current_candidates_key()
+        if key is None:
+            msg = QtWidgets.QMessageBox(self)
+            msg.setText("请检查：\n1.是否已选中一个待标注文件\n2.连续零点数应输入整数")
+            msg.setIcon(QtWidgets.QMessageBox.Warning)
+            msg.exec_()
+            return
+        path, delta_mz, dropped_points, engine = key
+        worker = ProcessWorker(ROI_ENGINES[engine], path, delta_mz, 0, 0, dropped_points, cancellable=True,
+                               candidates=True)  # 不按长度和强度过滤
+        worker.signals.result.connect(partial(self._set_candidates, key))
+        if self.parent.run_thread('提取候选ROI：', worker, key=('candidates',) + key):
+            self.candidates_label.setText('正在提取候选ROI...')
+
+    def _set_candidates(self, key, candidates):
+        self._candidates = candidates
+        self._candidates_key = key
+        self._show_candidates_count()
+
+    def _show_candidates_count(self):
+        if self._candidates is None:
+            return
+        if self._current_candidates_key() != self._candidates_key:
+            self.candidates_label.setText('文件或参数已改变，需重新提取候选ROI')
+            return
+        try:
+            n = self._candidates.count(int(self.roi_points_getter.text()), int(self.intensity_threshold_getter.text()))
+        except ValueError:
+            self.candidates_label.setText('最小ROI长度和峰阈值应输入整数')
+            return
+        self.candidates_label.setText(f'符合条件的ROI：{n} / 候选ROI：{len(self._candidates)}')
+
+    def _run_batch(self, paths, delta_mz, min_points, intensity_threshold, dropped_points, engine='scan'):
+        self._batch_left = len(paths)
+        self._batch_failed = []
+        # 并行算法在进程池的进程中再启动进程：按文件数分配CPU，避免进程数超过CPU核数
+        options = {'jobs': max(1, (os.cpu_count() or 1) // len(paths))} if engine == 'parallel' else {}
+        for path in paths:
+            filename = os.path.basename(path)
+            name = filename[:filename.rfind('.')]
+            folder = os.path.join(self.folder, name)
+            os.makedirs(folder, exist_ok=True)
+
+            # 每个文件的描述（总时长、扫描频率）在子进程中读取，不使用当前选中文件的描述
+            worker = ProcessWorker(described_ROIs, engine, path, delta_mz, min_points, intensity_threshold,
+                                   dropped_points, cancellable=True, **options)
+            worker.signals.result.connect(partial(self._save_described, folder, f'{self.file_prefix}_{name}',
+                                                  dropped_points))
+            worker.signals.error.connect(partial(self._batch_failed_file, filename))
+            worker.signals.cancelled.connect(partial(self._batch_failed_file, filename))
+            worker.signals.finished.connect(self._batch_finished)
+            self.parent.run_process(f'构建ROI：{filename}', worker)  # 每个文件一个进度条
+
+    def _batch_failed_file(self, filename, error=None):
+        self._batch_failed.append(filename)
+
+    def _batch_finished(self):
+        self._batch_left -= 1
+        if not self._batch_left:
+            msg = QtWidgets.QMessageBox(self.parent)
+            if self._batch_failed:
+                msg.setText('以下文件未生成ROI（失败或已取消）：\n' + '\n'.join(self._batch_failed)
+                            + f'\n其余文件的ROI保存在目录：\n{self.folder}')
+                msg.setIcon(QtWidgets.QMessageBox.Warning)
+            else:
+                msg.setText(f'已生成全部文件的ROI，保存在目录：\n{self.folder}\n可通过“继续标注”选择子目录进行标注')
+                msg.setIcon(QtWidgets.QMessageBox.Information)
+            msg.exec_()
+
+    def _save_described(self, folder, file_prefix, dropped_points, result):
+        rois, description = result
+        self._save(rois, dropped_points, folder, file_prefix, description)
+
+    def _save(self, rois, dropped_points, folder=None, file_prefix=None, description=None):
+        folder = self.folder if folder is None else folder
+        file_prefix = self.file_prefix if file_prefix is None else file_prefix
+        description = self.description if description is None else description
+        with instrumentation.timer('save.rois'):
+            store = ROIStore(os.path.join(folder, STORE_FILENAME))  # 所有ROI保存在一个文件中
+            store.add(rois, file_prefix, 'unmarked', drop_points=dropped_points, description=description)
+            store.close()
+
+    def _start_annotation(self, rois, dropped_points):
         subwindow = AnnotationMainWindow(rois, self.folder, self.file_prefix, self.file_suffix,
                                          self.description, self.mode, self.minimum_peak_points,
                                          dropped_points, parent=self.parent)
@@ -196,41 +320,22 @@ class AnnotationParameterWindow(QtWidgets.QDialog):
         subwindow.show()
 
     def get_freq(self, item):
-        spectrum_count = 0
-        t = 0
-        measure = 'second'
         get_selected_files = self.list_of_files.selectedItems()
-        for file in get_selected_files:
-            filename = file.text()
-            path2file = self.list_of_files.file2path[filename]
-            run = pymzml.run.Reader(path2file)
-            spectrum_count = run.get_spectrum_count()  # scan总数
-            # freq = run.scan_time_in_minutes()
-            for spectrum in run:
-                if spectrum.ID == spectrum_count:  # 读取扫描时长
-                    t, measure = spectrum.scan_time  # get scan time 扫描总时长
-                    print(spectrum.ID, spectrum_count, t, measure)
-        if measure == 'millisecond':
-            measure = 'ms'
-            frequency = spectrum_count / t * 1000
-        elif measure == 'minute':
-            measure = 'min'
-            frequency = spectrum_count / t / 60
-        elif measure == 'hour':
-            measure = 'h'
-            frequency = spectrum_count / t / 360
-        else:
-            measure = 's'
-            frequency = spectrum_count / t
-        t = "{:.3f}".format(t)
-        frequency = "{:.2f}".format(frequency)
+        if not get_selected_files:
+            return
+        path2file = self.list_of_files.file2path[get_selected_files[-1].text()]
+        self.instrumental_getter.setText('total time = ..., freq = ...')
+        worker = Worker(probe_run, path2file)  # 在后台线程读取（结果按文件缓存）
+        worker.signals.result.connect(self._show_freq)
+        self.parent.run_thread('获取扫描时长&频率：', worker, lane='interactive', key=('probe', path2file))
 
-        time = str(t)
-        freq = str(frequency)
-        self.instrumental_getter.setText('total time = ' + time + measure + ', freq = ' + freq + 'Hz')
+    def _show_freq(self, probe):
+        self.instrumental_getter.setText(describe_run(*probe))
 
 
 class AnnotationMainWindow(QtWidgets.QDialog):
+    prefetch_count = 5  # 后台预读接下来的ROI个数
+
     def __init__(self, ROIs, folder, file_prefix, file_suffix, description, mode,
                  minimum_peak_points, dropped_points, parent=None):
         super().__init__(parent)
@@ -239,32 +344,36 @@ class AnnotationMainWindow(QtWidgets.QDialog):
         self.file_suffix = file_suffix
         self.description = description
         self.current_description = description
+        self.current_drop_points = dropped_points  # 'drop points' of the plotted ROI
         self.folder = folder
         self.mode = mode
         self.dropped_points = dropped_points
         self.plotted_roi = None
-        self.plotted_path = None
-        self.plotted_item = None  # data reannotation
+        self.plotted_name = None  # name of ROI in the store (or json file), data reannotation
         self.current_flag = False
 
         self.ROIs = ROIs
 
         self.figure = plt.figure()  # a figure instance to plot on
         self.canvas = FigureCanvas(self.figure)
-
-        self.rois_list = ROIListWidget()  # 已标注的ROI列表
+        # axes and line are reused, only their data is swapped
+        self._ax = self.figure.add_subplot(111)
+        self._line, = self._ax.plot([], [], color='C0')
+        self._fills = []
+
+        self.store = open_rois(self.folder)  # ROI store file or json files
+        self.prefetcher = Prefetcher(self.folder)  # 在后台线程读取接下来的ROI
+        self.writer = WriteBehind(self.folder)  # 标注在后台线程批量保存
+        self.rois_list = ROIListView()  # 已标注的ROI列表（滚动时按需读取）
+        self.rois_list.setStore(self.store)
         self.rois_list.connectRightClick(self.file_right_click)
         self.rois_list.connectDoubleClick(self.file_double_click)
 
-        files = []
-        for created_file in os.listdir(self.folder):
-            if created_file.endswith('.json'):
-                begin = created_file.find('_') + 1
-                end = created_file.find('.json')
-                code = int(created_file[begin:end])
-                files.append((code, created_file))
-        for _, file in sorted(files):
-            self.rois_list.addFile(os.path.join(self.folder, file))
+        self.scores = Counter()  # score -> count (0 for noise), updated on every save
+        self.labelled = 0
+        for label, peaks_score in self.store.annotations():
+            self.scores.update(score_counts(label, peaks_score))
+            self.labelled += label in (0, 1)
 
         self._init_ui()  # initialize user interface
         if mode != 'reannotation':
@@ -275,9 +384,9 @@ class AnnotationMainWindow(QtWidgets.QDialog):
         Initialize all buttons and layouts.
         """
         # canvas layout
-        toolbar = NavigationToolbar(self.canvas, self)
+        self.toolbar = NavigationToolbar(self.canvas, self)
         canvas_layout = QtWidgets.QVBoxLayout()
-        canvas_layout.addWidget(toolbar)
+        canvas_layout.addWidget(self.toolbar)
         canvas_layout.addWidget(self.canvas)
 
         # ROI list layout
@@ -296,7 +405,16 @@ class AnnotationMainWindow(QtWidgets.QDialog):
         roi_progress.addWidget(roi_label)
         roi_progress.addWidget(self.roi_cnt)
         roi_list_layout.addLayout(roi_progress)
+        self.score_cnt = QtWidgets.QLabel(self)  # 实时统计各分数的个数
+        self.score_cnt.setWordWrap(True)
+        self.show_counters()
+        roi_list_layout.addWidget(self.score_cnt)
         roi_list_layout.addWidget(self.rois_list)
+        self.save_status = QtWidgets.QLabel(self)  # 后台保存状态
+        roi_list_layout.addWidget(self.save_status)
+        self.save_timer = QtCore.QTimer(self)
+        self.save_timer.timeout.connect(self.show_save_status)
+        self.save_timer.start(200)
 
         # canvas and ROI list layout
         canvas_files_layout = QtWidgets.QHBoxLayout()
@@ -343,35 +461,88 @@ class AnnotationMainWindow(QtWidgets.QDialog):
     def file_right_click(self):
         FileContextMenu(self)
 
-    def file_double_click(self, item):
-        self.plotted_item = item
+    def file_double_click(self, name):
+        self.plotted_name = name
         self.plot_chosen()
 
     def get_chosen(self):
-        chosen_item = None
-        for item in self.rois_list.selectedItems():
-            chosen_item = item
-        return chosen_item
-
-    def close_file(self, item):
-        if item == self.plotted_item:
-            index = min(self.rois_list.row(self.plotted_item) + 1, self.rois_list.count() - 2)
-            self.plotted_item = self.rois_list.item(index)
-            self.plotted_item.setSelected(True)
-            self.plot_chosen()
-        self.rois_list.deleteFile(item)
+        return self.rois_list.selectedName()
+
+    def show_counters(self):
+        text = f'已标注：{self.labelled} / {self.rois_list.count()}\n'
+        text += '，'.join(f'{score}分：{n}' for score, n in sorted(self.scores.items()) if n > 0)
+        self.score_cnt.setText(text)
+
+    def show_save_status(self):
+        pending, failed = self.writer.status()
+        if failed:
+            self.save_status.setStyleSheet('color: red')
+            self.save_status.setText(f'保存失败：{failed}（将在下次标注时重试）')
+            self.save_status.setToolTip(str(self.writer.error))
+        elif pending:
+            self.save_status.setStyleSheet('')
+            self.save_status.setText(f'正在保存：{pending}')
+        else:
+            self.save_status.setStyleSheet('')
+            self.save_status.setText('已保存')
+
+    def save_annotation(self, label, number_of_peaks=0, peaks_score=None, borders=None, description=None):
+        # the previous annotation could be not written yet
+        old_label, old_peaks_score = (self.writer.annotation(self.plotted_name) or
+                                      self.store.annotation(self.plotted_name))
+        self.writer.save(self.plotted_name, self.plotted_roi, label, number_of_peaks, peaks_score, borders,
+                         description=description)
+        self.scores.subtract(score_counts(old_label, old_peaks_score))
+        self.scores.update(score_counts(label, peaks_score))
+        self.labelled += (label in (0, 1)) - (old_label in (0, 1))
+        self.prefetcher.invalidate(self.plotted_name)
+        self.rois_list.refresh_background(self.plotted_name, label)  # 更新列表背景
+        self.show_counters()
+
+    def select_next(self):
+        index = min(self.rois_list.row(self.plotted_name) + 1, self.rois_list.count() - 1)
+        self.plotted_name = self.rois_list.name(index)
+        self.rois_list.select(index)
+        self.plot_chosen()
 
-    def delete_file(self, item):
-        os.remove(self.rois_list.getPath(item))
-        self.close_file(item)
+    def close_file(self, name):
+        if name == self.plotted_name:
+            index = min(self.rois_list.row(self.plotted_name) + 1, self.rois_list.count() - 2)
+            self.plotted_name = self.rois_list.name(index)
+            self.rois_list.select(index)
+            self.plot_chosen()
+        self.rois_list.deleteName(name)
+
+    def delete_file(self, name):
+        old_label, old_peaks_score = self.writer.annotation(name) or self.store.annotation(name)
+        self.writer.discard(name)  # waits if the annotation is being written
+        self.scores.subtract(score_counts(old_label, old_peaks_score))
+        self.labelled -= old_label in (0, 1)
+        self.store.delete(name)
+        self.prefetcher.invalidate(name)
+        self.close_file(name)
+        self.show_counters()
+
+    def closeEvent(self, event):
+        failed = self.writer.flush(timeout=10)
+        if failed:
+            msg = QtWidgets.QMessageBox(self)
+            msg.setText(f'{failed}个ROI的标注未能保存：{self.writer.error}\n重试保存？')
+            msg.setIcon(QtWidgets.QMessageBox.Warning)
+            msg.setStandardButtons(QtWidgets.QMessageBox.Retry | QtWidgets.QMessageBox.Discard)
+            if msg.exec_() == QtWidgets.QMessageBox.Retry:
+                event.ignore()
+                return
+        self.save_timer.stop()
+        self.writer.close(timeout=1)
+        self.prefetcher.close()
+        self.store.close()
+        super().closeEvent(event)
 
     # Buttons
     def noise(self):
-        code = os.path.basename(self.plotted_path)
-        code = code[:code.rfind('.')]
         label = 0
-        self.plotted_roi.save_annotated(self.plotted_path, code, label, description=self.current_description)
-        self.rois_list.refresh_background(self.plotted_path)  # 更新列表背景
+        self.save_annotation(label, description=self.current_description)
 
         if self.current_flag:
             self.current_flag = False
@@ -379,11 +550,7 @@ class AnnotationMainWindow(QtWidgets.QDialog):
             self.file_suffix += 1
             self.plot_current()
         else:
-            self.plotted_item.setSelected(False)
-            index = min(self.rois_list.row(self.plotted_item) + 1, self.rois_list.count() - 1)
-            self.plotted_item = self.rois_list.item(index)
-            self.plotted_item.setSelected(True)
-            self.plot_chosen()
+            self.select_next()
 
     def peak(self):  # 单峰评分
         subwindow = OnePeakScoreWindow(self)
@@ -399,31 +566,15 @@ class AnnotationMainWindow(QtWidgets.QDialog):
             self.current_flag = False
             self.plot_current()
         else:
-            self.plotted_item.setSelected(False)
-            index = min(self.rois_list.row(self.plotted_item) + 1, self.rois_list.count() - 1)
-            self.plotted_item = self.rois_list.item(index)
-            self.plotted_item.setSelected(True)
-            self.plot_chosen()
+            self.select_next()
 
     def count(self):
-        noise = 0
-        scores = []
-        for filename in self.rois_list.file2path:
-            path2roi = self.rois_list.file2path[filename]
-            with open(path2roi) as json_file:
-                roi = json.load(json_file)
-                if roi['label'] == 0:
-                    scores.append(0)
-                    noise += 1
-                elif roi['label'] == 1:
-                    for i in range(0, len(roi["peaks' score"])):
-                        score = roi["peaks' score"][i]
-                        scores.append(score)
+        scores = sorted(score for score, n in self.scores.items() if n > 0)  # 由计数器统计，不再读取文件
         fig_cnt = plt.figure('calculate')
         plt.xlabel('scores')
         plt.ylabel('count')
         plt.xticks(scores)
-        plt.hist(scores, bins=np.arange(-0.5, 11.5), edgecolor='w')
+        plt.hist(scores, bins=np.arange(-0.5, 11.5), weights=[self.scores[score] for score in scores], edgecolor='w')
         fig_cnt.show()
 
     def save_auto_annotation(self):
@@ -438,20 +589,18 @@ class AnnotationMainWindow(QtWidgets.QDialog):
             for i in range(number_of_peaks - 1):
                 intersections.append(int(np.argmin(self.plotted_roi.i[ends[i]:begins[i+1]]) + ends[i]))
 
-            code = os.path.basename(self.plotted_path)
-            code = code[:code.rfind('.')]
-            self.plotted_roi.save_annotated(self.plotted_path, int(self.label), code, number_of_peaks,
-                                            begins, ends, intersections, self.description)
+            self.writer.save(self.plotted_name, self.plotted_roi, int(self.label), number_of_peaks,
+                             begins, ends, intersections, self.description)
 
             self.current_flag = False
-            self.rois_list.addFile(self.plotted_path)
+            self.rois_list.refresh_background(self.plotted_name, int(self.label))
             self.file_suffix += 1
             self.plot_current()
 
     def press_plot_chosen(self):
         try:
-            self.plotted_item = self.get_chosen()
-            if self.plotted_item is None:
+            self.plotted_name = self.get_chosen()
+            if self.plotted_name is None:
                 raise ValueError
             self.plot_chosen()
         except ValueError:
@@ -467,35 +616,51 @@ class AnnotationMainWindow(QtWidgets.QDialog):
             if not self.current_flag:
                 self.current_flag = True
                 self.current_description = self.description
+                self.current_drop_points = self.dropped_points
                 self.plotted_roi = self.ROIs[self.file_suffix]  # 标注完成后，list index out of range：跳except弹出完成提示
-                filename = f'{self.file_prefix}_{self.file_suffix}.json'
-                self.plotted_path = os.path.join(self.folder, filename)
+                filename = self.store.name(f'{self.file_prefix}_{self.file_suffix}')
+                self.plotted_name = filename
 
-                self.figure.clear()
-                ax = self.figure.add_subplot(111)
-                ax.plot(self.plotted_roi.i, label=filename)
                 title = f'mz = {self.plotted_roi.mzmean:.3f}, ' \
                         f'rt = {self.plotted_roi.rt[0]:.1f} - {self.plotted_roi.rt[1]:.1f}'
-                ax.legend(loc='best')
-                ax.set_title(title)
-                self.canvas.draw()  # refresh canvas
+                self.show_roi(title)
         except IndexError:
             msg = QtWidgets.QMessageBox(self)
             msg.setText('已标注完所有ROI')
             msg.setIcon(QtWidgets.QMessageBox.Warning)
             msg.exec_()
 
+    def show_roi(self, title, fills=()):
+        """
+        Show plotted_roi: data of the line and filled peaks are swapped, the figure isn't rebuilt
+        :param title: title of the plot
+        :param fills: (begin, end, label) of filled peaks
+        """
+        i = self.plotted_roi.i
+        self._line.set_data(np.arange(len(i)), i)
+        self._line.set_label(self.plotted_name)
+        for fill in self._fills:
+            fill.remove()
+        self._fills = [self._ax.fill_between(range(begin, end + 1), i[begin:end + 1], alpha=0.5,
+                                             color=f'C{n + 1}', label=label)
+                       for n, (begin, end, label) in enumerate(fills)]
+        self._ax.set_autoscale_on(True)  # the view could be zoomed by the toolbar
+        self._ax.relim()
+        self._ax.autoscale_view()
+        self.toolbar.update()  # forget zoom history of the previous ROI
+        self._ax.set_title(title)
+        self._ax.legend(loc='best')
+        with instrumentation.timer('plot.draw'):
+            self.canvas.draw_idle()
+
     def plot_chosen(self):
-        filename = self.plotted_item.text()
-        path2roi = self.rois_list.file2path[filename]
-        with open(path2roi) as json_file:
-            roi = json.load(json_file)
+        filename = self.plotted_name
+        with instrumentation.timer('plot.load'):
+            roi, self.plotted_roi = self.prefetcher.get(filename, self.store)
+            roi = self.writer.annotated(filename, roi)  # the annotation could be not written yet
         self.current_description = roi['description']
-        self.plotted_roi = construct_ROI(roi)
-        self.plotted_path = path2roi
-        self.figure.clear()
-        ax = self.figure.add_subplot(111)
-        ax.plot(self.plotted_roi.i, label=filename)
+        self.current_drop_points = roi['drop points']
+        self.plotted_name = filename
         title = f'mz = {self.plotted_roi.mzmean:.3f}, ' \
                 f'rt = {self.plotted_roi.rt[0]:.1f} - {self.plotted_roi.rt[1]:.1f}'
 
@@ -506,32 +671,24 @@ class AnnotationMainWindow(QtWidgets.QDialog):
         else:
             title = 'label = unmarked, ' + title
 
+        fills = []
         for border, peak_score in zip(roi['borders'], roi["peaks' score"]):
             begin, end = border
             if begin < 0:
                 begin = 0
-            ax.fill_between(range(begin, end + 1), self.plotted_roi.i[begin:end + 1], alpha=0.5,
-                            label=f"score: {peak_score}, borders={begin}-{end}")
-
-        ax.set_title(title)
-        ax.legend(loc='best')
-        self.canvas.draw()
+            fills.append((begin, end, f"score: {peak_score}, borders={begin}-{end}"))
+        self.show_roi(title, fills)
         self.current_flag = False
 
+        row = self.rois_list.row(filename)  # 预读接下来的ROI
+        if row is not None:
+            last = min(row + 1 + self.prefetch_count, self.rois_list.count())
+            self.prefetcher.prefetch(self.rois_list.name(n) for n in range(row + 1, last))
+
     def plot_preview(self, borders):
-        filename = os.path.basename(self.plotted_path)
-        self.figure.clear()
-        ax = self.figure.add_subplot(111)
-        ax.plot(self.plotted_roi.i, label=filename)
         title = f'mz = {self.plotted_roi.mzmean:.3f}, ' \
                 f'rt = {self.plotted_roi.rt[0]:.1f} - {self.plotted_roi.rt[1]:.1f}'
-
-        for border in borders:
-            begin, end = border
-            ax.fill_between(range(begin, end + 1), self.plotted_roi.i[begin:end + 1], alpha=0.5)
-        ax.set_title(title)
-        ax.legend(loc='best')
-        self.canvas.draw()  # refresh canvas
+        self.show_roi(title, [(begin, end, None) for begin, end in borders])
 
 
 class AnnotationGetNumberOfPeaksNovel(QtWidgets.QDialog):
@@ -639,16 +796,11 @@ class OnePeakScoreWindow(QtWidgets.QDialog):
 
     def save(self):
         try:
-            code = os.path.basename(self.parent.plotted_path)
-            with open(self.parent.plotted_path) as json_file:
-                roi = json.load(json_file)
-            label = roi['label']
             if self.parent.mode != 'reannotation':  # 首次标注时，获取文本框中的dropped_points
                 dropped_points = self.parent.dropped_points
-            else:  # 模式为继续标注时，读取文件中的dropped_points
-                dropped_points = roi['drop points']
+            else:  # 模式为继续标注时，使用绘制ROI时读取的dropped_points（不再读取文件）
+                dropped_points = self.parent.current_drop_points
 
-            code = code[:code.rfind('.')]
             label = 1
             borders = []
             peaks_score = []
@@ -666,9 +818,7 @@ class OnePeakScoreWindow(QtWidgets.QDialog):
             msg.setIcon(QtWidgets.QMessageBox.Warning)
             msg.exec_()
 
-        self.parent.plotted_roi.save_annotated(self.parent.plotted_path, code, label, 1,
-                                               peaks_score, borders, description=self.parent.current_description)
-        self.parent.rois_list.refresh_background(self.parent.plotted_path)  # 更新列表背景
+        self.parent.save_annotation(label, 1, peaks_score, borders, description=self.parent.current_description)
 
         if self.parent.current_flag:
             self.parent.current_flag = False
@@ -676,11 +826,7 @@ class OnePeakScoreWindow(QtWidgets.QDialog):
             self.parent.file_suffix += 1
             self.parent.plot_current()
         else:
-            self.parent.plotted_item.setSelected(False)
-            index = min(self.parent.rois_list.row(self.parent.plotted_item) + 1, self.parent.rois_list.count() - 1)
-            self.parent.plotted_item = self.parent.rois_list.item(index)
-            self.parent.plotted_item.setSelected(True)
-            self.parent.plot_chosen()
+            self.parent.select_next()
         self.close()
 
 
@@ -808,8 +954,6 @@ class AnnotationGetBordersWindowNovel(QtWidgets.QDialog):  # 多峰标注界面
 
     def save(self):
         try:
-            code = os.path.basename(self.parent.plotted_path)
-            code = code[:code.rfind('.')]
             label = 1
             number_of_peaks = self.number_of_peaks
             peaks_score = []
@@ -823,21 +967,16 @@ class AnnotationGetBordersWindowNovel(QtWidgets.QDialog):  # 多峰标注界面
                 end = int(ps.end_getter.text())
                 borders.append((begin, end))
 
-            self.parent.plotted_roi.save_annotated(self.parent.plotted_path, code, label, number_of_peaks,
-                                                   peaks_score, borders, description=self.parent.current_description)
-            self.parent.rois_list.refresh_background(self.parent.plotted_path)  # 更新列表背景
+            self.parent.save_annotation(label, number_of_peaks, peaks_score, borders,
+                                        description=self.parent.current_description)
 
             if self.parent.current_flag:
                 self.parent.current_flag = False
-                self.parent.rois_list.addFile(self.parent.plotted_path)
+                # self.parent.rois_list.addFile(self.parent.plotted_path)
                 self.parent.file_suffix += 1
                 self.parent.plot_current()
             else:
-                self.parent.plotted_item.setSelected(False)
-                index = min(self.parent.rois_list.row(self.parent.plotted_item) + 1, self.parent.rois_list.count() - 1)
-                self.parent.plotted_item = self.parent.rois_list.item(index)
-                self.parent.plotted_item.setSelected(True)
-                self.parent.plot_chosen()
+                self.parent.select_next()
             self.close()
         except ValueError:
             # popup window with exception
@@ -872,9 +1011,9 @@ class FileContextMenu(QtWidgets.QMenu):
         #     self.reannotation()
 
     def close_file(self):
-        item = self.parent.get_chosen()
-        self.parent.close_file(item)
+        name = self.parent.get_chosen()
+        self.parent.close_file(name)
 
     def delete_file(self):
-        item = self.parent.get_chosen()
-        self.parent.delete_file(item)
+        name = self.parent.get_chosen()
+        self.parent.delete_file(name)
@@ -0,0 +1,35 @@
+import threading
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a job which was cancelled by its token
+    """
+
+
+class CancelToken:
+    """
+    Cooperative cancellation: long-running functions call check() between scans
+    :param event: threading.Event (by default) or a multiprocessing manager Event for jobs in other processes
+    """
+    def __init__(self, event=None):
+        self.event = threading.Event() if event is None else event
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled()
+
+
+def check(cancel_token):
+    """
+    Raise Cancelled if the token (which can be None) was cancelled
+    """
+    if cancel_token is not None and cancel_token.event.is_set():
+        raise Cancelled()
@@ -0,0 +1,180 @@
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+from utils import instrumentation
+from utils.cancel import check
+from utils.scan_cache import open_cached, build_cache, on_release
+
+
+VERSION = 1
+BIN_WIDTH = 0.01  # m/z width of bins of the inverted index
+FILES = ('eic_mz.npy', 'eic_scan.npy', 'eic_i.npy', 'eic_bins.npy')
+MAX_OPENED = 4  # indexes of the least recently used files are closed above this number
+_opened = OrderedDict()  # (cache folder, mtime, size) -> EICIndex (memory-mapped arrays are shared across queries)
+
+
+class EICIndex:
+    """
+    Inverted index of MS1 points: m/z bins -> postings (m/z, scan, intensity) sorted by m/z.
+    Arrays are memory-mapped from the cache folder of the file.
+    :param folder: cache folder of the file
+    :param meta: dict with description of the index
+    """
+    def __init__(self, folder, meta):
+        self.folder = folder
+        self.meta = meta
+        self.mz0 = meta['mz0']
+        self.bin_width = meta['bin_width']
+        self.mz, self.scan, self.i, self.bins = (np.load(os.path.join(folder, name), mmap_mode='r')
+                                                 if meta['points'] else np.zeros(0) for name in FILES)
+        if not meta['points']:
+            self.scan = self.scan.astype(np.int32)
+            self.bins = np.zeros(1, dtype=np.int64)
+
+    def _window(self, low, high):
+        """
+        :return: range of postings with low <= m/z < high (only the bins of the range are read)
+        """
+        n_bins = len(self.bins) - 1
+        first = int(np.clip(np.floor((low - self.mz0) / self.bin_width), 0, n_bins))
+        last = int(np.clip(np.floor((high - self.mz0) / self.bin_width) + 1, 0, n_bins))
+        begin, end = int(self.bins[first]), int(self.bins[last])
+        mz = self.mz[begin:end]
+        return begin + np.searchsorted(mz, low, 'left'), begin + np.searchsorted(mz, high, 'left')
+
+    def intensities(self, mz, delta, n_scans):
+        """
+        Intensities of the closest peak of every scan to mz (0 if it is farther than delta),
+        the same values as reading every scan
+        :param mz: target m/z
+        :param delta: tolerance
+        :param n_scans: number of MS1 scans
+        :return: array of intensities (one per scan)
+        """
+        result = np.zeros(n_scans)
+        # the closest peak within delta is the closest peak of the window on its side
+        begin, end = self._window(mz - 2 * delta, mz + 2 * delta)
+        if begin == end:
+            return result
+        window_mz = np.asarray(self.mz[begin:end])
+        window_scan = np.asarray(self.scan[begin:end])
+        window_i = np.asarray(self.i[begin:end])
+        split = np.searchsorted(window_mz, mz, 'left')  # left peaks are < mz, right peaks are >= mz
+
+        # right neighbour: the first peak >= mz of the scan, left one: the last peak < mz
+        right_scan, right = np.unique(window_scan[split:], return_index=True)
+        right += split
+        left_scan, left = np.unique(window_scan[:split][::-1], return_index=True)
+        left = split - 1 - left
+
+        closest = np.full(n_scans, -1)
+        closest[left_scan] = left
+        has_left = closest[right_scan] >= 0
+        # the right peak wins only if it is strictly closer (as in get_closest)
+        right_wins = ~has_left | (window_mz[right] - mz < mz - window_mz[closest[right_scan]])
+        closest[right_scan[right_wins]] = right[right_wins]
+
+        scans = np.flatnonzero(closest >= 0)
+        peaks = closest[scans]
+        near = np.abs(window_mz[peaks] - mz) < delta
+        result[scans[near]] = window_i[peaks[near]]
+        return result
+
+
+def open_eic_index(path):
+    """
+    Open EIC index of mzml file
+    :param path: path to mzml file
+    :return: (CachedRun, EICIndex) or None if the file isn't cached or the index isn't built
+    """
+    cached = open_cached(path)
+    if cached is None:
+        return None
+    key = (cached.folder, cached.meta['mtime'], cached.meta['size'])  # the cache is rebuilt if the file changes
+    index = _opened.get(key)
+    if index is not None:
+        _opened.move_to_end(key)
+    else:
+        try:
+            with open(os.path.join(cached.folder, 'eic.json')) as meta_file:
+                meta = json.load(meta_file)
+            if meta.get('version') != VERSION:
+                return None
+            index = EICIndex(cached.folder, meta)
+        except (OSError, ValueError):
+            return None
+        _opened[key] = index
+        while len(_opened) > MAX_OPENED:
+            _opened.popitem(last=False)
+    return cached, index
+
+
+def _release(folder):
+    """
+    Close indexes of the cache folder (it is going to be removed)
+    """
+    for key in [key for key in _opened if key[0] == folder]:
+        del _opened[key]
+
+
+on_release(_release)
+
+
+def build_eic_index(path, progress_callback=None, cancel_token=None):
+    """
+    Cache MS1 data of mzml file (if it isn't cached) and build the EIC index next to it
+    :param path: path to mzml file
+    :param cancel_token: CancelToken checked between stages
+    :return: path to the cache folder
+    """
+    if open_eic_index(path) is not None:
+        return open_cached(path).folder
+    cached = open_cached(path)
+    if cached is None:
+        build_cache(path, progress_callback=progress_callback, cancel_token=cancel_token)
+        cached = open_cached(path)
+    folder = cached.folder
+    n_points = len(cached.mz)
+
+    with instrumentation.timer('eic_index.build'):
+        mz = np.asarray(cached.mz)
+        order = np.argsort(mz, kind='stable')  # points of equal m/z stay in order of scans and peaks
+        check(cancel_token)
+        scan = np.repeat(np.arange(len(cached), dtype=np.int32), np.diff(cached.offsets))
+        mz0 = float(mz[order[0]]) if n_points else 0.
+        n_bins = int((float(mz[order[-1]]) - mz0) // BIN_WIDTH) + 1 if n_points else 0
+        arrays = {'eic_mz.npy': mz[order], 'eic_scan.npy': scan[order], 'eic_i.npy': np.asarray(cached.i)[order]}
+        check(cancel_token)
+        arrays['eic_bins.npy'] = np.searchsorted(arrays['eic_mz.npy'], mz0 + BIN_WIDTH * np.arange(n_bins + 1),
+                                                 'left').astype(np.int64)
+        arrays['eic_bins.npy'][-1] = n_points
+        pid = os.getpid()
+        for name, array in arrays.items():  # every file is replaced atomically, meta is written last
+            np.save(os.path.join(folder, f'{name}.{pid}.tmp.npy'), array)
+            os.replace(os.path.join(folder, f'{name}.{pid}.tmp.npy'), os.path.join(folder, name))
+        meta = {'version': VERSION, 'points': n_points, 'mz0': mz0, 'bin_width': BIN_WIDTH}
+        with open(os.path.join(folder, f'eic.json.{pid}.tmp'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(os.path.join(folder, f'eic.json.{pid}.tmp'), os.path.join(folder, 'eic.json'))
+    if progress_callback is not None:
+        progress_callback.emit(100)
+    return folder
+
+
+def eic_from_index(path, mz, delta):
+    """
+    EICs of targets from the index (without reading of mzml file)
+    :param path: path to mzml file
+    :param mz: vector of target m/z values
+    :param delta: vector of tolerances
+    :return: (retention times, matrix of intensities (targets x scans), time unit) or None if there is no index
+    """
+    opened = open_eic_index(path)
+    if opened is None:
+        return None
+    cached, index = opened
+    with instrumentation.timer('eic_index.query'):
+        eic = np.array([index.intensities(target_mz, target_delta, len(cached))
+                        for target_mz, target_delta in zip(mz, delta)]).reshape(len(mz), len(cached))
+    return cached.rt, eic, cached.time_unit
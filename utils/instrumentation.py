@@ -0,0 +1,250 @@
+"""
+Opt-in instrumentation of the hot paths: named timers, counters and value statistics.
+
+Enabled by environment variables (or by `roi_cli.py --profile`):
+    LCMS_MARKTOOL_INSTRUMENT=1            report is printed to stderr at exit
+    LCMS_MARKTOOL_INSTRUMENT=report.json  report is written to the file at exit
+    LCMS_MARKTOOL_PROFILE=cprofile        every Worker job runs under cProfile
+    LCMS_MARKTOOL_PROFILE=tracemalloc     every Worker job runs under tracemalloc
+The profile variable alone also turns instrumentation on (report to stderr).
+Timers and counters cost one attribute check when instrumentation is disabled.
+"""
+import io
+import os
+import sys
+import json
+import time
+import atexit
+import pstats
+import cProfile
+import tracemalloc
+
+ENV_INSTRUMENT = 'LCMS_MARKTOOL_INSTRUMENT'
+ENV_PROFILE = 'LCMS_MARKTOOL_PROFILE'
+
+
+class _State:
+    enabled = False
+    output = None  # path to the report (None - stderr)
+    profile = None  # None, 'cprofile' or 'tracemalloc'
+    timers = {}  # name -> [count, total seconds, max seconds]
+    counters = {}  # name -> value
+    stats = {}  # name -> [count, sum, min, max]
+    profiles = []
+    profile_calls = 0  # sequence number of profiled calls in this process (in names of .prof files)
+    process_dumps = set()  # reports of pool process jobs written by this process
+
+
+_state = _State()
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        timer = _state.timers.get(self.name)
+        if timer is None:
+            _state.timers[self.name] = [1, elapsed, elapsed]
+        else:
+            timer[0] += 1
+            timer[1] += elapsed
+            timer[2] = max(timer[2], elapsed)
+        return False
+
+
+def enabled():
+    return _state.enabled
+
+
+def enable(output=None, profile=None):
+    """
+    Turn instrumentation on (the report is dumped at exit)
+    :param output: path to json report (None - print to stderr)
+    :param profile: None, 'cprofile' or 'tracemalloc' capture of Worker jobs
+    """
+    if not _state.enabled:
+        atexit.register(dump)
+    _state.enabled = True
+    _state.output = output
+    _state.profile = profile
+    # child processes (process pool, CLI jobs) inherit the settings
+    os.environ[ENV_INSTRUMENT] = output or '1'
+    if profile:
+        os.environ[ENV_PROFILE] = profile
+
+
+def timer(name):
+    """
+    Context manager which accumulates time of the block: `with timer('roi.match'): ...`
+    """
+    return _Timer(name) if _state.enabled else _null_timer
+
+
+def count(name, value=1):
+    """
+    Add an integer value to the counter (scans, tree operations, bytes written)
+    """
+    if _state.enabled:
+        _state.counters[name] = _state.counters.get(name, 0) + int(value)
+
+
+def observe(name, value):
+    """
+    Add a value to statistics (count, sum, min, max), e.g. number of active ROIs per scan
+    """
+    if _state.enabled:
+        stat = _state.stats.get(name)
+        if stat is None:
+            _state.stats[name] = [1, value, value, value]
+        else:
+            stat[0] += 1
+            stat[1] += value
+            stat[2] = min(stat[2], value)
+            stat[3] = max(stat[3], value)
+
+
+def report():
+    """
+    :return: dict with timers, counters, statistics and profiles collected in this process
+    """
+    return {'pid': os.getpid(),
+            'timers': {name: {'count': n, 'total': total, 'mean': total / n, 'max': maximum}
+                       for name, (n, total, maximum) in sorted(_state.timers.items())},
+            'counters': dict(sorted(_state.counters.items())),
+            'stats': {name: {'count': n, 'mean': total / n, 'min': minimum, 'max': maximum}
+                      for name, (n, total, minimum, maximum) in sorted(_state.stats.items())},
+            'profiles': list(_state.profiles)}
+
+
+def merge(other):
+    """
+    Add report of another process (e.g. a CLI job) to this process
+    """
+    for name, timer_report in other['timers'].items():
+        timer_state = _state.timers.setdefault(name, [0, 0., 0.])
+        timer_state[0] += timer_report['count']
+        timer_state[1] += timer_report['total']
+        timer_state[2] = max(timer_state[2], timer_report['max'])
+    for name, value in other['counters'].items():
+        _state.counters[name] = _state.counters.get(name, 0) + int(value)
+    for name, stat in other['stats'].items():
+        stat_state = _state.stats.setdefault(name, [0, 0, stat['min'], stat['max']])
+        stat_state[0] += stat['count']
+        stat_state[1] += stat['mean'] * stat['count']
+        stat_state[2] = min(stat_state[2], stat['min'])
+        stat_state[3] = max(stat_state[3], stat['max'])
+    _state.profiles.extend(other['profiles'])
+
+
+def reset():
+    _state.timers.clear()
+    _state.counters.clear()
+    _state.stats.clear()
+    _state.profiles.clear()
+
+
+def dump(path=None):
+    """
+    Write the report to json file (or to stderr)
+    :param path: path to the report (by default the one given in enable / environment variable)
+    """
+    if not _state.enabled:
+        return
+    path = path or _state.output
+    if not (_state.timers or _state.counters or _state.stats or _state.profiles):
+        return
+    if path:
+        with open(path, 'w') as file:
+            json.dump(report(), file, indent=2)
+    else:
+        json.dump(report(), sys.stderr, indent=2)
+        sys.stderr.write('\n')
+
+
+def dump_process():
+    """
+    Dump report of a pool process next to the main report ({report}.{pid}.json) and reset it,
+    reports of the previous jobs of the process are merged into the file
+    """
+    if _state.enabled:
+        if _state.output:
+            base, extension = os.path.splitext(_state.output)
+            path = f'{base}.{os.getpid()}{extension or ".json"}'
+            if path in _state.process_dumps and os.path.isfile(path):
+                with open(path) as file:
+                    merge(json.load(file))
+            dump(path)
+            _state.process_dumps.add(path)
+        else:
+            dump()
+        reset()
+
+
+def profiled(function, *args, **kwargs):
+    """
+    Call function under cProfile or tracemalloc if the capture mode is on
+    """
+    if not _state.enabled or _state.profile not in ('cprofile', 'tracemalloc'):
+        return function(*args, **kwargs)
+    name = getattr(function, '__qualname__', repr(function))
+    if _state.profile == 'cprofile':
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args, **kwargs)
+        finally:
+            stream = io.StringIO()
+            stats = pstats.Stats(profiler, stream=stream)
+            stats.sort_stats('cumulative').print_stats(25)
+            profile = {'function': name, 'mode': 'cprofile', 'top': stream.getvalue()}
+            if _state.output:
+                _state.profile_calls += 1
+                profile['path'] = (f'{os.path.splitext(_state.output)[0]}.{name}.{os.getpid()}.'
+                                   f'{_state.profile_calls}.prof')
+                stats.dump_stats(profile['path'])
+            _state.profiles.append(profile)
+    started = tracemalloc.is_tracing()
+    if not started:
+        tracemalloc.start()
+    if hasattr(tracemalloc, 'reset_peak'):  # python 3.9+
+        tracemalloc.reset_peak()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if not started:
+            tracemalloc.stop()
+        _state.profiles.append({'function': name, 'mode': 'tracemalloc', 'current_bytes': current,
+                                'peak_bytes': peak,
+                                'top': [str(line) for line in snapshot.statistics('lineno')[:25]]})
+
+
+def _init_from_environment():
+    value = os.environ.get(ENV_INSTRUMENT)
+    profile = os.environ.get(ENV_PROFILE) or None
+    if value == '0':  # turned off explicitly
+        return
+    if value or profile:
+        enable(None if value in (None, '', '1') else value, profile)
+
+
+_init_from_environment()
@@ -0,0 +1,309 @@
+import os
+import re
+import zlib
+import base64
+import xml.etree.ElementTree as ET
+import pymzml
+import numpy as np
+from utils.scan_cache import open_cached
+
+
+# cvParams of mzML used below
+MS_LEVEL = 'MS:1000511'
+TOTAL_ION_CURRENT = 'MS:1000285'
+SCAN_START_TIME = 'MS:1000016'
+TIC_CHROMATOGRAM = 'MS:1000235'
+MS1_SPECTRUM = 'MS:1000579'
+MSN_SPECTRUM = 'MS:1000580'
+TIME_ARRAY = 'MS:1000595'
+INTENSITY_ARRAY = 'MS:1000515'
+FLOAT_32 = 'MS:1000521'
+FLOAT_64 = 'MS:1000523'
+ZLIB = 'MS:1000574'
+NO_COMPRESSION = 'MS:1000576'
+UNITS = {'UO:0000031': 'minute', 'UO:0000010': 'second', 'UO:0000028': 'millisecond', 'UO:0000032': 'hour'}
+
+
+def _tag(element):
+    return element.tag.rsplit('}', 1)[-1]  # without namespace
+
+
+def _unit(cv_param):
+    return UNITS.get(cv_param.get('unitAccession'), cv_param.get('unitName'))
+
+
+def read_index(path):
+    """
+    Read offsets of spectra and chromatograms from the index of indexedmzML file
+    :param path: path to mzml file
+    :return: dict {'spectrum': [(id, offset), ...], 'chromatogram': [...]} or None if there is no index
+    """
+    with open(path, 'rb') as file:
+        file.seek(0, 2)
+        size = file.tell()
+        file.seek(max(size - 4096, 0))
+        match = re.search(rb'<indexListOffset>\s*(\d+)\s*</indexListOffset>', file.read())
+        if match is None:
+            return None
+        offset = int(match.group(1))
+        if offset >= size:
+            return None
+        file.seek(offset)
+        index_list = file.read(size - offset)
+    if not index_list.lstrip().startswith(b'<indexList'):
+        return None  # wrong offset
+    index = {}
+    for name, content in re.findall(rb'<index\s+name="([^"]*)"[^>]*>(.*?)</index>', index_list, re.S):
+        index[name.decode()] = [(idRef.decode(), int(value)) for idRef, value in
+                                re.findall(rb'<offset\s+idRef="([^"]*)"[^>]*>\s*(\d+)\s*</offset>', content)]
+    return index
+
+
+def read_element(path, offset, tag, chunk_size=65536):
+    """
+    Parse one element (e.g. spectrum or chromatogram) starting at offset in mzml file
+    :param path: path to mzml file
+    :param offset: offset of the element (from the index)
+    :param tag: tag of the element
+    :return: xml element
+    """
+    end = f'</{tag}>'.encode()
+    data = b''
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                raise ValueError(f'{tag} at {offset} is not closed')
+            data += chunk
+            pos = data.find(end, max(len(data) - len(chunk) - len(end), 0))
+            if pos != -1:
+                break
+    return ET.fromstring(data[:pos + len(end)])
+
+
+def _decode_array(binary_data_array):
+    """
+    :return: (array type accession, unit, values) or None if encoding is not supported (e.g. numpress)
+    """
+    dtype, compression, array_type, unit = None, None, None, None
+    text = ''
+    for child in binary_data_array:
+        if _tag(child) == 'cvParam':
+            accession = child.get('accession')
+            if accession == FLOAT_32:
+                dtype = '<f4'
+            elif accession == FLOAT_64:
+                dtype = '<f8'
+            elif accession in (ZLIB, NO_COMPRESSION):
+                compression = accession
+            elif accession in (TIME_ARRAY, INTENSITY_ARRAY):
+                array_type, unit = accession, _unit(child)
+        elif _tag(child) == 'binary':
+            text = child.text or ''
+    if dtype is None or compression is None:
+        return None
+    data = base64.b64decode(text)
+    if compression == ZLIB:
+        data = zlib.decompress(data)
+    return array_type, unit, np.frombuffer(data, dtype=dtype).astype(np.float64)
+
+
+def file_content(path, chunk_size=1 << 20):
+    """
+    Read cvParams of fileContent (types of spectra in the file) from the header of mzml file
+    :param path: path to mzml file
+    :return: set of accessions or None if there is no fileContent in the beginning of file
+    """
+    with open(path, 'rb') as file:
+        match = re.search(rb'<fileContent>(.*?)</fileContent>', file.read(chunk_size), re.S)
+    if match is None:
+        return None
+    return {accession.decode() for accession in re.findall(rb'accession="([^"]*)"', match.group(1))}
+
+
+def tic_from_chromatogram(path):
+    """
+    Read TIC chromatogram of indexedmzML file (random access, spectra are not read).
+    The chromatogram includes MSn spectra, so it is used only if fileContent declares MS1 spectra only
+    :param path: path to mzml file
+    :return: (time, tic, time unit) or None if there is no TIC chromatogram in the index or the file
+        can have MSn spectra
+    """
+    content = file_content(path)
+    if content is None or MS1_SPECTRUM not in content or MSN_SPECTRUM in content:
+        return None
+    index = read_index(path)
+    if index is None:
+        return None
+    for _, offset in index.get('chromatogram', []):
+        chromatogram = read_element(path, offset, 'chromatogram')
+        if not any(_tag(child) == 'cvParam' and child.get('accession') == TIC_CHROMATOGRAM
+                   for child in chromatogram):
+            continue
+        arrays = {}
+        for binary_data_array in chromatogram.iter():
+            if _tag(binary_data_array) == 'binaryDataArray':
+                decoded = _decode_array(binary_data_array)
+                if decoded is None:
+                    return None
+                arrays[decoded[0]] = decoded
+        if TIME_ARRAY not in arrays or INTENSITY_ARRAY not in arrays:
+            return None
+        _, unit, time = arrays[TIME_ARRAY]
+        return time, arrays[INTENSITY_ARRAY][2], unit
+    return None
+
+
+def tic_from_headers(path):
+    """
+    Read TIC of MS1 spectra from the cvParams of spectrum headers (binary arrays are not decoded)
+    :param path: path to mzml file
+    :return: (time, tic, time unit) or None if some MS1 spectrum has no TIC or scan time
+    """
+    time, tic = [], []
+    t_measure = None
+    spectrum_list = None
+    ms_level, total, scan_time = None, None, None
+    for event, element in ET.iterparse(path, events=('start', 'end')):
+        tag = _tag(element)
+        if event == 'start':
+            if tag == 'spectrumList':
+                spectrum_list = element
+            elif tag == 'spectrum':
+                ms_level, total, scan_time = None, None, None
+            elif tag == 'chromatogramList':
+                break
+            continue
+        if tag == 'cvParam':
+            accession = element.get('accession')
+            if accession == MS_LEVEL:
+                ms_level = int(element.get('value'))
+            elif accession == TOTAL_ION_CURRENT:
+                total = float(element.get('value'))
+            elif accession == SCAN_START_TIME and scan_time is None:
+                scan_time = float(element.get('value'))
+                if not t_measure:
+                    t_measure = _unit(element)
+        elif tag == 'binary':
+            element.clear()  # peak arrays are not needed
+        elif tag == 'spectrum':
+            if ms_level == 1:
+                if total is None or scan_time is None:
+                    return None
+                time.append(scan_time)
+                tic.append(total)
+            if spectrum_list is not None:
+                spectrum_list.clear()  # keep memory low
+    if not time:
+        return None
+    return np.array(time), np.array(tic), t_measure
+
+
+_probes = {}  # (path, mtime, size) -> result of probe_run
+
+
+def _scan_start_time(spectrum_text):
+    """
+    :param spectrum_text: text of spectrum element (may be not closed)
+    :return: (scan time, time unit) or None
+    """
+    cv_param = re.search(rb'<cvParam[^>]*accession="' + SCAN_START_TIME.encode() + rb'"[^>]*>', spectrum_text)
+    if cv_param is None:
+        return None
+    cv_param = cv_param.group(0).decode()
+    value = re.search(r'\svalue="([^"]*)"', cv_param)
+    unit_accession = re.search(r'unitAccession="([^"]*)"', cv_param)
+    unit_name = re.search(r'unitName="([^"]*)"', cv_param)
+    unit = UNITS.get(unit_accession.group(1)) if unit_accession else None
+    if unit is None and unit_name:
+        unit = unit_name.group(1)
+    return float(value.group(1)), unit
+
+
+def _probe_tail(path, chunk_size=1 << 20):
+    """
+    Read the number of spectra from spectrumList and the scan time of the last spectrum from the end of file
+    """
+    with open(path, 'rb') as file:
+        match = re.search(rb'<spectrumList\s[^>]*count="(\d+)"', file.read(chunk_size))
+        if match is None:
+            return None
+        spectrum_count = int(match.group(1))
+        file.seek(0, 2)
+        size = file.tell()
+        file.seek(max(size - chunk_size, 0))
+        tail = file.read()
+    begin = tail.rfind(b'<spectrum ')
+    if begin == -1:
+        return None
+    scan_time = _scan_start_time(tail[begin:])
+    if scan_time is None:
+        return None
+    return spectrum_count, scan_time[0], scan_time[1]
+
+
+def probe_run(path, progress_callback=None):
+    """
+    Get the number of spectra and the scan time of the last spectrum (total time of the run)
+    :param path: path to mzml file
+    :return: (spectrum count, scan time, time unit)
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key in _probes:
+        return _probes[key]
+
+    result = None
+    cached = open_cached(path)
+    if cached is not None and cached.meta.get('last_scan_time'):
+        t, measure = cached.meta['last_scan_time']
+        result = cached.spectrum_count, t, measure
+    if result is None:
+        index = read_index(path)
+        if index and index.get('spectrum'):
+            _, offset = index['spectrum'][-1]
+            last = read_element(path, offset, 'spectrum')
+            for cv_param in last.iter():
+                if _tag(cv_param) == 'cvParam' and cv_param.get('accession') == SCAN_START_TIME:
+                    result = len(index['spectrum']), float(cv_param.get('value')), _unit(cv_param)
+                    break
+    if result is None:
+        result = _probe_tail(path)
+    if result is None:  # read all spectra
+        run = pymzml.run.Reader(path)
+        spectrum_count = run.get_spectrum_count()
+        t, measure = 0, 'second'
+        for n, spectrum in enumerate(run):
+            if spectrum.ID == spectrum_count:
+                t, measure = spectrum.scan_time
+            if progress_callback is not None and not n % 10:
+                progress_callback.emit(int(n * 100 / spectrum_count))
+        result = spectrum_count, t, measure
+    _probes[key] = result
+    return result
+
+
+def describe_run(spectrum_count, t, measure):
+    """
+    Text with total time and scan frequency of the run (saved as description of ROIs)
+    :return: 'total time = {t}{unit}, freq = {frequency}Hz'
+    """
+    if measure == 'millisecond':
+        measure = 'ms'
+        frequency = spectrum_count / t * 1000
+    elif measure == 'minute':
+        measure = 'min'
+        frequency = spectrum_count / t / 60
+    elif measure == 'hour':
+        measure = 'h'
+        frequency = spectrum_count / t / 360
+    else:
+        measure = 's'
+        frequency = spectrum_count / t
+    t = "{:.3f}".format(t)
+    frequency = "{:.2f}".format(frequency)
+
+    time = str(t)
+    freq = str(frequency)
+    return 'total time = ' + time + measure + ', freq = ' + freq + 'Hz'
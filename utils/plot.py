@@ -1,18 +1,50 @@
+import os
+import sys
 from functools import partial
+import numpy as np
 from PyQt5 import QtWidgets, QtGui, QtCore
 from utils.show_list import ClickableListWidget, FileListWidget, PeakListWidget, ProgressBarsListItem, ProgressBarsList
 from utils.roi import construct_tic, construct_eic
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
-from utils.threading import Worker
+from utils.threading import Worker, ProcessWorker, JobScheduler
+from utils.eic_index import open_eic_index, build_eic_index
+from utils.scan_cache import release
+from utils import instrumentation
+
+
+def decimate(x, y, x_min, x_max, buckets):
+    """
+    Min/max decimation of a trace for the visible range: every bucket (about one pixel wide)
+    keeps its minimum and maximum points, so peaks look the same as at full resolution
+    :param x: sorted x values (retention time)
+    :param y: y values
+    :param x_min: left limit of the visible range
+    :param x_max: right limit of the visible range
+    :param buckets: number of buckets (width of axes in pixels)
+    :return: x and y of the decimated trace
+    """
+    begin = max(np.searchsorted(x, x_min, 'left') - 1, 0)  # the neighbours keep the line to the border
+    end = min(np.searchsorted(x, x_max, 'right') + 1, len(x))
+    x, y = x[begin:end], y[begin:end]
+    if len(x) <= 4 * buckets:
+        return x, y
+    size = -(-len(x) // buckets)
+    n = len(x) // size * size
+    rows = y[:n].reshape(-1, size)
+    offsets = np.arange(0, n, size)
+    indices = np.concatenate((offsets + rows.argmin(axis=1), offsets + rows.argmax(axis=1),
+                              np.arange(n, len(x)), [0, len(x) - 1]))
+    indices = np.unique(indices)  # sorted, so the line goes through the points in order
+    return x[indices], y[indices]
 
 
 class PlotWindow(QtWidgets.QWidget):
     def __init__(self):
         super().__init__()
 
-        self._thread_pool = QtCore.QThreadPool()
+        self._scheduler = JobScheduler(parent=self)  # threads (interactive and batch lanes) and processes
         self._pb_list = ProgressBarsList(self)
         self._plotted_list = []
 
@@ -24,19 +56,57 @@ class PlotWindow(QtWidgets.QWidget):
         self._ax.set_ylabel('Intensity')
         self._ax.ticklabel_format(axis='y', scilimits=(0, 0))
         self._label2line = dict()  # a label (aka line name) to plotted line
+        self._label2data = dict()  # a label to full resolution (x, y) of the line
         self._canvas = FigureCanvas(self._figure)
         self._toolbar = NavigationToolbar(self._canvas, self)
-
-    def run_thread(self, caption: str, worker: Worker, text=None, icon=None):
+        # handlers are connected once (the canvas is kept when the figure is cleared)
+        self._canvas.mpl_connect('scroll_event', self.scroll_event)  # 鼠标滚轮缩放画布
+        self._canvas.mpl_connect('button_press_event', self.button_press)  # 右键清空画布
+        self._canvas.mpl_connect('draw_event', self._blit_lines)
+
+    def run_thread(self, caption: str, worker: Worker, text=None, icon=None, lane='batch', key=None):
+        """
+        Run the worker (Worker in a thread, ProcessWorker in a process) with a progress bar
+        (with cancel button if the worker is cancellable)
+        :param lane: 'interactive' (plotting) or 'batch' (long jobs)
+        :param key: identity of the job, the same job isn't started twice while it is running
+        :return: False if the same job is already running
+        """
+        if self._scheduler.is_running(key):
+            return False
         pb = ProgressBarsListItem(caption, parent=self._pb_list)
         self._pb_list.addItem(pb)
         worker.signals.progress.connect(pb.setValue)
         worker.signals.operation.connect(pb.setLabel)
+        worker.signals.error.connect(partial(self._job_failed, pb=pb))
         worker.signals.finished.connect(partial(self._threads_finisher,
                                                 text=text, icon=icon, pb=pb))
-        self._thread_pool.start(worker)
+        if worker.cancellable:
+            pb.connectCancel(partial(self._scheduler.cancel, worker))
+        return self._scheduler.submit(worker, lane, key)
+
+    def run_process(self, caption: str, worker: ProcessWorker, text=None, icon=None, key=None):
+        return self.run_thread(caption, worker, text, icon, key=key)
+
+    def cache_file(self, path):
+        if open_eic_index(path) is None:  # convert MS1 data to binary sidecar and EIC index once
+            release(path)  # an outdated copy is replaced by the job (it can't be removed while it is open)
+            worker = ProcessWorker(build_eic_index, path, cancellable=True)
+            self.run_process(f'缓存文件：{os.path.basename(path)}', worker, key=('cache', path))
+
+    def closeEvent(self, event):
+        self._scheduler.shutdown()
+        super().closeEvent(event)
+
+    def _job_failed(self, error, pb=None):
+        exctype, value, details = error
+        sys.stderr.write(details)  # the traceback is also shown by the progress bar
+        if pb is not None:
+            pb.setError(str(value) or exctype.__name__, details)
 
     def _threads_finisher(self, text=None, icon=None, pb=None):
+        if pb is not None and pb.failed:
+            return  # the error is shown until the item is closed
         if pb is not None:
             self._pb_list.removeItem(pb)
             pb.setParent(None)
@@ -54,6 +124,8 @@ class PlotWindow(QtWidgets.QWidget):
         self._feature_parameters = parameters
 
     def scroll_event(self, event):  # 滚轮缩放
+        if event.inaxes is None:
+            return
         x_min, x_max = event.inaxes.get_xlim()
         x_range = (x_max - x_min) / 10
         if event.button == 'up':
@@ -74,12 +146,14 @@ class PlotWindow(QtWidgets.QWidget):
             print(self._plotted_list, 'event in')
             self._ax.cla()
             self._label2line.clear()
+            self._label2data.clear()
             self._plotted_list.clear()
             print(self._plotted_list, 'event end')
             self._canvas.draw_idle()
 
     def plotter(self, obj):
-        if not self._label2line:  # in case if 'feature' was plotted
+        new_axes = not self._label2line
+        if new_axes:  # in case if 'feature' was plotted
             self._figure.clear()
             self._ax = self._figure.add_subplot(111)
             self._ax.set_title('TIC diagram')
@@ -87,13 +161,37 @@ class PlotWindow(QtWidgets.QWidget):
             self._ax.set_ylabel('Intensity')
             self._ax.ticklabel_format(axis='y', scilimits=(0, 0))  # 使用科学计数法
 
-        line = self._ax.plot(obj['x'], obj['y'], label=obj['label'])
-        self._label2line[obj['label']] = line[0]  # save line
+        x = np.asarray(obj['x'], dtype=np.float64)
+        if isinstance(obj['label'], str):
+            traces = [(obj['y'], obj['label'])]
+        else:  # several EICs extracted in one pass (matrix of traces)
+            traces = zip(obj['y'], obj['label'])
+        for y, label in traces:
+            y = np.asarray(y, dtype=np.float64)
+            # lines are drawn by _blit_lines (decimated for the visible range) after the rest of figure
+            line = self._ax.plot(x, y, label=label, animated=True)
+            self._label2line[label] = line[0]  # save line
+            self._label2data[label] = (x, y)
         self._ax.legend(loc='best')
-        self._figure.tight_layout()
-        self._figure.canvas.mpl_connect('scroll_event', self.scroll_event)  # 鼠标滚轮缩放画布
-        self._figure.canvas.mpl_connect('button_press_event', self.button_press)  # 右键清空画布
-        self._canvas.draw()
+        if new_axes:
+            self._figure.tight_layout()
+        with instrumentation.timer('plot.draw'):
+            self._canvas.draw()
+
+    def _blit_lines(self, event=None):
+        """
+        Draw lines decimated for the visible range on the rendered figure (axes, ticks, legend)
+        and blit them: full draw costs the same for 1 or 20 overlaid traces of any length
+        """
+        if not self._label2line:
+            return
+        x_min, x_max = self._ax.get_xlim()
+        buckets = max(int(self._ax.bbox.width), 1)
+        for label, line in self._label2line.items():
+            x, y = self._label2data[label]
+            line.set_data(*decimate(x, y, x_min, x_max, buckets))
+            self._ax.draw_artist(line)
+        self._canvas.blit(self._figure.bbox)
 
 
     def close_file(self, item):
@@ -111,6 +209,7 @@ class PlotWindow(QtWidgets.QWidget):
     def plot_feature(self, item, shifted=True):
         feature = self._list_of_features.get_feature(item)
         self._label2line = dict()  # empty plotted TIC and EIC
+        self._label2data = dict()
         self._figure.clear()
         self._ax = self._figure.add_subplot(111)
         feature.plot(self._ax, shifted=shifted)
@@ -128,46 +227,48 @@ class PlotWindow(QtWidgets.QWidget):
         if label not in self._label2line:
             path = self._list_of_files.file2path[file]
 
-            pb = ProgressBarsListItem(f'Plotting TIC: {file}', parent=self._pb_list)
-            self._pb_list.addItem(pb)
-            worker = Worker(construct_tic, path, label)
-            worker.signals.progress.connect(pb.setValue)
+            worker = Worker(construct_tic, path, label, cancellable=True)
             worker.signals.result.connect(self.plotter)
-            worker.signals.finished.connect(partial(self._threads_finisher, pb=pb))
-
-            self._thread_pool.start(worker)
-
-            self._plotted_list.append(label)
-            print(self._plotted_list)
-            print('plotted')
+            plotted = self.run_thread(f'Plotting TIC: {file}', worker, lane='interactive', key=('tic', path))
 
-            plotted = True
+            if plotted:
+                self._plotted_list.append(label)
+                print(self._plotted_list)
+                print('plotted')
         return plotted, label
 
     def plot_eic(self, file, mz, delta):
-        label = f'EIC {mz:.4f} ± {delta:.4f}: {file[:file.rfind(".")]}'
-        plotted = False
-        if label not in self._label2line:
+        """
+        :param mz: list of target m/z values
+        :param delta: list of tolerances (one per target)
+        """
+        labels, targets = [], []
+        for target_mz, target_delta in zip(mz, delta):
+            label = f'EIC {target_mz:.4f} ± {target_delta:.4f}: {file[:file.rfind(".")]}'
+            if label not in self._label2line and label not in labels:
+                labels.append(label)
+                targets.append((target_mz, target_delta))
+        plotted = bool(labels)
+        if plotted:
             path = self._list_of_files.file2path[file]
+            mz, delta = zip(*targets)
 
-            pb = ProgressBarsListItem(f'Plotting EIC (mz={mz:.4f}): {file}', parent=self._pb_list)
-            self._pb_list.addItem(pb)
-            worker = Worker(construct_eic, path, label, mz, delta)
-            worker.signals.progress.connect(pb.setValue)
+            caption = f'Plotting EIC (mz={mz[0]:.4f}): {file}' if len(mz) == 1 else \
+                f'Plotting EIC ({len(mz)} targets): {file}'
+            # one pass for all targets in a process (the GUI isn't blocked by decoding)
+            worker = ProcessWorker(construct_eic, path, labels, list(mz), list(delta), cancellable=True)
             worker.signals.result.connect(self.plotter)
-            worker.signals.finished.connect(partial(self._threads_finisher, pb=pb))
-
-            self._thread_pool.start(worker)
-
-            plotted = True
-        return plotted, label
+            plotted = self.run_thread(caption, worker, lane='interactive', key=('eic', path, tuple(labels)))
+        return plotted, labels
 
     def delete_line(self, label):
-        self._ax.lines.remove(self._label2line[label])
-        del self._label2line[label]
+        self._label2line.pop(label).remove()
+        del self._label2data[label]
 
     def refresh_canvas(self):
         if self._label2line:
+            for label, line in self._label2line.items():
+                line.set_data(*self._label2data[label])  # limits of full resolution traces
             self._ax.legend(loc='best')
             self._ax.relim()  # recompute the ax.dataLim
             self._ax.autoscale_view()  # update ax.viewLim using the new dataLim
@@ -186,11 +287,11 @@ class EICParameterWindow(QtWidgets.QDialog):
         super().__init__(self.parent)
         self.setWindowTitle('EIC plot option')
 
-        mz_layout = QtWidgets.QHBoxLayout()
+        mz_layout = QtWidgets.QVBoxLayout()
         mz_label = QtWidgets.QLabel(self)
-        mz_label.setText('m/z=')
-        self.mz_getter = QtWidgets.QLineEdit(self)
-        self.mz_getter.setText('100.000')
+        mz_label.setText('m/z (one target per line, optionally "m/z, delta"):')
+        self.mz_getter = QtWidgets.QPlainTextEdit(self)
+        self.mz_getter.setPlainText('100.000')
         mz_layout.addWidget(mz_label)
         mz_layout.addWidget(self.mz_getter)
 
@@ -211,10 +312,24 @@ class EICParameterWindow(QtWidgets.QDialog):
         layout.addWidget(plot_button)
         self.setLayout(layout)
 
+    def get_targets(self):
+        default_delta = float(self.delta_getter.text())
+        mz, delta = [], []
+        for line in self.mz_getter.toPlainText().splitlines():
+            values = line.replace(',', ' ').split()
+            if not values:
+                continue
+            if len(values) > 2:
+                raise ValueError
+            mz.append(float(values[0]))
+            delta.append(float(values[1]) if len(values) == 2 else default_delta)
+        if not mz:
+            raise ValueError
+        return mz, delta
+
     def plot(self):
         try:
-            mz = float(self.mz_getter.text())
-            delta = float(self.delta_getter.text())
+            mz, delta = self.get_targets()
             for file in self.parent.get_selected_files():
                 file = file.text()
                 self.parent.plot_eic(file, mz, delta)
@@ -1,9 +1,16 @@
 import os
 import json
+import heapq
+import bisect
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import pymzml
 import numpy as np
 from tqdm import tqdm
-from bintrees import FastAVLTree
+from utils import instrumentation
+from utils.cancel import check
+from utils.scan_cache import open_cached, read_ms1, build_cache
+from utils.mzml_meta import tic_from_chromatogram, tic_from_headers, probe_run, describe_run
+from utils.eic_index import eic_from_index
 
 
 def construct_ROI(roi_dict):
@@ -21,10 +28,16 @@ def construct_ROI(roi_dict):
                             'intensity',
                             'mz'
     """
-    return ROI(roi_dict['scan'], roi_dict['rt'], roi_dict['intensity'], roi_dict['mz'], np.mean(roi_dict['mz']))
+    return ROI(roi_dict['scan'], roi_dict['rt'], np.asarray(roi_dict['intensity'], dtype=np.float64),
+               np.asarray(roi_dict['mz'], dtype=np.float64), np.mean(roi_dict['mz']))
 
 
 class ROI:
+    """
+    Region of interest: intensities and m/z values are float64 arrays (often views into one shared buffer)
+    """
+    __slots__ = ('scan', 'rt', 'i', 'mz', 'mzmean')
+
     def __init__(self, scan, rt, i, mz, mzmean):
         self.scan = scan
         self.rt = rt
@@ -48,17 +61,103 @@ class ROI:
 
         roi['rt'] = self.rt
         roi['scan'] = self.scan
-        roi['intensity'] = list(map(float, self.i))
-        roi['mz'] = list(map(float, self.mz))
+        roi['intensity'] = np.asarray(self.i, dtype=np.float64).tolist()
+        roi['mz'] = np.asarray(self.mz, dtype=np.float64).tolist()
 
         with open(path, 'w') as jsonfile:
             json.dump(roi, jsonfile)
+            instrumentation.count('bytes_written.json', jsonfile.tell())
 
 
-class ProcessROI(ROI):
-    def __init__(self, scan, rt, i, mz, mzmean):
-        super().__init__(scan, rt, i, mz, mzmean)
-        self.points = 1
+class ROICandidates:
+    """
+    ROIs before filtering by length and intensity in columnar form (one array per column, points of all ROIs
+    are packed: ROI n has points offsets[n]:offsets[n + 1]), so thresholds can be changed without the file
+    :param dropped_points: number of 'zero' points around ROIs
+    :param begin: first scans of ROIs (without 'zero' points)
+    :param last: last scans of ROIs
+    :param points: numbers of peaks
+    :param max_i: max intensities
+    :param completed: False for ROIs which were still active in the end of file (they aren't filtered by intensity)
+    """
+    def __init__(self, dropped_points, begin, last, rt_begin, rt_last, mzmean, points, max_i, completed,
+                 offsets, i, mz):
+        self.dropped_points = dropped_points
+        self.begin = begin
+        self.last = last
+        self.rt_begin = rt_begin
+        self.rt_last = rt_last
+        self.mzmean = mzmean
+        self.points = points
+        self.max_i = max_i
+        self.completed = completed
+        self.offsets = offsets
+        self.i = i
+        self.mz = mz
+
+    def __len__(self):
+        return len(self.begin)
+
+    @classmethod
+    def empty(cls, dropped_points):
+        integers, floats = np.zeros(0, dtype=np.int64), np.zeros(0)
+        return cls(dropped_points, integers, integers, floats, floats, floats, integers, floats,
+                   np.zeros(0, dtype=bool), np.zeros(1, dtype=np.int64), floats, floats)
+
+    @property
+    def lengths(self):
+        """
+        Numbers of scans from the first to the last peak
+        """
+        return self.last - self.begin + 1
+
+    def mask(self, required_points=15, intensity_threshold=1000):
+        """
+        :return: boolean array of ROIs which get_ROIs returns with these parameters
+        """
+        return (self.points >= required_points) & (~self.completed | (self.max_i > intensity_threshold))
+
+    def take(self, indices):
+        """
+        :param indices: numbers of ROIs
+        :return: ROICandidates with these ROIs (in this order)
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        source = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return ROICandidates(self.dropped_points, self.begin[indices], self.last[indices], self.rt_begin[indices],
+                             self.rt_last[indices], self.mzmean[indices], self.points[indices], self.max_i[indices],
+                             self.completed[indices], offsets, self.i[source], self.mz[source])
+
+    @classmethod
+    def concatenate(cls, parts, dropped_points):
+        """
+        :param parts: list of ROICandidates
+        :return: ROICandidates with ROIs of all parts (in order of the parts)
+        """
+        parts = [cls.empty(dropped_points)] + list(parts)
+        columns = [np.concatenate([getattr(part, name) for part in parts])
+                   for name in ('begin', 'last', 'rt_begin', 'rt_last', 'mzmean', 'points', 'max_i', 'completed',
+                                'i', 'mz')]
+        offsets = np.concatenate([[0]] + [part.offsets[1:] + shift for part, shift in
+                                          zip(parts, np.cumsum([0] + [len(part.i) for part in parts[:-1]]))])
+        return cls(dropped_points, *columns[:-2], offsets, *columns[-2:])
+
+    def count(self, required_points=15, intensity_threshold=1000):
+        return int(np.count_nonzero(self.mask(required_points, intensity_threshold)))
+
+    def rois(self, required_points=15, intensity_threshold=1000):
+        """
+        :return: list of ROI objects (views of the packed arrays) in order of get_ROIs
+        """
+        dropped_points = self.dropped_points
+        offsets = self.offsets
+        return [ROI((int(self.begin[n]) - dropped_points, int(self.last[n]) + dropped_points),
+                    [float(self.rt_begin[n]), float(self.rt_last[n])], self.i[offsets[n]:offsets[n + 1]],
+                    self.mz[offsets[n]:offsets[n + 1]], float(self.mzmean[n]))
+                for n in np.flatnonzero(self.mask(required_points, intensity_threshold)).tolist()]
 
 
 def get_closest(mzmean, mz, pos):
@@ -71,7 +170,533 @@ def get_closest(mzmean, mz, pos):
     return res
 
 
-def get_ROIs(path, delta_mz=0.005, required_points=15, intensity_threshold=1000, dropped_points=3, progress_callback=None):
+class _Trace:
+    """
+    Active ROI which is read or changed by peaks depending on each other within one scan
+    """
+    __slots__ = ('key', 'slot', 'mzmean', 'points', 'begin', 'last', 'rt_begin', 'rt_last', 'max_i', 'id',
+                 'last_mz', 'last_i')
+
+    def __init__(self, key, slot, mzmean, points, begin, last, rt_begin, rt_last, max_i, roi_id,
+                 last_mz=None, last_i=None):
+        self.key = key
+        self.slot = slot  # index in the arrays of ROIBuilder, None for ROI started in the current scan
+        self.mzmean = mzmean
+        self.points = points
+        self.begin = begin
+        self.last = last
+        self.rt_begin = rt_begin
+        self.rt_last = rt_last
+        self.max_i = max_i
+        self.id = roi_id
+        self.last_mz = last_mz
+        self.last_i = last_i
+
+    def extend(self, mz, i, number, time):
+        self.mzmean = (self.mzmean * self.points + mz) / (self.points + 1)
+        self.points += 1
+        if self.last == number:
+            # ROI is already extended (two peaks in one mz window)
+            self.last_mz = (self.last_i * self.last_mz + i * mz) / (self.last_i + i)
+            self.last_i = self.last_i + i
+        else:
+            if self.last < number - 1:  # 'zero' points in the gap
+                self.max_i = max(self.max_i, 0)
+            self.last_mz = mz
+            self.last_i = i
+            self.last = number
+            self.rt_last = time
+
+
+class ROIBuilder:
+    """
+    Scan-by-scan ROI detection where a whole scan is matched against active ROIs at once
+
+    Active ROIs are kept in NumPy arrays sorted by key (m/z of the peak which started ROI),
+    so ceiling and floor ROIs of all peaks are found with one np.searchsorted call.
+    Peaks which read a ROI changed by an earlier peak of the same scan (collisions) are
+    resolved one by one, all the other peaks are applied in bulk. The result is the same
+    as for peak-by-peak matching with an AVL tree.
+
+    ROIs are queued by the scan where they expire (dropped_points + 1 scans after the last
+    extension), so only ROIs extended dropped_points + 1 scans ago are checked for completion.
+    'Zero' points of ROIs without peaks are not stored, they are filled in when ROIs are constructed.
+
+    Parameters
+    ----------
+    delta_mz : float
+        maximal deviation of peak m/z from ROI mean m/z
+    required_points : int
+        minimal number of points in ROI
+    intensity_threshold : float
+        ROI is saved only if its maximal intensity is higher
+    dropped_points : int
+        number of consecutive scans without peaks which completes ROI
+    keep_candidates : bool
+        keep all ROIs (not filtered by required_points and intensity_threshold), see get_candidates
+    columnar : bool
+        keep saved ROIs in columnar form (see get_candidates) instead of ROI objects, implied by keep_candidates
+    """
+    _fields = ('keys', 'mzmean', 'points', 'begin', 'last', 'rt_begin', 'rt_last', 'max_i', 'ids')
+    flush_points = 1000000  # buffered points of completed ROIs which trigger construction of ROI objects
+
+    def __init__(self, delta_mz=0.005, required_points=15, intensity_threshold=1000, dropped_points=3,
+                 keep_candidates=False, columnar=False):
+        self.delta_mz = delta_mz
+        self.required_points = required_points
+        self.intensity_threshold = intensity_threshold
+        self.dropped_points = dropped_points
+        self.keep_candidates = keep_candidates
+        self.columnar = columnar or keep_candidates
+
+        self.number = 0  # number of processed scans
+        self._next_id = 0
+        # active ROIs sorted by keys
+        self.keys = np.empty(0, dtype=np.float64)
+        self.mzmean = np.empty(0, dtype=np.float64)
+        self.points = np.empty(0, dtype=np.int64)
+        self.begin = np.empty(0, dtype=np.int64)
+        self.last = np.empty(0, dtype=np.int64)
+        self.rt_begin = np.empty(0, dtype=np.float64)
+        self.rt_last = np.empty(0, dtype=np.float64)
+        self.max_i = np.empty(0, dtype=np.float64)
+        self.ids = np.empty(0, dtype=np.int64)
+
+        self._points = []  # (ROI ids, scan, mz, intensity, mzmean after the scan): one point per extended ROI per scan
+        self._buffered_points = 0
+        self._kept_points = 0  # points of active ROIs after the last flush
+        self._expiry = {}  # scan -> (keys, ids) of ROIs which are completed in the scan if they are not extended
+        self._extended = []  # (keys, ids) of ROIs extended or started in the current scan
+        # (ROI ids, begin, last, rt_begin, rt_last, mzmean, points, max_i, completed)
+        self._completed = []
+        self._ROIs = []
+        self._candidates = []  # columns and packed points of ROIs (columnar)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add_scan(self, mz, intensity, time):
+        """
+        Extend active ROIs by peaks of the next scan, then complete ROIs without peaks
+        for more than dropped_points scans
+        """
+        self.number += 1
+        mz = np.asarray(mz, dtype=np.float64)
+        intensity = np.asarray(intensity, dtype=np.float64)
+        nonzero = intensity != 0
+        mz, intensity = mz[nonzero], intensity[nonzero]
+        if len(mz) > 1 and np.any(mz[1:] < mz[:-1]):
+            order = np.argsort(mz, kind='stable')
+            mz, intensity = mz[order], intensity[order]
+
+        instrumentation.count('roi.peaks', len(mz))
+        instrumentation.observe('roi.active', len(self.keys))
+        with instrumentation.timer('roi.match'):
+            if len(self.keys):
+                started, started_i, traces = self._match(mz, intensity, time)
+            else:  # every peak starts a new ROI (the last one of equal m/z values is kept)
+                unique = np.append(mz[1:] != mz[:-1], True) if len(mz) else np.zeros(0, dtype=bool)
+                started, started_i, traces = mz[unique], intensity[unique], ()
+        with instrumentation.timer('roi.cleanup'):
+            completed = self._expire()
+        with instrumentation.timer('roi.update'):
+            self._start(started, started_i, time, traces, completed)
+        if self._extended:
+            self._expiry[self.number + self.dropped_points + 1] = tuple(
+                np.concatenate(column) for column in zip(*self._extended))
+            self._extended = []
+        # points of completed ROIs are not needed anymore (memory doesn't grow with file length)
+        if self._buffered_points > 2 * self._kept_points + self.flush_points:
+            self._flush()
+
+    def get_ROIs(self):
+        """
+        Complete ROIs which are still active and return all found ROIs
+        :return: ROIs - a list of ROI objects
+        """
+        active = self.points >= (0 if self.keep_candidates else self.required_points)
+        max_i = self.max_i[active]
+        if self.dropped_points:  # 'zero' points in the end
+            max_i = np.where(self.last[active] < self.number, np.maximum(max_i, 0), max_i)
+        self._completed.append((self.ids[active], self.begin[active], self.last[active],
+                                self.rt_begin[active], self.rt_last[active], self.mzmean[active],
+                                self.points[active], max_i, False))
+        self._flush()
+        return self._ROIs
+
+    def get_candidates(self):
+        """
+        Complete ROIs which are still active and return all ROIs (keep_candidates) or saved ROIs (columnar)
+        :return: ROICandidates
+        """
+        self.get_ROIs()
+        columns = [np.concatenate([chunk[n] for chunk in self._candidates] + [np.empty(0, dtype=dtype)])
+                   for n, dtype in enumerate((np.int64, np.int64, np.float64, np.float64, np.float64, np.int64,
+                                              np.float64, bool, np.int64, np.float64, np.float64))]
+        lengths, i, mz = columns[-3:]
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        return ROICandidates(self.dropped_points, *columns[:-3], offsets, i, mz)
+
+    def _flush(self):
+        """
+        Construct ROI objects for completed ROIs and keep points of active ROIs only
+        """
+        with instrumentation.timer('roi.flush'):
+            self._flush_completed()
+
+    def _flush_completed(self):
+        dropped_points = self.dropped_points
+        if not self._points:
+            self._points = [(np.empty(0, dtype=np.int64), 0, np.empty(0), np.empty(0), np.empty(0))]
+        roi_ids = np.concatenate([chunk[0] for chunk in self._points])
+        order = np.argsort(roi_ids, kind='stable')
+        roi_ids = roi_ids[order]
+        scans = np.concatenate([np.broadcast_to(np.asarray(chunk[1], dtype=np.int64), chunk[0].shape)
+                                for chunk in self._points])[order]
+        mzs = np.concatenate([chunk[2] for chunk in self._points])[order]
+        intensities = np.concatenate([chunk[3] for chunk in self._points])[order]
+        means = np.concatenate([chunk[4] for chunk in self._points])[order]
+
+        for ids, begin, last, rt_begin, rt_last, mzmean, points, max_i, completed in self._completed:
+            starts = np.searchsorted(roi_ids, ids, 'left')
+            counts = np.searchsorted(roi_ids, ids, 'right') - starts
+            # one buffer for all ROIs with dropped_points 'zero' points in the begin and in the end
+            lengths = last - begin + 1 + 2 * dropped_points
+            offsets = np.concatenate(([0], np.cumsum(lengths)))
+            i = np.zeros(offsets[-1])
+            mz = np.repeat(mzmean, lengths)
+            rank = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            source = np.repeat(starts, counts) + rank
+            target = np.repeat(offsets[:-1] + dropped_points - begin, counts) + scans[source]
+            i[target] = intensities[source]
+            mz[target] = mzs[source]
+            if len(target) < np.sum(last - begin + 1):
+                # 'zero' points in the gaps of ROIs have mzmean of ROI after the previous point
+                real = np.zeros(len(mz), dtype=bool)
+                real[target] = True
+                position = np.arange(len(mz)) - np.repeat(offsets[:-1], lengths)
+                gaps = ~real & (position >= dropped_points) & (position < np.repeat(lengths - dropped_points, lengths))
+                previous = np.maximum.accumulate(np.where(real, np.arange(len(mz)), 0))
+                mean = np.zeros(len(mz))
+                mean[target] = means[source]
+                mz[gaps] = mean[previous[gaps]]
+            if self.columnar:
+                self._candidates.append((begin, last, rt_begin, rt_last, mzmean, points, max_i,
+                                         np.full(len(ids), completed), lengths, i, mz))
+                continue
+            for n in range(len(ids)):
+                roi = ROI((int(begin[n]) - dropped_points, int(last[n]) + dropped_points),
+                          [float(rt_begin[n]), float(rt_last[n])], i[offsets[n]:offsets[n + 1]],
+                          mz[offsets[n]:offsets[n + 1]], float(mzmean[n]))
+                assert roi.scan[1] - roi.scan[0] == len(roi.i) - 1
+                self._ROIs.append(roi)
+        self._completed = []
+
+        active = np.isin(roi_ids, self.ids)
+        self._points = [(roi_ids[active], scans[active], mzs[active], intensities[active], means[active])]
+        self._kept_points = self._buffered_points = np.count_nonzero(active)
+
+    def _start(self, mz, intensity, time, traces=(), completed=None):
+        """
+        Insert new ROIs started by peaks (and by traces resolved one by one) into active ROIs
+        and remove completed ROIs (the arrays are rebuilt once per scan)
+        :param completed: sorted slots of completed ROIs
+        """
+        number = self.number
+        completed = np.zeros(0, dtype=np.int64) if completed is None else completed
+        values = {'keys': mz, 'mzmean': mz,
+                  'points': np.ones(len(mz), dtype=np.int64),
+                  'begin': np.full(len(mz), number, dtype=np.int64),
+                  'last': np.full(len(mz), number, dtype=np.int64),
+                  'rt_begin': np.full(len(mz), time, dtype=np.float64),
+                  'rt_last': np.full(len(mz), time, dtype=np.float64),
+                  'max_i': intensity}
+        last_mz = mz
+        if traces:
+            rows = np.array([(t.key, t.mzmean, t.points, t.begin, t.last, t.rt_begin, t.rt_last, t.last_i, t.last_mz)
+                             for t in traces], dtype=np.float64)
+            for column, field in enumerate(values):
+                values[field] = np.concatenate([values[field], rows[:, column].astype(values[field].dtype)])
+            last_mz = np.concatenate([mz, rows[:, -1]])
+        values['ids'] = np.arange(self._next_id, self._next_id + len(values['keys']), dtype=np.int64)
+        self._next_id += len(values['keys'])
+        instrumentation.count('roi.inserted', len(values['keys']))  # insertions into the sorted active ROIs
+        if len(last_mz):
+            self._points.append((values['ids'], number, last_mz, values['max_i'], values['mzmean']))
+            self._buffered_points += len(last_mz)
+            self._extended.append((values['keys'], values['ids']))
+        if not len(last_mz) and not len(completed):
+            return
+
+        order = np.argsort(values['keys'])
+        position = np.searchsorted(self.keys, values['keys'][order])
+        position -= np.searchsorted(completed, position)  # position among the ROIs which are left
+        target = position + np.arange(len(position))
+        left = np.ones(len(self.keys) - len(completed) + len(target), dtype=bool)
+        left[target] = False
+        kept = np.ones(len(self.keys), dtype=bool)
+        kept[completed] = False
+        for field in self._fields:
+            column = np.empty(len(left), dtype=getattr(self, field).dtype)
+            column[target] = values[field][order]
+            column[left] = getattr(self, field)[kept]
+            setattr(self, field, column)
+
+    def _match(self, mz, intensity, time):
+        number = self.number
+        keys, mzmean = self.keys, self.mzmean
+        n, m = len(keys), len(mz)
+        index = np.arange(m)
+
+        # ceiling and floor ROIs in the active ROIs (before the current scan)
+        gap = np.searchsorted(keys, mz, 'left')
+        equal = keys[np.minimum(gap, n - 1)] == mz
+        has_ceiling = mz < keys[-1]
+        has_floor = mz > keys[0]
+        ceiling = np.where(has_ceiling, gap, 0)
+        floor = np.where(has_floor, gap - 1 + equal, 0)
+
+        # choose closest as if every peak was the only one in the scan
+        choose_floor = has_floor & (~has_ceiling | ((mzmean[ceiling] - mz) > (mz - mzmean[floor])))
+        closest = np.where(choose_floor, floor, ceiling)
+        matched = (has_floor | has_ceiling) & (np.abs(mzmean[closest] - mz) < self.delta_mz)
+        target = np.where(matched, closest, -1)
+        started = ~matched & ~equal  # a new ROI will be started
+
+        # peaks which read a ROI changed by an earlier peak of the same scan
+        touched = np.where(equal, gap, target)  # peak with the same m/z as key extends or replaces ROI
+        first_hit = np.full(n, m)
+        rois, first = np.unique(touched[touched >= 0], return_index=True)
+        first_hit[rois] = index[touched >= 0][first]
+        first_start = np.full(n + 1, m)  # new ROIs become floor ROIs for the next peaks in the same gap
+        gaps, first = np.unique(gap[started], return_index=True)
+        first_start[gaps] = index[started][first]
+        # new ROIs in the gap can't change the decision if the previous peak is far enough:
+        # their mzmean is not closer to the peak than delta_mz (up to the rounding of mean)
+        keeps_decision = np.ones(m, dtype=bool)
+        keeps_decision[1:] = (gap[1:] != gap[:-1]) | (mz[1:] - mz[:-1] >= self.delta_mz + 1e-10 * mz[1:])
+        keeps_decision &= (started & (~has_ceiling | (np.abs(mzmean[ceiling] - mz) >= self.delta_mz))) | \
+                          (matched & ~choose_floor)
+        dependent = equal.copy()
+        dependent |= has_floor & (first_start[gap] < index) & ~keeps_decision
+        dependent |= has_ceiling & (first_hit[ceiling] < index)
+        dependent[1:] |= mz[1:] == mz[:-1]
+        floor_hit = has_floor & (first_hit[floor] < index)
+
+        # floor ROI extended by one independent peak: repeat the decision with its new mzmean
+        # (the peak stays independent if the decision is the same and doesn't extend floor ROI)
+        second_hit = np.full(n, m)
+        hits = np.flatnonzero(touched >= 0)
+        order = hits[np.argsort(touched[hits], kind='stable')]
+        repeated = order[1:][touched[order[1:]] == touched[order[:-1]]]
+        rois, first = np.unique(touched[repeated], return_index=True)
+        second_hit[rois] = repeated[first]
+        relieved = floor_hit & ~dependent & (second_hit[floor] > index) & (target != floor)
+        relieved[relieved] &= ~(dependent | floor_hit)[first_hit[floor[relieved]]]
+        if np.any(relieved):
+            x = mz[relieved]
+            slot = floor[relieved]
+            floor_mzmean = (mzmean[slot] * self.points[slot] + mz[first_hit[slot]]) / (self.points[slot] + 1)
+            ceiling_mzmean = mzmean[ceiling[relieved]]
+            floor_closer = ~has_ceiling[relieved] | ((ceiling_mzmean - x) > (x - floor_mzmean))
+            closest_mzmean = np.where(floor_closer, floor_mzmean, ceiling_mzmean)
+            outcome = np.where(np.abs(closest_mzmean - x) < self.delta_mz,
+                               np.where(floor_closer, slot, ceiling[relieved]), -1)
+            relieved[relieved] = outcome == target[relieved]
+        dependent |= floor_hit & ~relieved
+        relied = {}  # independent peak -> relieved peaks which rely on it
+        for j, k in zip(np.flatnonzero(relieved).tolist(), first_hit[floor[relieved]].tolist()):
+            relied.setdefault(k, []).append(j)
+
+        # sequential resolution of dependent peaks
+        applied = np.zeros(m, dtype=bool)  # independent peaks applied to traces before the bulk update
+        traces = {}  # slot -> trace of active ROI changed in the current scan
+        new_traces = {}  # key -> trace of ROI started in the current scan
+        if np.any(dependent):
+            self._resolve(mz, intensity, time, gap, equal, has_floor, has_ceiling, floor, ceiling,
+                          target, started, touched, first_hit, keeps_decision, relied, dependent,
+                          applied, traces, new_traces)
+
+        # bulk update by independent peaks
+        independent = ~dependent & ~applied
+        extended = independent & matched
+        slots = target[extended]
+        points = self.points[slots]
+        mzmean[slots] = (mzmean[slots] * points + mz[extended]) / (points + 1)
+        self.points[slots] = points + 1
+        gapped = slots[self.last[slots] < number - 1]  # 'zero' points in the gap
+        self.max_i[gapped] = np.maximum(self.max_i[gapped], 0)
+        self.last[slots] = number
+        self.rt_last[slots] = time
+        self.max_i[slots] = np.maximum(self.max_i[slots], intensity[extended])
+        point_slots, point_mz, point_i = [slots], [mz[extended]], [intensity[extended]]
+
+        for slot, trace in traces.items():
+            if trace.id is None:  # replaced ROI
+                trace.id = self._next_id
+                self._next_id += 1
+                self.begin[slot] = trace.begin
+                self.rt_begin[slot] = trace.rt_begin
+                self.ids[slot] = trace.id
+            mzmean[slot] = trace.mzmean
+            self.points[slot] = trace.points
+            self.last[slot] = trace.last
+            self.rt_last[slot] = trace.rt_last
+            if trace.last == number:
+                self.max_i[slot] = max(trace.max_i, trace.last_i)
+                point_slots.append([slot])
+                point_mz.append([trace.last_mz])
+                point_i.append([trace.last_i])
+        slots = np.concatenate(point_slots).astype(np.int64)
+        self._points.append((self.ids[slots], number, np.concatenate(point_mz), np.concatenate(point_i),
+                             mzmean[slots]))
+        self._buffered_points += len(slots)
+        self._extended.append((keys[slots], self.ids[slots]))
+
+        started &= independent
+        return mz[started], intensity[started], list(new_traces.values())
+
+    def _resolve(self, mz, intensity, time, gap, equal, has_floor, has_ceiling, floor, ceiling,
+                 target, started, touched, first_hit, keeps_decision, relied, dependent, applied, traces,
+                 new_traces):
+        """
+        Process dependent peaks one by one (in the order of m/z) exactly as the AVL tree did
+        """
+        number = self.number
+        delta_mz = self.delta_mz
+        mzmean = self.mzmean
+        gap_array = gap
+        gap_begin = np.searchsorted(gap, gap, 'left').tolist()
+        gap_end = np.searchsorted(gap, gap, 'right').tolist()
+        mz, intensity, gap, equal = mz.tolist(), intensity.tolist(), gap.tolist(), equal.tolist()
+        has_floor, has_ceiling, floor, ceiling = has_floor.tolist(), has_ceiling.tolist(), floor.tolist(), ceiling.tolist()
+        target, started, touched, first_hit = target.tolist(), started.tolist(), touched.tolist(), first_hit.tolist()
+        keeps_decision = keeps_decision.tolist()
+        keys = self.keys
+        m = len(mz)
+        is_dependent = dependent.tolist()
+        is_applied = [False] * m
+        new_keys = []
+        registered = {}  # gap -> index of the next peak to check for a started ROI
+        queue = np.flatnonzero(dependent).tolist()
+
+        def get_trace(slot, before):
+            # independent peak which extends ROI before the current one should be applied first
+            k = first_hit[slot]
+            if k < before and not is_dependent[k] and not is_applied[k] and target[k] == slot:
+                if slot not in traces:
+                    traces[slot] = _Trace(keys[slot], slot, mzmean[slot], self.points[slot], self.begin[slot],
+                                          self.last[slot], self.rt_begin[slot], self.rt_last[slot],
+                                          self.max_i[slot], self.ids[slot])
+                traces[slot].extend(mz[k], intensity[k], number, time)
+                is_applied[k] = True
+            return traces.get(slot)
+
+        def add_dependent(peaks):
+            for k in peaks:
+                if not is_dependent[k]:
+                    is_dependent[k] = True
+                    heapq.heappush(queue, k)
+                    add_dependent(relied.get(k, ()))
+
+        while queue:
+            j = heapq.heappop(queue)
+            x, g = mz[j], gap[j]
+            for k in range(registered.get(g, gap_begin[j]), j):
+                if started[k] and not is_dependent[k]:
+                    new_traces[mz[k]] = _Trace(mz[k], None, mz[k], 1, number, number, time, time,
+                                               -np.inf, None, mz[k], intensity[k])
+                    bisect.insort(new_keys, mz[k])
+                    is_applied[k] = True
+            registered[g] = j
+
+            # floor and ceiling items: (key, mzmean, trace or None)
+            floor_item, ceiling_item = None, None
+            if has_floor[j]:
+                slot = floor[j]
+                trace = get_trace(slot, j)
+                floor_item = (trace.key, trace.mzmean, trace) if trace else (keys[slot], mzmean[slot], slot)
+                p = bisect.bisect_right(new_keys, x) - 1
+                if p >= 0 and new_keys[p] > floor_item[0]:
+                    trace = new_traces[new_keys[p]]
+                    floor_item = (trace.key, trace.mzmean, trace)
+            if has_ceiling[j]:
+                slot = ceiling[j]
+                trace = get_trace(slot, j)
+                ceiling_item = (trace.key, trace.mzmean, trace) if trace else (keys[slot], mzmean[slot], slot)
+                p = bisect.bisect_left(new_keys, x)
+                if p < len(new_keys) and new_keys[p] < ceiling_item[0]:
+                    trace = new_traces[new_keys[p]]
+                    ceiling_item = (trace.key, trace.mzmean, trace)
+            if ceiling_item is None:
+                closest_item = floor_item
+            elif floor_item is None:
+                closest_item = ceiling_item
+            elif ceiling_item[1] - x > x - floor_item[1]:
+                closest_item = floor_item
+            else:
+                closest_item = ceiling_item
+
+            if closest_item is not None and abs(closest_item[1] - x) < delta_mz:
+                trace = closest_item[2]
+                if not isinstance(trace, _Trace):
+                    slot = trace
+                    trace = traces[slot] = _Trace(keys[slot], slot, mzmean[slot], self.points[slot],
+                                                  self.begin[slot], self.last[slot], self.rt_begin[slot],
+                                                  self.rt_last[slot], self.max_i[slot], self.ids[slot])
+                trace.extend(x, intensity[j], number, time)
+                slot = trace.slot
+            elif equal[j]:  # new ROI replaces the old one with the same key
+                slot = g
+                get_trace(slot, j)
+                traces[slot] = _Trace(x, slot, x, 1, number, number, time, time, -np.inf, None, x, intensity[j])
+            else:
+                if x not in new_traces:
+                    bisect.insort(new_keys, x)
+                new_traces[x] = _Trace(x, None, x, 1, number, number, time, time, -np.inf, None, x, intensity[j])
+                slot = None
+
+            # the next peaks which read changed ROI (if it was not expected)
+            if slot is not None and slot != touched[j]:
+                begin = max(j + 1, np.searchsorted(gap_array, slot, 'left'))
+                end = np.searchsorted(gap_array, slot + 2, 'left')
+                add_dependent(k for k in range(begin, end) if (has_floor[k] and floor[k] == slot) or
+                              (has_ceiling[k] and ceiling[k] == slot))
+            elif slot is None and not started[j]:
+                add_dependent(k for k in range(j + 1, gap_end[j]) if has_floor[k] and not keeps_decision[k])
+
+        for slot in list(traces):
+            get_trace(slot, m)
+        dependent[:] = is_dependent
+        applied[:] = is_applied
+
+    def _expire(self):
+        """
+        Complete ROIs queued for the current scan which were not extended since they were queued
+        :return: sorted slots of completed ROIs (they are removed by _start)
+        """
+        queued = self._expiry.pop(self.number, None)
+        if queued is None or not len(self.keys):
+            return np.zeros(0, dtype=np.int64)
+        keys, ids = queued
+        slots = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        # ROIs extended later are queued again, replaced ROIs have new ids
+        slots = np.sort(slots[(self.ids[slots] == ids) & (self.last[slots] == self.number - self.dropped_points - 1)])
+        if len(slots):
+            max_i = self.max_i[slots]
+            if self.dropped_points:  # 'zero' points in the end
+                max_i = np.maximum(max_i, 0)
+            saved = np.ones(len(slots), dtype=bool) if self.keep_candidates else \
+                (self.points[slots] >= self.required_points) & (max_i > self.intensity_threshold)
+            rois = slots[saved]
+            self._completed.append((self.ids[rois], self.begin[rois], self.last[rois], self.rt_begin[rois],
+                                    self.rt_last[rois], self.mzmean[rois], self.points[rois], max_i[saved], True))
+            instrumentation.count('roi.removed', len(slots))
+        return slots
+
+
+def get_ROIs(path, delta_mz=0.005, required_points=15, intensity_threshold=1000, dropped_points=3, progress_callback=None,
+             cancel_token=None, candidates=False):
     '''
     :param path: path to mzml file
     :param delta_mz:
@@ -79,155 +704,273 @@ def get_ROIs(path, delta_mz=0.005, required_points=15, intensity_threshold=1000,
     :param dropped_points: can be zero points
     :param intensity_threshold:
     :param pbar: an pyQt5 progress bar to visualize
+    :param cancel_token: CancelToken checked before every scan (Cancelled is raised)
+    :param candidates: return ROICandidates with all ROIs (required_points and intensity_threshold are applied
+        later by ROICandidates.rois)
     :return: ROIs - a list of ROI objects found in current file
     '''
-    # read all scans in mzML file
-    run = pymzml.run.Reader(path)
-    scans = []
-    for scan in run:
-        if scan.ms_level == 1:
-            scans.append(scan)
-
-    ROIs = []  # completed ROIs
-    process_ROIs = FastAVLTree()  # processed ROIs
-
-    # initialize a processed data
-    number = 1  # number of processed scan
-    init_scan = scans[0]
-    start_time = init_scan.scan_time[0]
-
-    min_mz = max(init_scan.mz)
-    max_mz = min(init_scan.mz)
-    for mz, i in zip(init_scan.mz, init_scan.i):
-        if i != 0:
-            process_ROIs[mz] = ProcessROI([1, 1],
-                                          [start_time, start_time],
-                                          [i],
-                                          [mz],
-                                          mz)
-            min_mz = min(min_mz, mz)
-            max_mz = max(max_mz, mz)
-
-    for scan in tqdm(scans):
-        if number == 1:  # already processed scan
-            number += 1
-            continue
-        # expand ROI
-        for n, mz in enumerate(scan.mz):
-            if scan.i[n] != 0:
-                ceiling_mz, ceiling_item = None, None
-                floor_mz, floor_item = None, None
-                if mz < max_mz:
-                    _, ceiling_item = process_ROIs.ceiling_item(mz)
-                    ceiling_mz = ceiling_item.mzmean
-                if mz > min_mz:
-                    _, floor_item = process_ROIs.floor_item(mz)
-                    floor_mz = floor_item.mzmean
-                # choose closest
-                if ceiling_mz is None and floor_mz is None:
-                    time = scan.scan_time[0]
-                    process_ROIs[mz] = ProcessROI([number, number],
-                                                  [time, time],
-                                                  [scan.i[n]],
-                                                  [mz],
-                                                  mz)
-                    continue
-                elif ceiling_mz is None:
-                    closest_mz, closest_item = floor_mz, floor_item
-                elif floor_mz is None:
-                    closest_mz, closest_item = ceiling_mz, ceiling_item
-                else:
-                    if ceiling_mz - mz > mz - floor_mz:
-                        closest_mz, closest_item = floor_mz, floor_item
-                    else:
-                        closest_mz, closest_item = ceiling_mz, ceiling_item
-
-                if abs(closest_item.mzmean - mz) < delta_mz:
-                    roi = closest_item
-                    if roi.scan[1] == number:
-                        # ROIs is already extended (two peaks in one mz window)
-                        roi.mzmean = (roi.mzmean * roi.points + mz) / (roi.points + 1)
-                        roi.points += 1
-                        roi.mz[-1] = (roi.i[-1]*roi.mz[-1] + scan.i[n]*mz) / (roi.i[-1] + scan.i[n])
-                        roi.i[-1] = (roi.i[-1] + scan.i[n])
-                    else:
-                        roi.mzmean = (roi.mzmean * roi.points + mz) / (roi.points + 1)
-                        roi.points += 1
-                        roi.mz.append(mz)
-                        roi.i.append(scan.i[n])
-                        roi.scan[1] = number  # show that we extended the roi
-                        roi.rt[1] = scan.scan_time[0]
-                else:
-                    time = scan.scan_time[0]
-                    process_ROIs[mz] = ProcessROI([number, number],
-                                                  [time, time],
-                                                  [scan.i[n]],
-                                                  [mz],
-                                                  mz)
-        # Check and cleanup
-        to_delete = []
-        for mz, roi in process_ROIs.items():
-            if roi.scan[1] < number <= roi.scan[1] + dropped_points:
-                # insert 'zero' in the end
-                roi.mz.append(roi.mzmean)
-                roi.i.append(0)
-            elif roi.scan[1] != number:
-                to_delete.append(mz)
-                if roi.points >= required_points:
-                    if max(roi.i) > intensity_threshold:
-                        ROIs.append(ROI(
-                            roi.scan,
-                            roi.rt,
-                            roi.i,
-                            roi.mz,
-                            roi.mzmean
-                        ))
-                    # else:  # 调试信息
-                    #     print(max(roi.i))
-        process_ROIs.remove_items(to_delete)
-        try:
-            min_mz, _ = process_ROIs.min_item()
-            max_mz, _ = process_ROIs.max_item()
-        except ValueError:
-            min_mz = float('inf')
-            max_mz = 0
-        number += 1
-        if progress_callback is not None and not number % 10:
-            progress_callback.emit(int(number * 100 / len(scans)))
-    # add final rois
-    for mz, roi in process_ROIs.items():
-        if roi.points >= required_points:
-            for n in range(dropped_points - (number - 1 - roi.scan[1])):
-                # insert 'zero' in the end
-                roi.mz.append(roi.mzmean)
-                roi.i.append(0)
-            ROIs.append(ROI(
-                        roi.scan,
-                        roi.rt,
-                        roi.i,
-                        roi.mz,
-                        roi.mzmean
-                        ))
-    # expand constructed roi
-    for roi in ROIs:
-        for n in range(dropped_points):
-            # insert in the begin
-            roi.i.insert(0, 0)
-            roi.mz.insert(0, roi.mzmean)
-        # change scan numbers (necessary for future matching)
-        roi.scan = (roi.scan[0] - dropped_points, roi.scan[1] + dropped_points)
-        assert roi.scan[1] - roi.scan[0] == len(roi.i) - 1
-    # print(ROIs)
-    return ROIs
-
-
-def construct_tic(path, label, progress_callback=None):
+    # scans are processed while reading mzML file (only active ROIs are kept in memory)
+    builder = ROIBuilder(delta_mz, required_points, intensity_threshold, dropped_points, keep_candidates=candidates)
+    for mz, i, scan_time in tqdm(read_ms1(path, progress_callback, cancel_token)):
+        builder.add_scan(mz, i, scan_time[0])
+    rois = builder.get_candidates() if candidates else builder.get_ROIs()
+    instrumentation.count('roi.found', len(rois))
+    return rois
+
+
+def read_run(path, progress_callback=None, cancel_token=None):
+    """
+    All MS1 peaks of mzml file as flat arrays (the whole run is kept in memory)
+    :param path: path to mzml file
+    :param cancel_token: CancelToken checked before every scan (Cancelled is raised)
+    :return: (scan numbers of peaks (from 1), m/z, intensities, retention times of scans)
+    """
+    cached = open_cached(path)
+    if cached is not None:
+        check(cancel_token)
+        instrumentation.count('scans', len(cached))
+        scan = np.repeat(np.arange(1, len(cached) + 1), np.diff(cached.offsets))
+        return scan, np.array(cached.mz), np.array(cached.i), np.array(cached.rt, dtype=np.float64)
+
+    scans, mzs, intensities, rt = [], [], [], []
+    for number, (mz, i, scan_time) in enumerate(read_ms1(path, progress_callback, cancel_token), 1):
+        mzs.append(np.asarray(mz, dtype=np.float64))
+        intensities.append(np.asarray(i, dtype=np.float64))
+        scans.append(np.full(len(mzs[-1]), number))
+        rt.append(scan_time[0])
+    if not rt:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0), np.zeros(0)
+    return np.concatenate(scans), np.concatenate(mzs), np.concatenate(intensities), np.array(rt, dtype=np.float64)
+
+
+def cluster_ROIs(path, delta_mz=0.005, required_points=15, intensity_threshold=1000, dropped_points=3,
+                 progress_callback=None, cancel_token=None, candidates=False):
+    """
+    ROI detection on the whole run at once (vectorized, no loop over peaks): all peaks are sorted by m/z,
+    split into clusters where the gap between neighbouring m/z values is larger than delta_mz and
+    the clusters are split into ROIs where more than dropped_points scans in a row have no peaks.
+    Peaks of one scan in a cluster are merged as in get_ROIs (intensities are summed, m/z is weighted).
+    ROIs are comparable with get_ROIs (the same layout with zero points around, the same filters),
+    but not identical: get_ROIs assigns a peak to the closest ROI, here close m/z values are chained.
+    :param path: path to mzml file
+    :param cancel_token: CancelToken checked before every scan and between stages
+    :param candidates: return ROICandidates with all ROIs (see get_ROIs)
+    :return: ROIs - a list of ROI objects found in current file (in order of completion as in get_ROIs)
+    """
+    scan, mz, i, rt = read_run(path, progress_callback, cancel_token)
+    n_scans = len(rt)
+    with instrumentation.timer('roi.cluster'):
+        nonzero = i != 0
+        scan, mz, i = scan[nonzero], mz[nonzero], i[nonzero]
+        instrumentation.count('roi.peaks', len(mz))
+        if not len(mz):
+            return ROICandidates.empty(dropped_points) if candidates else []
+        order = np.argsort(mz, kind='stable')
+        scan, mz, i = scan[order], mz[order], i[order]
+        cluster = np.concatenate(([0], np.cumsum(np.diff(mz) > delta_mz)))
+        check(cancel_token)
+
+        # peaks of a cluster in order of scans, peaks of the same scan are merged into one point
+        order = np.lexsort((scan, cluster))
+        scan, mz, i, cluster = scan[order], mz[order], i[order], cluster[order]
+        first = np.flatnonzero(np.concatenate(([True], (cluster[1:] != cluster[:-1]) | (scan[1:] != scan[:-1]))))
+        point_scan, point_cluster = scan[first], cluster[first]
+        point_i = np.add.reduceat(i, first)
+        point_mz = np.add.reduceat(i * mz, first) / point_i
+        peaks = np.diff(np.append(first, len(mz)))
+        check(cancel_token)
+
+        # ROI is completed after dropped_points scans without peaks
+        starts = np.concatenate(([True], (point_cluster[1:] != point_cluster[:-1]) |
+                                 (point_scan[1:] - point_scan[:-1] > dropped_points + 1)))
+        roi_first = np.flatnonzero(starts)
+        roi = np.cumsum(starts) - 1
+        n_points = np.add.reduceat(peaks, roi_first)
+        mzmean = np.add.reduceat(np.add.reduceat(mz, first), roi_first) / n_points
+        max_i = np.maximum.reduceat(point_i, roi_first)
+        begin = point_scan[roi_first]
+        last = point_scan[np.append(roi_first[1:], len(first)) - 1]
+        completed = last + dropped_points + 1 <= n_scans  # the others are still active in the end of file
+        if candidates:
+            ids = np.arange(len(roi_first))
+        else:
+            ids = np.flatnonzero((n_points >= required_points) & (~completed | (max_i > intensity_threshold)))
+        # order of get_ROIs: by scan of completion, then by m/z of the first peak
+        ids = ids[np.lexsort((mz[first[roi_first[ids]]], np.minimum(last[ids] + dropped_points + 1, n_scans + 1)))]
+        check(cancel_token)
+
+        # one buffer for all ROIs with dropped_points 'zero' points in the begin and in the end
+        lengths = last[ids] - begin[ids] + 1 + 2 * dropped_points
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        slot = np.full(len(roi_first), -1)
+        slot[ids] = np.arange(len(ids))
+        kept = slot[roi] >= 0
+        buffer_i = np.zeros(offsets[-1])
+        buffer_mz = np.repeat(mzmean[ids], lengths)
+        target = offsets[slot[roi[kept]]] + dropped_points + point_scan[kept] - begin[roi[kept]]
+        buffer_i[target] = point_i[kept]
+        buffer_mz[target] = point_mz[kept]
+        found = ROICandidates(dropped_points, begin[ids], last[ids], rt[begin[ids] - 1], rt[last[ids] - 1],
+                              mzmean[ids], n_points[ids], max_i[ids], completed[ids], offsets, buffer_i, buffer_mz)
+        rois = found if candidates else found.rois(required_points, intensity_threshold)
+    if progress_callback is not None:
+        progress_callback.emit(100)
+    instrumentation.count('roi.found', len(rois))
+    return rois
+
+
+MAX_BAND_BINS = 1 << 22  # histogram of mz_bands is coarser than delta_mz for very wide m/z ranges
+
+
+def mz_bands(path, delta_mz, n_bands):
+    """
+    Split m/z axis of cached file into bands with about equal numbers of peaks. Bands are cut only in the middle
+    of gaps without peaks (in all scans) wider than 2 * delta_mz: a peak is farther than delta_mz from
+    any peak (and any ROI) of another band, so bands don't interact in get_ROIs. Dense runs (e.g. with
+    a lot of noise) can have no such gaps, then there is one band
+    :param path: path to mzml file (it should be cached)
+    :param n_bands: wanted number of bands (there are less if there aren't enough gaps)
+    :return: list of (low, high) m/z ranges of bands (low <= m/z < high)
+    """
+    cached = open_cached(path)
+    if n_bands < 2 or cached is None or not len(cached.mz):
+        return [(-np.inf, np.inf)]
+    mz, chunk = cached.mz, 1 << 24  # memory-mapped m/z of all peaks are read in chunks
+    mz0 = min(float(np.min(mz[n:n + chunk])) for n in range(0, len(mz), chunk))
+    mz1 = max(float(np.max(mz[n:n + chunk])) for n in range(0, len(mz), chunk))
+    width = max(delta_mz, (mz1 - mz0) / MAX_BAND_BINS)  # gaps of two empty bins are still wider than 2 * delta_mz
+    counts = np.zeros(int((mz1 - mz0) // width) + 1, dtype=np.int64)
+    for n in range(0, len(mz), chunk):
+        nonzero = np.asarray(cached.i[n:n + chunk]) != 0  # zero peaks are skipped by get_ROIs
+        bins = np.minimum(((mz[n:n + chunk][nonzero] - mz0) // width).astype(np.int64), len(counts) - 1)
+        counts += np.bincount(bins, minlength=len(counts))
+
+    empty = counts == 0
+    gaps = np.flatnonzero(empty[:-1] & empty[1:]) + 1  # cuts between two empty bins
+    if not len(gaps):
+        return [(-np.inf, np.inf)]
+    below = np.cumsum(counts)[gaps - 1]  # numbers of peaks below the cuts
+    targets = counts.sum() * np.arange(1, n_bands) / n_bands
+    right = np.minimum(np.searchsorted(below, targets), len(gaps) - 1)
+    left = np.maximum(right - 1, 0)
+    chosen = np.unique(np.where(targets - below[left] < below[right] - targets, left, right))
+    edges = [-np.inf] + (mz0 + width * gaps[chosen]).tolist() + [np.inf]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _band_ROIs(path, low, high, delta_mz, required_points, intensity_threshold, dropped_points, candidates):
+    """
+    get_ROIs for peaks with low <= m/z < high only.
+    Floor (ceiling) ROI is looked for only if peak is above the first (below the last) active ROI, so ROIs
+    of other bands are replaced with 'sentinel' ROIs: a sentinel peak (farther than delta_mz from the band)
+    is added below (above) the band in every scan with peaks below (above) the band
+    :return: (number of scans, ROICandidates)
+    """
+    builder = ROIBuilder(delta_mz, required_points, intensity_threshold, dropped_points, keep_candidates=candidates,
+                         columnar=True)  # columns are sent to the main process much faster than ROI objects
+    below, above = low - 2 * delta_mz, high + 2 * delta_mz
+    for mz, i, scan_time in read_ms1(path):
+        mz, i = np.asarray(mz, dtype=np.float64), np.asarray(i, dtype=np.float64)
+        band = (mz >= low) & (mz < high)
+        band_mz, band_i = mz[band], i[band]
+        nonzero = i != 0
+        if np.any(nonzero & (mz < low)):
+            band_mz, band_i = np.append(below, band_mz), np.append(1., band_i)
+        if np.any(nonzero & (mz >= high)):
+            band_mz, band_i = np.append(band_mz, above), np.append(band_i, 1.)
+        builder.add_scan(band_mz, band_i, scan_time[0])
+
+    rois = builder.get_candidates()
+    return builder.number, rois.take(np.flatnonzero((rois.mzmean >= low) & (rois.mzmean < high)))
+
+
+def parallel_ROIs(path, delta_mz=0.005, required_points=15, intensity_threshold=1000, dropped_points=3,
+                  progress_callback=None, cancel_token=None, candidates=False, jobs=None):
+    """
+    get_ROIs in several processes: the file is decoded once to the scan cache, m/z axis is split into bands
+    which don't interact (see mz_bands) and every band is processed by its own ROIBuilder.
+    ROIs are identical to get_ROIs and in the same order (by scan of completion, then by m/z of the first peak:
+    bands are sorted by m/z, so a stable sort of ROIs of all bands by scan of completion restores it).
+    :param path: path to mzml file
+    :param cancel_token: CancelToken checked while decoding and between bands (running bands are left to finish)
+    :param candidates: return ROICandidates with all ROIs (see get_ROIs)
+    :param jobs: number of processes and bands (number of CPUs by default, one - get_ROIs in this process,
+        e.g. when it is called in a process of another pool)
+    :return: ROIs - a list of ROI objects found in current file
+    """
+    jobs = jobs or os.cpu_count() or 1
+    build_cache(path, progress_callback=progress_callback, cancel_token=cancel_token)
+    bands = mz_bands(path, delta_mz, jobs)
+    if len(bands) == 1:
+        return get_ROIs(path, delta_mz, required_points, intensity_threshold, dropped_points, progress_callback,
+                        cancel_token, candidates)
+
+    results = [None] * len(bands)
+    executor = ProcessPoolExecutor(len(bands))
+    try:
+        futures = {executor.submit(_band_ROIs, path, low, high, delta_mz, required_points, intensity_threshold,
+                                   dropped_points, candidates): n for n, (low, high) in enumerate(bands)}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            check(cancel_token)
+            for future in done:
+                results[futures[future]] = future.result()
+            if progress_callback is not None and done:
+                progress_callback.emit(int(100 * (len(bands) - len(pending)) / len(bands)))
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    with instrumentation.timer('roi.stitch'):
+        n_scans = results[0][0]
+        rois = ROICandidates.concatenate([part for _, part in results], dropped_points)
+        completion = np.where(rois.completed, rois.last + dropped_points + 1, n_scans + 1)
+        rois = rois.take(np.argsort(completion, kind='stable'))
+        if not candidates:
+            rois = rois.rois(required_points, intensity_threshold)
+    instrumentation.count('roi.found', len(rois))
+    return rois
+
+
+# ROI detection algorithms: name -> function with the arguments of get_ROIs
+ROI_ENGINES = {'scan': get_ROIs, 'cluster': cluster_ROIs, 'parallel': parallel_ROIs}
+
+
+def described_ROIs(engine, path, delta_mz=0.005, required_points=15, intensity_threshold=1000, dropped_points=3,
+                   progress_callback=None, cancel_token=None, **options):
+    """
+    ROIs of one file of batch generation with the description of its run (the same as in roi_cli)
+    :param engine: name of ROI detection algorithm (see ROI_ENGINES)
+    :param options: other arguments of the algorithm (e.g. jobs of the parallel engine)
+    :return: (ROIs, 'total time = ..., freq = ..., intensity_thr = ...')
+    """
+    rois = ROI_ENGINES[engine](path, delta_mz, required_points, intensity_threshold, dropped_points, progress_callback,
+                               cancel_token, **options)
+    return rois, describe_run(*probe_run(path)) + ', intensity_thr = ' + str(intensity_threshold)
+
+
+def construct_tic(path, label, progress_callback=None, cancel_token=None):
+    cached = open_cached(path)
+    if cached is not None:
+        time = cached.rt / 60 if cached.time_unit == 'second' else cached.rt
+        return {'x': time.tolist(), 'y': cached.tic.tolist(), 'label': label}
+
+    # metadata (TIC chromatogram or spectrum headers) is read without decoding of peak arrays
+    tic = tic_from_chromatogram(path) or tic_from_headers(path)
+    if tic is not None:
+        time, tic, t_measure = tic
+        time = time / 60 if t_measure == 'second' else time
+        return {'x': time.tolist(), 'y': tic.tolist(), 'label': label}
+
     run = pymzml.run.Reader(path)
     t_measure = None
     time = []
     tic = []
     spectrum_count = run.get_spectrum_count()
     for i, scan in enumerate(run):
+        check(cancel_token)
         if scan.ms_level == 1:
             tic.append(scan.TIC)  # get total ion of scan
             t, measure = scan.scan_time  # get scan time
@@ -241,26 +984,53 @@ def construct_tic(path, label, progress_callback=None):
     return {'x': time, 'y': tic, 'label': label}
 
 
-def construct_eic(path, label, mz, delta, progress_callback=None):
-    run = pymzml.run.Reader(path)
+def construct_eic(path, label, mz, delta, progress_callback=None, cancel_token=None):
+    """
+    Extract EICs of one or several targets in one pass through the file
+    :param path: path to mzml file
+    :param label: label of EIC (a list of labels in case of several targets)
+    :param mz: target m/z (or a vector of target m/z values)
+    :param delta: tolerance (or a vector of tolerances, one per target)
+    :param cancel_token: CancelToken checked before every scan (Cancelled is raised)
+    :return: dict with retention times ('x') and intensities ('y'), 'y' is a matrix (targets x scans)
+        in case of several targets
+    """
+    single = np.ndim(mz) == 0
+    mz = np.atleast_1d(np.asarray(mz, dtype=np.float64))
+    delta = np.broadcast_to(np.asarray(delta, dtype=np.float64), mz.shape)
+
+    indexed = eic_from_index(path, mz, delta)  # built in background when the file is opened
+    if indexed is not None:
+        time, eic, t_measure = indexed
+        time = (time / 60).tolist() if t_measure == 'second' else time.tolist()
+        return {'x': time, 'y': eic[0] if single else eic, 'label': label}
+
     t_measure = None
     time = []
     eic = []
-    spectrum_count = run.get_spectrum_count()
-    for i, scan in enumerate(run):
-        if scan.ms_level == 1:
-            t, measure = scan.scan_time  # get scan time
-            time.append(t)
-            pos = np.searchsorted(scan.mz, mz)
-            closest = get_closest(scan.mz, mz, pos)
-            if abs(scan.mz[closest] - mz) < delta:
-                eic.append(scan.i[closest])
-            else:
-                eic.append(0)
-            if not t_measure:
-                t_measure = measure
-            if progress_callback is not None and not i % 10:
-                progress_callback.emit(int(i * 100 / spectrum_count))
+    for scan_mz, scan_i, (t, measure) in read_ms1(path, progress_callback, cancel_token):
+        time.append(t)
+        eic.append(_extract_intensities(scan_mz, scan_i, mz, delta))
+        if not t_measure:
+            t_measure = measure
     if t_measure == 'second':
         time = np.array(time) / 60
+    eic = np.array(eic).reshape(len(time), len(mz)).T
+    if single:
+        return {'x': time, 'y': eic[0], 'label': label}
     return {'x': time, 'y': eic, 'label': label}
+
+
+def _extract_intensities(scan_mz, scan_i, mz, delta):
+    """
+    Intensities of the closest peaks to each of target m/z (0 if the closest peak is farther than delta)
+    """
+    scan_mz = np.asarray(scan_mz)
+    n = len(scan_mz)
+    if n == 0:
+        return np.zeros(len(mz))
+    pos = np.searchsorted(scan_mz, mz)
+    left = np.maximum(pos - 1, 0)
+    right = np.minimum(pos, n - 1)
+    closest = np.where((pos == 0) | ((pos < n) & (scan_mz[right] - mz < mz - scan_mz[left])), right, left)
+    return np.where(np.abs(scan_mz[closest] - mz) < delta, np.asarray(scan_i)[closest], 0)
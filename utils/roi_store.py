@@ -0,0 +1,604 @@
+import os
+import json
+import sqlite3
+import time
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from utils import instrumentation
+
+
+STORE_FILENAME = 'rois.sqlite'
+INDEX_FILENAME = '.roi_index.sqlite'  # label index of json files
+
+
+def _annotation(code, label=0, number_of_peaks=0, peaks_score=None, borders=None, drop_points=3,
+                description=None):
+    """
+    Annotation part of ROI dict (the same keys as in json files)
+    """
+    return {'code': code, 'label': label, 'number of peaks': number_of_peaks,
+            "peaks' score": [] if peaks_score is None else peaks_score,
+            'borders': [] if borders is None else borders,
+            'description': description, 'drop points': drop_points}
+
+
+class JSONFolder:
+    """
+    ROIs saved as separate json files ({prefix}_{n}.json) in a folder.
+    Labels are kept in an index (INDEX_FILENAME) which is built once and updated on save
+    (files which were added, changed or removed by other programs are found by modification time).
+    :param folder: path to the folder
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self._index = None
+
+    def _numbered(self):
+        files = []
+        for created_file in os.listdir(self.folder):
+            if created_file.endswith('.json'):
+                files.append((self._number(created_file), created_file))
+        return files
+
+    @staticmethod
+    def _number(name):
+        return int(name[name.rfind('_') + 1:name.find('.json')])
+
+    def _modified(self):
+        """
+        :return: dict {name: modification time in ns} of json files
+        """
+        with os.scandir(self.folder) as entries:
+            return {entry.name: entry.stat().st_mtime_ns for entry in entries if entry.name.endswith('.json')}
+
+    def names(self):
+        """
+        :return: names of ROIs (json files) sorted by their number
+        """
+        return [file for _, file in sorted(self._numbered())]
+
+    @property
+    def index(self):
+        """
+        Label index synchronized with the list of json files (only new files are read)
+        """
+        if self._index is None:
+            try:
+                self._index = self._open_index(os.path.join(self.folder, INDEX_FILENAME))
+            except sqlite3.Error:  # read-only folder
+                self._index = self._open_index(':memory:')
+            files = self._modified()
+            indexed = dict(self._index.execute('SELECT name, mtime FROM labels'))
+            rows = []
+            for name, mtime in files.items():
+                if indexed.get(name) != mtime:  # new or changed file
+                    roi = self.load(name)
+                    rows.append((name, self._number(name), roi['label'], json.dumps(roi["peaks' score"]), mtime))
+            with self._index:
+                self._index.executemany('DELETE FROM labels WHERE name = ?',
+                                        ((name,) for name in indexed.keys() - files.keys()))
+                self._index.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?, ?)', rows)
+        return self._index
+
+    @staticmethod
+    def _open_index(path):
+        index = sqlite3.connect(path)
+        with index:
+            columns = [row[1] for row in index.execute('PRAGMA table_info(labels)')]
+            if columns and 'mtime' not in columns:  # index of the previous version is rebuilt
+                index.execute('DROP TABLE labels')
+            index.execute('CREATE TABLE IF NOT EXISTS labels '
+                          '(name TEXT PRIMARY KEY, number INTEGER, label, peaks_score TEXT, mtime INTEGER)')
+        return index
+
+    def name(self, code):
+        return f'{code}.json'
+
+    def code(self, name):
+        return name[:name.rfind('.')]
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def load(self, name):
+        with open(self.path(name)) as json_file:
+            return json.load(json_file)
+
+    def count(self):
+        return self.index.execute('SELECT COUNT(*) FROM labels').fetchone()[0]
+
+    def labels(self, offset=0, limit=-1):
+        """
+        :return: list of (name, label) sorted by number of ROI
+        """
+        return self.index.execute('SELECT name, label FROM labels ORDER BY number, name LIMIT ? OFFSET ?',
+                                  (limit, offset)).fetchall()
+
+    def annotation(self, name):
+        """
+        :return: (label, peaks' score) of ROI from the index
+        """
+        row = self.index.execute('SELECT label, peaks_score FROM labels WHERE name = ?', (name,)).fetchone()
+        return ('unmarked', []) if row is None else (row[0], json.loads(row[1]))
+
+    def annotations(self):
+        """
+        :return: generator of (label, peaks' score) of all ROIs (from the index, json files are not read)
+        """
+        for label, peaks_score in self.index.execute('SELECT label, peaks_score FROM labels'):
+            yield label, json.loads(peaks_score)
+
+    def add(self, rois, file_prefix, label='unmarked', drop_points=3, description=None):
+        rows = []
+        for file_suffix, roi in enumerate(rois):
+            name = self.name(f'{file_prefix}_{file_suffix}')
+            roi.save_annotated(self.path(name), self.code(name), label,
+                               drop_points=drop_points, description=description)
+            rows.append((name, file_suffix, label, '[]', os.stat(self.path(name)).st_mtime_ns))
+        if self._index is not None:  # otherwise the files are indexed when the index is opened
+            with self._index:
+                self._index.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?, ?)', rows)
+
+    def save(self, name, roi, label=0, number_of_peaks=0, peaks_score=None, borders=None, drop_points=3,
+             description=None):
+        self.save_many([(name, roi, label, number_of_peaks, peaks_score, borders, drop_points, description)])
+
+    def save_many(self, records):
+        """
+        Save annotations: every file is written to a temporary file and renamed (a file is never half-written),
+        files are synced before renaming and the folder once after it
+        :param records: tuples of arguments of save
+        """
+        rows = []
+        renames = []
+        for name, roi, label, number_of_peaks, peaks_score, borders, drop_points, description in records:
+            path = self.path(name)
+            roi.save_annotated(path + '.tmp', self.code(name), label, number_of_peaks, peaks_score, borders,
+                               drop_points, description)
+            fd = os.open(path + '.tmp', os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            renames.append((path + '.tmp', path))
+            rows.append([name, self._number(name), label, json.dumps([] if peaks_score is None else peaks_score)])
+        for (tmp_path, path), row in zip(renames, rows):
+            os.replace(tmp_path, path)
+            row.append(os.stat(path).st_mtime_ns)
+        if hasattr(os, 'O_DIRECTORY'):  # renames are durable after sync of the folder (POSIX)
+            fd = os.open(self.folder, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        with self.index:
+            self.index.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?, ?)', rows)
+
+    def delete(self, name):
+        os.remove(self.path(name))
+        with self.index:
+            self.index.execute('DELETE FROM labels WHERE name = ?', (name,))
+
+    def close(self):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+
+class ROIStore:
+    """
+    ROIs saved in one SQLite file: packed m/z and intensity arrays and an annotation row per ROI.
+    Each update of annotation is a separate transaction.
+    :param path: path to the store file (created if it doesn't exist)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.folder = os.path.dirname(path)
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS rois (
+                    id INTEGER PRIMARY KEY,
+                    code TEXT UNIQUE NOT NULL,
+                    label,  -- 0 (noise), 1 (peak) or 'unmarked'
+                    number_of_peaks INTEGER,
+                    peaks_score TEXT,
+                    borders TEXT,
+                    description TEXT,
+                    drop_points INTEGER,
+                    scan_begin INTEGER,
+                    scan_end INTEGER,
+                    rt_begin REAL,
+                    rt_end REAL,
+                    mzmean REAL,
+                    intensity BLOB,
+                    mz BLOB
+                )""")
+            self.connection.execute('CREATE INDEX IF NOT EXISTS rois_label ON rois (label)')
+
+    def names(self):
+        return [code for code, in self.connection.execute('SELECT code FROM rois ORDER BY id')]
+
+    def name(self, code):
+        return code
+
+    def code(self, name):
+        return name
+
+    def load(self, name):
+        row = self.connection.execute(
+            'SELECT code, label, number_of_peaks, peaks_score, borders, description, drop_points, '
+            'rt_begin, rt_end, scan_begin, scan_end, intensity, mz FROM rois WHERE code = ?', (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        code, label, number_of_peaks, peaks_score, borders, description, drop_points, \
+            rt_begin, rt_end, scan_begin, scan_end, intensity, mz = row
+        roi = _annotation(code, label, number_of_peaks, json.loads(peaks_score), json.loads(borders),
+                          drop_points, description)
+        roi['rt'] = [rt_begin, rt_end]
+        roi['scan'] = [scan_begin, scan_end]
+        roi['intensity'] = np.frombuffer(intensity, dtype=np.float64).tolist()
+        roi['mz'] = np.frombuffer(mz, dtype=np.float64).tolist()
+        return roi
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM rois').fetchone()[0]
+
+    def labels(self, offset=0, limit=-1):
+        """
+        :return: list of (name, label) sorted by number of ROI
+        """
+        return self.connection.execute('SELECT code, label FROM rois ORDER BY id LIMIT ? OFFSET ?',
+                                       (limit, offset)).fetchall()
+
+    def annotation(self, name):
+        row = self.connection.execute('SELECT label, peaks_score FROM rois WHERE code = ?', (name,)).fetchone()
+        return ('unmarked', []) if row is None else (row[0], json.loads(row[1]))
+
+    def annotations(self):
+        for label, peaks_score in self.connection.execute('SELECT label, peaks_score FROM rois'):
+            yield label, json.loads(peaks_score)
+
+    @staticmethod
+    def _row(roi, annotation):
+        return (annotation['code'], annotation['label'], annotation['number of peaks'],
+                json.dumps(annotation["peaks' score"]), json.dumps(annotation['borders']),
+                annotation['description'], annotation['drop points'],
+                int(roi.scan[0]), int(roi.scan[1]), float(roi.rt[0]), float(roi.rt[1]), float(roi.mzmean),
+                np.asarray(roi.i, dtype=np.float64).tobytes(), np.asarray(roi.mz, dtype=np.float64).tobytes())
+
+    def _insert(self, rows):
+        if instrumentation.enabled():
+            rows = list(rows)
+            instrumentation.count('store.rows', len(rows))
+            instrumentation.count('bytes_written.store', sum(len(row[-1]) + len(row[-2]) for row in rows))
+        with instrumentation.timer('store.insert'), self.connection:  # one transaction
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO rois (code, label, number_of_peaks, peaks_score, borders, description, '
+                'drop_points, scan_begin, scan_end, rt_begin, rt_end, mzmean, intensity, mz) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def add(self, rois, file_prefix, label='unmarked', drop_points=3, description=None):
+        self._insert(self._row(roi, _annotation(f'{file_prefix}_{file_suffix}', label, drop_points=drop_points,
+                                                description=description))
+                     for file_suffix, roi in enumerate(rois))
+
+    def save(self, name, roi, label=0, number_of_peaks=0, peaks_score=None, borders=None, drop_points=3,
+             description=None):
+        self.save_many([(name, roi, label, number_of_peaks, peaks_score, borders, drop_points, description)])
+
+    def save_many(self, records):
+        """
+        Save annotations in one transaction (one sync of the file)
+        :param records: tuples of arguments of save
+        """
+        with instrumentation.timer('store.save'), self.connection:
+            for name, roi, label, number_of_peaks, peaks_score, borders, drop_points, description in records:
+                annotation = _annotation(name, label, number_of_peaks, peaks_score, borders, drop_points,
+                                         description)
+                updated = self.connection.execute(
+                    'UPDATE rois SET label = ?, number_of_peaks = ?, peaks_score = ?, borders = ?, description = ?, '
+                    'drop_points = ? WHERE code = ?',
+                    (label, number_of_peaks, json.dumps(annotation["peaks' score"]),
+                     json.dumps(annotation['borders']), description, drop_points, name)).rowcount
+                if not updated:
+                    self.connection.execute(
+                        'INSERT INTO rois (code, label, number_of_peaks, peaks_score, borders, description, '
+                        'drop_points, scan_begin, scan_end, rt_begin, rt_end, mzmean, intensity, mz) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self._row(roi, annotation))
+
+    def delete(self, name):
+        with self.connection:
+            self.connection.execute('DELETE FROM rois WHERE code = ?', (name,))
+
+    def close(self):
+        self.connection.close()
+
+
+def score_counts(label, peaks_score):
+    """
+    Scores of one ROI for the histogram: 0 for noise and score of each peak for peaks
+    :return: Counter {score: count}
+    """
+    if label == 0:
+        return Counter([0])
+    if label == 1:
+        return Counter(peaks_score)
+    return Counter()
+
+
+def open_rois(folder):
+    """
+    Open ROIs in the folder: ROIStore if the folder has a store file, otherwise json files
+    :param folder: path to the folder
+    :return: ROIStore or JSONFolder
+    """
+    path = os.path.join(folder, STORE_FILENAME)
+    if os.path.isfile(path):
+        return ROIStore(path)
+    return JSONFolder(folder)
+
+
+class Prefetcher:
+    """
+    Loads ROIs (dict and ROI object) in a background thread before they are shown.
+    The thread has its own connection to the store (sqlite connections can't be shared between threads).
+    :param folder: folder with ROIs (see open_rois)
+    :param size: max number of kept ROIs
+    """
+    def __init__(self, folder, size=32):
+        self.folder = folder
+        self.size = size
+        self._executor = ThreadPoolExecutor(1)
+        self._local = threading.local()
+        self._futures = {}  # name -> future of (roi dict, ROI), in order of requests
+
+    def _load(self, name, store=None):
+        from utils.roi import construct_ROI
+
+        if store is None:
+            if getattr(self._local, 'store', None) is None:
+                self._local.store = open_rois(self.folder)
+            store = self._local.store
+        roi = store.load(name)
+        return roi, construct_ROI(roi)
+
+    def prefetch(self, names):
+        """
+        Start loading of ROIs which aren't loaded yet
+        """
+        for name in names:
+            if name is not None and name not in self._futures:
+                self._futures[name] = self._executor.submit(self._load, name)
+        while len(self._futures) > self.size:
+            future = self._futures.pop(next(iter(self._futures)))
+            future.cancel()
+
+    def get(self, name, store):
+        """
+        :param store: store of the calling thread to load ROI which wasn't prefetched
+        :return: (roi dict, ROI) - prefetched (waits if loading is in progress) or loaded now
+        """
+        future = self._futures.pop(name, None)
+        if future is not None and not future.cancelled():
+            try:
+                result = future.result()
+                self._futures[name] = future  # the most recently used
+                return result
+            except (OSError, KeyError, ValueError):  # deleted or changed after the request
+                pass
+        return self._load(name, store)
+
+    def invalidate(self, name):
+        """
+        Forget the prefetched ROI (after its annotation was saved or it was deleted)
+        """
+        future = self._futures.pop(name, None)
+        if future is not None:
+            future.cancel()
+
+    def close(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._executor.submit(self._close_store)
+        self._executor.shutdown(wait=False)
+
+    def _close_store(self):
+        store = getattr(self._local, 'store', None)
+        if store is not None:
+            store.close()
+            self._local.store = None
+
+
+class WriteBehind:
+    """
+    Saves annotations in a background thread. The latest annotation of every ROI is kept in memory
+    until it is written; saves collected during `delay` are written together (one transaction / sync).
+    Failed saves are kept and retried with the next save (or flush).
+    :param folder: folder with ROIs (see open_rois), the thread has its own connection to the store
+    :param delay: seconds to collect saves into one batch
+    """
+    def __init__(self, folder, delay=0.2):
+        self.folder = folder
+        self.delay = delay
+        self._pending = {}  # name -> arguments of save (the latest one)
+        self._writing = {}  # the batch which is being written
+        self._failed = {}  # name -> arguments of save
+        self.error = None  # the last exception
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, name, roi, label=0, number_of_peaks=0, peaks_score=None, borders=None, drop_points=3,
+             description=None):
+        with self._condition:
+            self._pending.update(self._failed)  # retry failed saves
+            self._failed.clear()
+            self._pending.pop(name, None)
+            self._pending[name] = (name, roi, label, number_of_peaks, peaks_score, borders, drop_points, description)
+            self._condition.notify_all()
+
+    def _record(self, name):
+        return self._pending.get(name) or self._writing.get(name) or self._failed.get(name)
+
+    def annotation(self, name):
+        """
+        :return: (label, peaks' score) of not written annotation or None
+        """
+        with self._condition:
+            record = self._record(name)
+        if record is None:
+            return None
+        return record[2], [] if record[4] is None else record[4]
+
+    def annotated(self, name, roi):
+        """
+        :param roi: ROI dict loaded from the store
+        :return: the dict with not written annotation of ROI (if there is one)
+        """
+        with self._condition:
+            record = self._record(name)
+        if record is not None:
+            _, _, label, number_of_peaks, peaks_score, borders, drop_points, description = record
+            roi.update(_annotation(roi['code'], label, number_of_peaks, peaks_score, borders, drop_points,
+                                   description))
+        return roi
+
+    def status(self):
+        """
+        :return: (number of not written annotations, number of failed ones)
+        """
+        with self._condition:
+            return len(self._pending) + len(self._writing), len(self._failed)
+
+    def discard(self, name):
+        """
+        Forget not written annotation of ROI (e.g. it is deleted) and wait if it is being written
+        """
+        with self._condition:
+            self._pending.pop(name, None)
+            self._failed.pop(name, None)
+            while name in self._writing:
+                self._condition.wait()
+
+    def flush(self, timeout=None):
+        """
+        Retry failed saves and wait until everything is written
+        :return: number of failed saves
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._pending.update(self._failed)
+            self._failed.clear()
+            self._condition.notify_all()
+            while self._pending or self._writing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return len(self._failed) + len(self._pending) + len(self._writing)
+
+    def close(self, timeout=None):
+        """
+        Write pending saves and stop the thread
+        :return: number of saves which weren't written
+        """
+        failed = self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        return failed
+
+    def _run(self):
+        store = None
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed and not self._pending:
+                    break
+                if not self._closed:
+                    self._condition.wait(self.delay)  # collect more saves into the batch
+                self._writing, self._pending = self._pending, {}
+                batch = list(self._writing.values())
+            try:
+                if store is None:
+                    store = open_rois(self.folder)
+                store.save_many(batch)
+                failed = None
+            except (OSError, sqlite3.Error, ValueError) as exception:
+                failed = exception
+                if store is not None:
+                    try:
+                        store.close()
+                    except sqlite3.Error:
+                        pass
+                    store = None  # reconnect on retry (e.g. network drive was disconnected)
+            with self._condition:
+                if failed is not None:
+                    self.error = failed
+                    for name, record in self._writing.items():
+                        if name not in self._pending:  # a newer annotation is saved anyway
+                            self._failed[name] = record
+                self._writing = {}
+                self._condition.notify_all()
+        if store is not None:
+            store.close()
+
+
+def json_to_store(folder, path=None):
+    """
+    Convert json files of the folder to one store file
+    :param folder: folder with json files
+    :param path: path to the store (STORE_FILENAME in the folder by default)
+    :return: path to the store
+    """
+    from utils.roi import construct_ROI
+
+    path = os.path.join(folder, STORE_FILENAME) if path is None else path
+    source = JSONFolder(folder)
+    store = ROIStore(path)
+    rows = []
+    for name in source.names():
+        roi = source.load(name)
+        annotation = _annotation(roi.get('code') or source.code(name), roi['label'], roi['number of peaks'],
+                                 roi["peaks' score"], roi['borders'], roi['drop points'], roi['description'])
+        rows.append(ROIStore._row(construct_ROI(roi), annotation))
+    store._insert(rows)
+    store.close()
+    return path
+
+
+def store_to_json(path, folder=None):
+    """
+    Convert store file to json files (one file per ROI)
+    :param path: path to the store
+    :param folder: folder for json files (the folder of the store by default)
+    :return: folder with json files
+    """
+    folder = os.path.dirname(path) if folder is None else folder
+    os.makedirs(folder, exist_ok=True)
+    store = ROIStore(path)
+    for name in store.names():
+        roi = store.load(name)
+        with open(os.path.join(folder, f'{name}.json'), 'w') as jsonfile:
+            json.dump(roi, jsonfile)
+    store.close()
+    return folder
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert ROIs between json files and one store file')
+    parser.add_argument('direction', choices=['to-json', 'from-json'])
+    parser.add_argument('folder', help='folder with json files or with the store file')
+    args = parser.parse_args()
+    if args.direction == 'to-json':
+        print(store_to_json(os.path.join(args.folder, STORE_FILENAME)))
+    else:
+        print(json_to_store(args.folder))
@@ -0,0 +1,139 @@
+"""
+Parameter sweep of ROI detection: the file is decoded once (to the scan cache), then every
+combination of delta_mz and dropped_points is evaluated in parallel on the memory-mapped scans;
+required_points and intensity_threshold only filter ROI candidates of the combination.
+
+    python -m utils.roi_sweep data/run.mzML --delta-mz 0.003 0.005 0.01 --required-points 10 15 \
+        --dropped-points 2 3 --intensity-threshold 1000 5000 --jobs 8 --output sweep.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from utils.roi import ROI_ENGINES
+from utils.scan_cache import build_cache
+
+PARAMETERS = ('delta_mz', 'required_points', 'dropped_points', 'intensity_threshold')
+
+
+def parameter_grid(delta_mz, required_points, dropped_points, intensity_threshold):
+    """
+    :return: list of dicts with every combination of the values (arguments of get_ROIs)
+    """
+    return [dict(zip(PARAMETERS, values))
+            for values in itertools.product(delta_mz, required_points, dropped_points, intensity_threshold)]
+
+
+def roi_statistics(lengths):
+    """
+    :param lengths: lengths of ROIs (scans from the first to the last peak)
+    :return: dict with number of ROIs and distribution of their lengths
+    """
+    if not len(lengths):
+        return {'rois': 0}
+    p25, median, p75, p90 = np.percentile(lengths, [25, 50, 75, 90])
+    return {'rois': len(lengths), 'length_min': int(lengths.min()), 'length_p25': float(p25),
+            'length_median': float(median), 'length_mean': float(lengths.mean()), 'length_p75': float(p75),
+            'length_p90': float(p90), 'length_max': int(lengths.max())}
+
+
+def evaluate(path, delta_mz, dropped_points, thresholds, engine='scan', jobs=None):
+    """
+    Run ROI detection once (scans are read from the cache) and filter ROI candidates by every threshold
+    :param thresholds: list of (required_points, intensity_threshold)
+    :param jobs: number of processes of the parallel engine (number of CPUs by default)
+    :return: list of dicts with the parameters, ROI statistics and seconds of detection
+    """
+    start = time.perf_counter()
+    options = {'jobs': jobs} if engine == 'parallel' else {}
+    candidates = ROI_ENGINES[engine](path, delta_mz, dropped_points=dropped_points, candidates=True, **options)
+    seconds = time.perf_counter() - start
+    lengths = candidates.lengths
+    return [dict(delta_mz=delta_mz, required_points=required_points, dropped_points=dropped_points,
+                 intensity_threshold=intensity_threshold, engine=engine, seconds=seconds,
+                 **roi_statistics(lengths[candidates.mask(required_points, intensity_threshold)]))
+            for required_points, intensity_threshold in thresholds]
+
+
+def sweep(path, grid, engine='scan', jobs=None, callback=None):
+    """
+    Evaluate every set of parameters of the grid on one file
+    :param path: path to mzml file
+    :param grid: list of dicts with arguments of get_ROIs (see parameter_grid)
+    :param engine: name of ROI detection algorithm (see ROI_ENGINES)
+    :param jobs: number of processes (number of CPUs by default)
+    :param callback: called with the result of every set of parameters as soon as it is ready
+    :return: (seconds of decoding, list of results in order of the grid)
+    """
+    start = time.perf_counter()
+    build_cache(path)  # the only pass through mzml file
+    decode_seconds = time.perf_counter() - start
+
+    groups = {}  # (delta_mz, dropped_points) -> numbers of parameter sets
+    for n, parameters in enumerate(grid):
+        groups.setdefault((parameters['delta_mz'], parameters['dropped_points']), []).append(n)
+    results = [None] * len(grid)
+    jobs = jobs or os.cpu_count() or 1
+    group_jobs = min(jobs, len(groups))
+    band_jobs = max(1, jobs // group_jobs)  # processes of the parallel engine in every process of the pool
+    with ProcessPoolExecutor(group_jobs) as executor:
+        futures = {executor.submit(evaluate, path, delta_mz, dropped_points,
+                                   [(grid[n]['required_points'], grid[n]['intensity_threshold']) for n in numbers],
+                                   engine, band_jobs): numbers
+                   for (delta_mz, dropped_points), numbers in groups.items()}
+        for future in as_completed(futures):
+            for n, result in zip(futures[future], future.result()):
+                results[n] = result
+                if callback is not None:
+                    callback(result)
+    return decode_seconds, results
+
+
+def format_result(result):
+    text = ', '.join(f'{name} = {result[name]}' for name in PARAMETERS)
+    text += f": {result['rois']} ROIs"
+    if result['rois']:
+        text += f", length median {result['length_median']:g} (p90 {result['length_p90']:g}, " \
+                f"max {result['length_max']})"
+    return text + f", {result['seconds']:.2f} s"
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Evaluate a grid of ROI parameters on one mzML file')
+    parser.add_argument('path', help='mzML file')
+    parser.add_argument('--delta-mz', type=float, nargs='+', default=[0.005], help='m/z deviations')
+    parser.add_argument('--required-points', type=int, nargs='+', default=[15], help='minimum lengths of ROI')
+    parser.add_argument('--dropped-points', type=int, nargs='+', default=[3],
+                        help='numbers of zero points which end ROI')
+    parser.add_argument('--intensity-threshold', type=int, nargs='+', default=[1000],
+                        help='minimum intensities of ROI')
+    parser.add_argument('--engine', choices=sorted(ROI_ENGINES), default='scan', help='ROI detection algorithm')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='number of processes')
+    parser.add_argument('--output', help='write results to this json file')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    grid = parameter_grid(args.delta_mz, args.required_points, args.dropped_points, args.intensity_threshold)
+    start = time.perf_counter()
+    decode_seconds, results = sweep(args.path, grid, args.engine, args.jobs,
+                                    callback=lambda result: print(format_result(result)))
+    total_seconds = time.perf_counter() - start
+    print(f'{len(grid)} parameter sets in {total_seconds:.1f} s (decoding {decode_seconds:.1f} s)')
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'path': os.path.abspath(args.path), 'engine': args.engine, 'decode_seconds': decode_seconds,
+                       'total_seconds': total_seconds, 'results': results}, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,240 @@
+import os
+import json
+import shutil
+import hashlib
+import pymzml
+import numpy as np
+from utils import instrumentation
+from utils.cancel import check
+
+
+CACHE_DIR = os.environ.get('LCMS_MARKTOOL_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.lcms_marktool', 'cache'))
+CACHE_SIZE = 20 * 1024 ** 3  # bytes, the least recently used files are evicted above this limit
+VERSION = 1
+_release_callbacks = []  # called with a cache folder before it is removed
+
+
+def _cache_path(path, cache_dir=None):
+    key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir or CACHE_DIR, key)
+
+
+def _source_stat(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class CachedRun:
+    """
+    MS1 scans of mzml file stored in the cache (arrays are memory-mapped)
+    :param folder: folder of the cached file
+    :param meta: dict with description of the cached file
+    """
+    def __init__(self, folder, meta):
+        self.folder = folder
+        self.meta = meta
+        n_points = meta['points']
+        if n_points:
+            self.mz = np.memmap(os.path.join(folder, 'mz.bin'), dtype=np.float64, mode='r', shape=(n_points,))
+            self.i = np.memmap(os.path.join(folder, 'i.bin'), dtype=np.float64, mode='r', shape=(n_points,))
+        else:  # memmap of empty file is not allowed
+            self.mz = np.zeros(0)
+            self.i = np.zeros(0)
+        self.offsets = np.load(os.path.join(folder, 'offsets.npy'))
+        self.rt = np.load(os.path.join(folder, 'rt.npy'))
+        self.tic = np.load(os.path.join(folder, 'tic.npy'))
+        self.time_unit = meta['time_unit']
+        self.spectrum_count = meta['spectrum_count']  # all spectra (MS1 and MSn)
+
+    def __len__(self):
+        return len(self.rt)
+
+    def scan(self, n):
+        """
+        :param n: number of MS1 scan
+        :return: m/z and intensity arrays of the scan
+        """
+        begin, end = self.offsets[n], self.offsets[n + 1]
+        return self.mz[begin:end], self.i[begin:end]
+
+
+def on_release(callback):
+    """
+    Register a function which closes memory-mapped arrays of a cache folder (called with the folder)
+    """
+    _release_callbacks.append(callback)
+
+
+def release(path, cache_dir=None):
+    """
+    Close memory-mapped arrays of cached mzml file in this process, e.g. before the cache is rebuilt
+    in another process (open files can't be removed on Windows)
+    :param path: path to mzml file
+    """
+    _release(_cache_path(path, cache_dir))
+
+
+def _release(folder):
+    for callback in _release_callbacks:
+        callback(folder)
+
+
+def _remove(folder):
+    """
+    Remove cache folder (memory-mapped arrays of this process are closed first)
+    :return: True if the folder doesn't exist anymore (files opened by other processes can't be removed on Windows)
+    """
+    _release(folder)
+    shutil.rmtree(folder, ignore_errors=True)
+    return not os.path.exists(folder)
+
+
+def open_cached(path, cache_dir=None):
+    """
+    Open cached copy of mzml file
+    :param path: path to mzml file
+    :param cache_dir: cache directory (CACHE_DIR by default)
+    :return: CachedRun or None if the file is not cached or was changed after caching
+    """
+    folder = _cache_path(path, cache_dir)
+    meta_path = os.path.join(folder, 'meta.json')
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        mtime, size = _source_stat(path)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != VERSION or meta['mtime'] != mtime or meta['size'] != size:
+        return None
+    try:
+        run = CachedRun(folder, meta)
+    except (OSError, ValueError):
+        return None
+    os.utime(meta_path)  # mark as recently used
+    return run
+
+
+def build_cache(path, cache_dir=None, max_size=None, progress_callback=None, cancel_token=None):
+    """
+    Convert MS1 data of mzml file to binary sidecar in the cache directory
+    :param path: path to mzml file
+    :param cache_dir: cache directory (CACHE_DIR by default)
+    :param max_size: max size of the cache directory in bytes (CACHE_SIZE by default)
+    :param cancel_token: CancelToken checked after every scan (the temporary folder is removed)
+    :return: path to the cached folder
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    folder = _cache_path(path, cache_dir)
+    if open_cached(path, cache_dir) is not None:
+        return folder
+
+    mtime, size = _source_stat(path)
+    tmp_folder = f'{folder}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+    try:
+        run = pymzml.run.Reader(path)
+        spectrum_count = run.get_spectrum_count()
+        offsets = [0]
+        rt = []
+        tic = []
+        time_unit = None
+        last_time = None
+        count = 0
+        with open(os.path.join(tmp_folder, 'mz.bin'), 'wb') as mz_file, \
+                open(os.path.join(tmp_folder, 'i.bin'), 'wb') as i_file:
+            for count, scan in enumerate(run, 1):
+                check(cancel_token)
+                if scan.ms_level == 1:
+                    t, measure = scan.scan_time
+                    mz = np.asarray(scan.mz, dtype=np.float64)
+                    mz_file.write(mz.tobytes())
+                    i_file.write(np.asarray(scan.i, dtype=np.float64).tobytes())
+                    offsets.append(offsets[-1] + len(mz))
+                    rt.append(t)
+                    tic.append(scan.TIC)
+                    if not time_unit:
+                        time_unit = measure
+                if progress_callback is not None and not count % 10:
+                    progress_callback.emit(int(count * 100 / spectrum_count))
+            if count:
+                last_time = scan.scan_time
+        np.save(os.path.join(tmp_folder, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_folder, 'rt.npy'), np.array(rt, dtype=np.float64))
+        np.save(os.path.join(tmp_folder, 'tic.npy'), np.array(tic, dtype=np.float64))
+        meta = {'version': VERSION, 'source': os.path.abspath(path), 'mtime': mtime, 'size': size,
+                'points': offsets[-1], 'time_unit': time_unit, 'spectrum_count': count,
+                'last_scan_time': last_time}
+        with open(os.path.join(tmp_folder, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+        instrumentation.count('bytes_written.cache', sum(
+            os.path.getsize(os.path.join(tmp_folder, name)) for name in os.listdir(tmp_folder)))
+
+        if not _remove(folder):  # outdated copy
+            raise OSError(f'outdated cache of {path} is in use and can not be replaced: {folder}')
+        os.replace(tmp_folder, folder)
+    except BaseException:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        raise
+    evict(cache_dir, max_size, keep=folder)
+    return folder
+
+
+def evict(cache_dir=None, max_size=None, keep=None):
+    """
+    Remove the least recently used files from the cache until its size is below max_size
+    :param cache_dir: cache directory (CACHE_DIR by default)
+    :param max_size: max size of the cache directory in bytes (CACHE_SIZE by default)
+    :param keep: folder which should not be removed
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    max_size = CACHE_SIZE if max_size is None else max_size
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        folder = os.path.join(cache_dir, name)
+        meta_path = os.path.join(folder, 'meta.json')
+        if not os.path.isfile(meta_path):
+            continue  # conversion in progress
+        folder_size = sum(os.path.getsize(os.path.join(folder, file)) for file in os.listdir(folder))
+        entries.append((os.path.getmtime(meta_path), folder, folder_size))
+        total += folder_size
+    for _, folder, folder_size in sorted(entries):
+        if total <= max_size:
+            break
+        if folder != keep and _remove(folder):  # folders in use are left
+            total -= folder_size
+
+
+def read_ms1(path, progress_callback=None, cancel_token=None):
+    """
+    Iterate over MS1 scans of mzml file (from the cache if possible)
+    :param path: path to mzml file
+    :param cancel_token: CancelToken checked before every scan (Cancelled is raised)
+    :return: generator of (m/z array, intensity array, (scan time, time unit))
+    """
+    cached = open_cached(path)
+    if cached is not None:
+        n_scans = len(cached)
+        for n in range(n_scans):
+            check(cancel_token)
+            with instrumentation.timer('decode.cached'):
+                mz, i = cached.scan(n)
+            instrumentation.count('scans')
+            yield mz, i, (float(cached.rt[n]), cached.time_unit)
+            if progress_callback is not None and not n % 10:
+                progress_callback.emit(int(n * 100 / n_scans))
+        return
+
+    run = pymzml.run.Reader(path)
+    spectrum_count = run.get_spectrum_count()
+    for n, scan in enumerate(run):
+        check(cancel_token)
+        if scan.ms_level == 1:
+            with instrumentation.timer('decode'):  # peak arrays are decoded on access
+                mz, i = scan.mz, scan.i
+            instrumentation.count('scans')
+            yield mz, i, scan.scan_time
+        if progress_callback is not None and not n % 10:
+            progress_callback.emit(int(n * 100 / spectrum_count))
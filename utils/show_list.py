@@ -64,11 +64,27 @@ class FileListWidget(ClickableListWidget):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.file2path = {}
+        self.add_file = None
 
     def addFile(self, path: str):
         filename = os.path.basename(path)
         self.file2path[filename] = path
         self.addItem(filename)
+        if self.add_file is not None:
+            self.add_file(path)
+
+    def connectAddFile(self, method):
+        """
+        Set a callable object which should be called with a path when a file is added (e.g. to cache the file)
+        Parameters
+        ----------
+        method : callable
+            any callable object
+        Returns
+        -------
+        - : None
+        """
+        self.add_file = method
 
     def deleteFile(self, item: QtWidgets.QListWidgetItem):
         del self.file2path[item.text()]
@@ -88,11 +104,16 @@ class ROIListWidget(ClickableListWidget):
         self.file2path[filename] = path
         with open(path) as json_file:
             roi = json.load(json_file)
-        status = roi['label']
+        self.addROI(filename, roi['label'])
+
+    def addROI(self, name: str, status):
+        """
+        Add ROI by its name in the store (or json file) and label
+        """
         # file_name_label = QtWidgets.QLabel(filename)
         # file_status_label = QtWidgets.QLabel(status)
         item = QtWidgets.QListWidgetItem()
-        item.setText(filename)
+        item.setText(name)
         if status == 0:
             pass
         elif status == 1:
@@ -108,13 +129,150 @@ class ROIListWidget(ClickableListWidget):
         item.setData(QtCore.Qt.BackgroundRole, QtGui.QColor("white"))
 
     def deleteFile(self, item: QtWidgets.QListWidgetItem):
-        del self.file2path[item.text()]
+        self.file2path.pop(item.text(), None)  # ROIs of the store have no path
         self.takeItem(self.row(item))
 
     def getPath(self, item: QtWidgets.QListWidgetItem):
         return self.file2path[item.text()]
 
 
+class ROIListModel(QtCore.QAbstractListModel):
+    """
+    List of ROIs of a store (or json folder): names and labels are fetched from the label index in batches
+    when they are scrolled into view
+
+    Parameters
+    ----------
+    store : ROIStore or JSONFolder
+        opened ROIs (see utils.roi_store)
+    """
+    batch_size = 500
+
+    def __init__(self, store, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.total = store.count()
+        self._rows = []  # (name, label) of fetched rows
+        self._name2row = {}
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return not parent.isValid() and len(self._rows) < self.total
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        rows = self.store.labels(len(self._rows), self.batch_size)
+        if not rows:
+            self.total = len(self._rows)
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), len(self._rows), len(self._rows) + len(rows) - 1)
+        for name, label in rows:
+            self._name2row[name] = len(self._rows)
+            self._rows.append((name, label))
+        self.endInsertRows()
+
+    def fetchRow(self, row):
+        while row >= len(self._rows) and self.canFetchMore():
+            self.fetchMore()
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        name, label = self._rows[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return name
+        if role == QtCore.Qt.BackgroundRole and label not in (0, 1):  # 高亮未标注的文件
+            return QtGui.QColor("yellow")
+        return None
+
+    def name(self, row):
+        self.fetchRow(row)
+        return self._rows[row][0]
+
+    def row(self, name):
+        return self._name2row.get(name)
+
+    def setLabel(self, name, label):
+        row = self.row(name)
+        if row is not None:  # not fetched rows will be read from the index
+            self._rows[row] = (name, label)
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+    def removeName(self, name):
+        row = self.row(name)
+        if row is not None:
+            self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+            del self._rows[row]
+            self._name2row = {name: row for row, (name, _) in enumerate(self._rows)}
+            self.endRemoveRows()
+        self.total -= 1
+
+
+class ROIListView(QtWidgets.QListView):
+    """
+    Virtualized list of ROIs (only the visible rows are fetched and drawn)
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.setUniformItemSizes(True)
+        self.double_click = None
+        self.right_click = None
+
+    def setStore(self, store):
+        self.setModel(ROIListModel(store, self))
+
+    def mousePressEvent(self, QMouseEvent):
+        super().mousePressEvent(QMouseEvent)
+        if QMouseEvent.button() == QtCore.Qt.RightButton and self.right_click is not None:
+            self.right_click()
+
+    def mouseDoubleClickEvent(self, QMouseEvent):
+        if self.double_click is not None:
+            if QMouseEvent.button() == QtCore.Qt.LeftButton:
+                index = self.indexAt(QMouseEvent.pos())
+                if index.isValid():
+                    self.double_click(self.model().name(index.row()))
+
+    def connectDoubleClick(self, method):
+        """
+        Set a callable object which should be called with a name of ROI when a user double-clicks on it
+        """
+        self.double_click = method
+
+    def connectRightClick(self, method):
+        """
+        Set a callable object which should be called when a user right-clicks on the list
+        """
+        self.right_click = method
+
+    def count(self):
+        return self.model().total
+
+    def name(self, row):
+        return self.model().name(row)
+
+    def row(self, name):
+        return self.model().row(name)
+
+    def selectedName(self):
+        indexes = self.selectedIndexes()
+        return self.model().name(indexes[-1].row()) if indexes else None
+
+    def select(self, row):
+        self.model().fetchRow(row)
+        index = self.model().index(row)
+        self.setCurrentIndex(index)
+        self.scrollTo(index)
+
+    def refresh_background(self, name, label):
+        self.model().setLabel(name, label)
+
+    def deleteName(self, name):
+        self.model().removeName(name)
+
+
 class PeakListWidget(ClickableListWidget):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -147,13 +305,22 @@ class ProgressBarsListItem(QtWidgets.QWidget):
         self.pb = pb
         if self.pb is None:
             self.pb = QtWidgets.QProgressBar()
+        self.failed = False
+        self._cancel_function = None
 
         self.label = QtWidgets.QLabel(self)
         self.label.setText(text)
 
+        self.button = QtWidgets.QToolButton(self)
+        self.button.setText('×')
+        self.button.setToolTip('取消')
+        self.button.clicked.connect(self._button_clicked)
+        self.button.hide()
+
         main_layout = QtWidgets.QHBoxLayout()
         main_layout.addWidget(self.label, 30)
         main_layout.addWidget(self.pb, 70)
+        main_layout.addWidget(self.button)
 
         self.setLayout(main_layout)
 
@@ -164,6 +331,32 @@ class ProgressBarsListItem(QtWidgets.QWidget):
         self.pb.setValue(0)
         self.label.setText(text)
 
+    def connectCancel(self, function):
+        self._cancel_function = function
+        self.button.show()
+
+    def setError(self, text, details=None):
+        """
+        Keep the item with the error message until it is closed by the button
+        """
+        self.failed = True
+        self.pb.hide()
+        self.label.setText(f'{self.label.text()} 失败：{text}')
+        self.label.setStyleSheet('color: red')
+        self.label.setToolTip(details or text)
+        self.button.setToolTip('关闭')
+        self.button.setEnabled(True)
+        self.button.show()
+
+    def _button_clicked(self):
+        if self.failed:
+            self.parent().removeItem(self)
+            self.setParent(None)
+        elif self._cancel_function is not None:
+            self.label.setText(f'{self.label.text()}（正在取消）')
+            self.button.setEnabled(False)
+            self._cancel_function()
+
 class ProgressBarsList(QtWidgets.QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -1,4 +1,15 @@
+import os
+import sys
+import queue
+import pickle
+import traceback
+import multiprocessing
+from functools import partial
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 from PyQt5 import QtCore
+from utils import instrumentation
+from utils.cancel import Cancelled, CancelToken
 
 
 class WorkerSignals(QtCore.QObject):
@@ -15,6 +26,8 @@ class WorkerSignals(QtCore.QObject):
         `object` data returned from processing, anything
     progress : QtCore.pyqtSignal
         `int` indicating % progress
+    cancelled : QtCore.pyqtSignal
+        No data, the job was stopped by its cancel token (`finished` is emitted after it)
     download_progress : QtCore.pyqtSignal
         `int`, `int`, `int` used to show a count of blocks transferred,
         a block size in bytes, the total size of the file
@@ -23,6 +36,7 @@ class WorkerSignals(QtCore.QObject):
     error = QtCore.pyqtSignal(tuple)
     result = QtCore.pyqtSignal(object)
     progress = QtCore.pyqtSignal(int)
+    cancelled = QtCore.pyqtSignal()
     operation = QtCore.pyqtSignal(str)
     download_progress = QtCore.pyqtSignal(int, int, int)
 
@@ -35,9 +49,13 @@ class Worker(QtCore.QRunnable):
     ----------
     function : callable
         Any callable object
+    cancellable : bool
+        pass `cancel_token` (CancelToken) to the function, which should check it periodically
 
     Attributes
     ----------
+    cancel_token : CancelToken
+        cancels the job (a job cancelled before start isn't run at all)
     mode : str
         A one of two 'all in one' of 'sequential'
     model : nn.Module
@@ -50,13 +68,17 @@ class Worker(QtCore.QRunnable):
         minimum peak length in points
 
     """
-    def __init__(self, function, *args, download=False, multiple_process=False, **kwargs):
+    def __init__(self, function, *args, download=False, multiple_process=False, cancellable=False, **kwargs):
         super(Worker, self).__init__()
 
         self.function = function
         self.args = args
         self.kwargs = kwargs
         self.signals = WorkerSignals()
+        self.cancellable = cancellable
+        self.cancel_token = CancelToken()
+        if cancellable:
+            self.kwargs['cancel_token'] = self.cancel_token
 
         # Add the callback to our kwargs
         if not download:
@@ -69,6 +91,316 @@ class Worker(QtCore.QRunnable):
 
     @QtCore.pyqtSlot()
     def run(self):
-        result = self.function(*self.args, **self.kwargs)
-        self.signals.result.emit(result)  # return results
-        self.signals.finished.emit()  # done
+        try:
+            self.cancel_token.check()
+            with instrumentation.timer(f'worker.{getattr(self.function, "__name__", "job")}'):
+                result = instrumentation.profiled(self.function, *self.args, **self.kwargs)
+        except Cancelled:
+            self.signals.cancelled.emit()
+        except Exception:
+            exctype, value = sys.exc_info()[:2]
+            self.signals.error.emit((exctype, value, traceback.format_exc()))
+        else:
+            self.signals.result.emit(result)  # return results
+        finally:
+            self.signals.finished.emit()  # done
+
+
+class QueueProgress:
+    """
+    Picklable replacement of `progress` signal for functions running in other process
+
+    Parameters
+    ----------
+    queue : multiprocessing queue
+        (key, value) pairs are put into the queue
+    key : int
+        a key of the job
+    """
+    def __init__(self, queue, key):
+        self.queue = queue
+        self.key = key
+        self.value = None
+
+    def emit(self, value):
+        if value != self.value:  # every put is a round trip to the manager process
+            self.value = value
+            self.queue.put((self.key, value))
+
+
+class SharedResult:
+    """
+    Result of a process job whose arrays were moved to shared memory
+
+    The result is pickled (protocol 5) with numpy arrays as out-of-band buffers, the buffers
+    are copied into one shared memory block, so only the small pickle goes through the pipe.
+
+    Parameters
+    ----------
+    data : bytes
+        pickled result without array data
+    name : str
+        name of the shared memory block
+    offsets : list
+        (offset, size) of every buffer in the block
+    """
+    min_size = 1 << 20  # smaller results are pickled as usual
+
+    def __init__(self, data, name, offsets):
+        self.data = data
+        self.name = name
+        self.offsets = offsets
+
+    @classmethod
+    def pack(cls, result):
+        buffers = []
+        data = pickle.dumps(result, protocol=5, buffer_callback=buffers.append)
+        buffers = [buffer.raw() for buffer in buffers]
+        offsets = []
+        total = 0
+        for buffer in buffers:
+            total += -total % 8  # arrays of float64 stay aligned
+            offsets.append((total, buffer.nbytes))
+            total += buffer.nbytes
+        if total < cls.min_size:
+            return result
+        block = shared_memory.SharedMemory(create=True, size=total)
+        try:
+            for buffer, (offset, size) in zip(buffers, offsets):
+                block.buf[offset:offset + size] = buffer
+        finally:
+            block.close()
+        return cls(data, block.name, offsets)
+
+    def unpack(self):
+        """
+        Copy the block once and unpickle the result (arrays are views into the copy)
+        """
+        block = shared_memory.SharedMemory(name=self.name)
+        try:
+            size = self.offsets[-1][0] + self.offsets[-1][1]
+            arena = memoryview(bytearray(block.buf[:size]))
+        finally:
+            block.close()
+            block.unlink()
+        return pickle.loads(self.data, buffers=[arena[offset:offset + size] for offset, size in self.offsets])
+
+    def discard(self):
+        try:
+            block = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        block.close()
+        block.unlink()
+
+
+def _call_in_process(function, args, kwargs, queue, key, cancel_token=None):
+    kwargs['progress_callback'] = QueueProgress(queue, key)
+    if cancel_token is not None:
+        kwargs['cancel_token'] = cancel_token
+    try:
+        with instrumentation.timer(f'worker.{getattr(function, "__name__", "job")}'):
+            result = instrumentation.profiled(function, *args, **kwargs)
+        with instrumentation.timer('worker.share_result'):
+            return SharedResult.pack(result)
+    finally:
+        instrumentation.dump_process()  # pool processes don't run atexit handlers
+
+
+class ProcessWorker:
+    """
+    Worker which runs a callable in a process of ProcessPool
+
+    Parameters
+    ----------
+    function : callable
+        Any picklable callable object (a function defined at module level)
+    cancellable : bool
+        pass `cancel_token` (shared with the process by the pool) to the function
+
+    Attributes
+    ----------
+    signals : WorkerSignals
+        the same signals as for Worker (emitted in the main thread)
+    """
+    def __init__(self, function, *args, cancellable=False, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.cancellable = cancellable
+        self.signals = WorkerSignals()
+
+
+class ProcessPool(QtCore.QObject):
+    """
+    Pool of processes for CPU-bound functions (they don't hold GIL of the GUI process)
+
+    Progress and results of the running jobs are polled by timer in the main thread
+    and are emitted through the signals of ProcessWorker. Large results (e.g. arrays of ROIs)
+    come back through shared memory (see SharedResult).
+
+    Parameters
+    ----------
+    max_workers : int
+        number of processes, by default number of CPU cores
+    """
+    def __init__(self, max_workers=None, parent=None):
+        super().__init__(parent)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = None
+        self._manager = None
+        self._queue = None
+        self._jobs = {}  # key -> (worker, future, cancel token)
+        self._next_key = 0
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(100)
+        self._timer.timeout.connect(self._poll)
+
+    def start(self, worker: ProcessWorker):
+        if self._executor is None:
+            context = multiprocessing.get_context('spawn')  # forking the GUI process is not safe
+            self._executor = ProcessPoolExecutor(self.max_workers, mp_context=context)
+            self._manager = context.Manager()
+            self._queue = self._manager.Queue()
+        key = self._next_key
+        self._next_key += 1
+        cancel_token = CancelToken(self._manager.Event()) if worker.cancellable else None
+        future = self._executor.submit(_call_in_process, worker.function, worker.args, worker.kwargs,
+                                       self._queue, key, cancel_token)
+        self._jobs[key] = (worker, future, cancel_token)
+        self._timer.start()
+
+    def cancel(self, worker: ProcessWorker):
+        for key, (job_worker, future, cancel_token) in list(self._jobs.items()):
+            if job_worker is worker:
+                if future.cancel():  # still in the queue
+                    del self._jobs[key]
+                    worker.signals.cancelled.emit()
+                    worker.signals.finished.emit()
+                elif cancel_token is not None:
+                    cancel_token.cancel()  # the result is polled as usual
+
+    def _poll(self):
+        progress = {}
+        while True:
+            try:
+                key, value = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            progress[key] = value  # only the last value of each job is shown
+        for key, value in progress.items():
+            if key in self._jobs:
+                self._jobs[key][0].signals.progress.emit(value)
+        for key, (worker, future, _) in list(self._jobs.items()):
+            if future.done():
+                del self._jobs[key]
+                exception = future.exception()
+                if exception is None:
+                    result = future.result()
+                    if isinstance(result, SharedResult):
+                        result = result.unpack()
+                    worker.signals.result.emit(result)  # return results
+                elif isinstance(exception, Cancelled):
+                    worker.signals.cancelled.emit()
+                else:
+                    worker.signals.error.emit((type(exception), exception, ''.join(
+                        traceback.format_exception(type(exception), exception, exception.__traceback__))))
+                worker.signals.finished.emit()  # done
+        if not self._jobs:
+            self._timer.stop()
+
+    def shutdown(self):
+        if self._executor is not None:
+            for _, future, cancel_token in self._jobs.values():
+                if future.done() and not future.cancelled() and future.exception() is None \
+                        and isinstance(future.result(), SharedResult):
+                    future.result().discard()  # never polled
+                elif not future.cancel() and cancel_token is not None:
+                    cancel_token.cancel()
+            self._executor.shutdown(wait=False)
+            self._manager.shutdown()
+            self._executor = None
+
+
+class JobScheduler(QtCore.QObject):
+    """
+    Runs workers in priority lanes, cancels them and skips duplicates of jobs in flight
+
+    Interactive jobs (e.g. plotting of TIC/EIC) have their own threads and processes, so they
+    are never queued behind long batch jobs (e.g. ROI generation). ProcessWorker jobs go to
+    the ProcessPool of their lane (processes are started on the first job).
+
+    Parameters
+    ----------
+    batch_threads : int
+        number of threads for batch jobs, by default number of CPU cores minus one
+    """
+    LANES = ('interactive', 'batch')
+
+    def __init__(self, batch_threads=None, parent=None):
+        super().__init__(parent)
+        ideal = QtCore.QThread.idealThreadCount()
+        self._pools = {lane: QtCore.QThreadPool(self) for lane in self.LANES}
+        self._pools['interactive'].setMaxThreadCount(max(2, ideal // 2))
+        self._pools['batch'].setMaxThreadCount(batch_threads or max(1, ideal - 1))
+        cpu_count = os.cpu_count() or 1
+        self._process_pools = {'interactive': ProcessPool(max(1, cpu_count // 2), parent=self),
+                               'batch': ProcessPool(cpu_count, parent=self)}
+        self._in_flight = {}  # key -> worker
+        self._workers = set()  # all started workers (to be cancelled on shutdown)
+
+    def is_running(self, key):
+        return key is not None and key in self._in_flight
+
+    def submit(self, worker, lane='batch', key=None):
+        """
+        Start the worker (signals should be connected before)
+
+        Parameters
+        ----------
+        worker : Worker or ProcessWorker
+        lane : str
+            'interactive' or 'batch'
+        key : hashable
+            identity of the job (e.g. function and path), the worker isn't started if
+            a job with the same key is in flight
+
+        Returns
+        -------
+        bool
+            False if the job is a duplicate
+        """
+        if self.is_running(key):
+            return False
+        if key is not None:
+            self._in_flight[key] = worker
+            worker.signals.finished.connect(partial(self._in_flight.pop, key, None))
+        self._workers.add(worker)
+        worker.signals.finished.connect(partial(self._workers.discard, worker))
+        if isinstance(worker, ProcessWorker):
+            self._process_pools[lane].start(worker)
+        else:
+            self._pools[lane].start(worker)
+        return True
+
+    def cancel(self, worker):
+        if isinstance(worker, ProcessWorker):
+            for pool in self._process_pools.values():
+                pool.cancel(worker)
+            return
+        worker.cancel_token.cancel()
+        for pool in self._pools.values():
+            if pool.tryTake(worker):  # still in the queue, never runs
+                worker.signals.cancelled.emit()
+                worker.signals.finished.emit()
+                break
+
+    def shutdown(self):
+        for pool in self._pools.values():
+            pool.clear()
+        for worker in list(self._workers):
+            if isinstance(worker, Worker):
+                worker.cancel_token.cancel()
+        for pool in self._process_pools.values():
+            pool.shutdown()